@@ -8,7 +8,7 @@ VENV=$DIR/.venv/bin/activate
 
 cd $DIR/src
 source $VENV
-export PYTHONPATH=$DIR/src APP_ENDPOINTS=asn APP_SPACE_INIT=no APP_MODE=PROD
+export PYTHONPATH=$DIR/src APP_ENDPOINTS=asn APP_SPACE_INIT=no APP_INDEX_INIT=no APP_MODE=PROD
 
 exec uvicorn app:app \
     --host 0.0.0.0 \
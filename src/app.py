@@ -23,7 +23,8 @@ from extensions import (
     mongo
 )
 from config import Config
-from ip.views import _ip_space_init
+from ip.views import _ip_snapshot_init, _ip_space_warmup, _ip_index_init, _ip_enrich_init
+from asn.views import _as_index_init
 from logs import configure_logs
 
 
@@ -142,9 +143,24 @@ def config_app():
 config_app()
 
 
+@app.on_event('startup')
+async def ip_enrich_init():
+    _ip_enrich_init()
+
+
+if str(os.getenv('APP_INDEX_INIT', 'yes')).lower() == 'yes':
+    print('init index ...')
+
+    @app.on_event('startup')
+    async def ip_index_init():
+        await _ip_index_init()
+        await _as_index_init()
+
+
 if str(os.getenv('APP_SPACE_INIT', 'yes')).lower() == 'yes':
     print('init space ...')
 
     @app.on_event('startup')
     async def ip_space_init():
-        await _ip_space_init()
+        _ip_snapshot_init()
+        _ip_space_warmup()
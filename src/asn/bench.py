@@ -0,0 +1,146 @@
+import time
+import random
+import logging
+from .services import build_cernet_paths
+
+
+logger = logging.getLogger('asn.bench')
+
+# upstreams of the synthetic routes, the first hop of every one
+FIRST_HOPS = [4538, 4134, 4837, 9808, 23911, 24350, 38272, 58879, 9929, 7497]
+
+
+def synthetic_paths(n: int, ases: int = 60000, seed: int = 1) -> list:
+    """
+    n as paths of 2 to 8 hops, the hops after the first drawn from a
+    skewed distribution so some transit ases carry most routes
+    """
+    rnd = random.Random(seed)
+    pool = list(range(1, ases + 1))
+    weights = [1 / i for i in pool]
+
+    hops = rnd.choices(pool, weights=weights, k=n * 8)
+    paths = []
+    for i in range(n):
+        length = rnd.randint(2, 8)
+        paths.append([rnd.choice(FIRST_HOPS)] + hops[i * 8: i * 8 + length - 1])
+
+    return paths
+
+
+def _legacy_top_hops(idx, routes, need):
+    # get_top_hops before the hop trie: the routes re-bucketed at every level
+    last_count = {}
+    last_route_map = {}
+    _routes = []
+    for route in routes:
+        if idx >= len(route):
+            _routes.append(route)
+            continue
+
+        if route[idx] not in last_count:
+            last_count[route[idx]] = 1
+            last_route_map[route[idx]] = [route]
+        else:
+            last_count[route[idx]] += 1
+            last_route_map[route[idx]].append(route)
+
+    filter_count = sorted(list(last_count.items()), key=lambda x: x[1], reverse=True)[:need]
+    filter_map = {k for k, _ in filter_count}
+
+    return {k: v for k, v in last_route_map.items() if k in filter_map}, _routes
+
+
+def _legacy_need_count(route_map, top=10):
+    max_count = max((len(v) for v in route_map.values()), default=0)
+
+    count_map = {}
+    depend_map = {}
+    for k, v in route_map.items():
+        n = max(int(top * len(v) / max_count), 1)
+        count_map[k] = n
+        depend_map[k] = n * 1000
+
+    return count_map, depend_map
+
+
+def legacy_cernet_paths(paths: list) -> (list, dict):
+    """
+    cernet_paths and get_paths before the hop trie, depth 4 and tops 10/7,
+    kept to check and time the trie against
+    """
+    length = 4
+    routes = []
+    records = set()
+
+    for path in paths:
+        _path = [str(_c) for _c in path[:length]]
+        if ','.join(_path) in records:
+            continue
+
+        for i in range(1, len(_path) + 1):
+            records.add(','.join(_path[:i]))
+        routes.append(_path)
+
+    level_map = {}
+    for idx in range(length):
+        for route in routes:
+            if len(route) < idx + 1:
+                continue
+
+            if route[idx] not in level_map:
+                level_map[route[idx]] = (idx, 0)
+            else:
+                _i, _c = level_map[route[idx]]
+                if _i == idx:
+                    if _c != 0:
+                        route[idx] = f'{route[idx]}-{_c}'
+                else:
+                    level_map[route[idx]] = (idx, _c + 1)
+                    route[idx] = f'{route[idx]}-{_c + 1}'
+
+    tops, _ = _legacy_top_hops(0, routes, need=10)
+    short_routes = []
+    depend_map = {}
+
+    for idx in range(1, length):
+        count_map, _depend_map = _legacy_need_count(tops, top=7)
+        depend_map.update(_depend_map)
+
+        _tops = {}
+        for v, _routes in tops.items():
+            _t, _r = _legacy_top_hops(idx, _routes, count_map[v])
+            short_routes += _r
+            _tops.update(_t)
+        tops = _tops
+
+    for v, _routes in tops.items():
+        depend_map[v] = len(_routes) * 1000
+
+    _filter_routes = []
+    for _routes in tops.values():
+        _filter_routes += _routes
+
+    return _filter_routes + short_routes, depend_map
+
+
+def bench_cernet_paths(n: int, depth: int = 4, first_top: int = 10, top: int = 7,
+                       seed: int = 1, legacy: bool = True) -> dict:
+    tick = time.time()
+    paths = synthetic_paths(n, seed=seed)
+    result = {'routes': n, 'generate': round(time.time() - tick, 3)}
+
+    tick = time.time()
+    routes, point_map = build_cernet_paths(paths, depth, first_top, top)
+    result['trie'] = round(time.time() - tick, 3)
+    result['top_routes'] = len(routes)
+
+    # the legacy code only knows the defaults
+    if legacy and (depth, first_top, top) == (4, 10, 7):
+        tick = time.time()
+        _routes, _point_map = legacy_cernet_paths(paths)
+        result['legacy'] = round(time.time() - tick, 3)
+        result['same'] = (_routes, _point_map) == (routes, point_map)
+
+    logger.info(f'bench cernet paths {result}')
+    return result
@@ -0,0 +1,210 @@
+import logging
+from collections import OrderedDict
+from pymongo import InsertOne
+from config import Config
+from database.models import TableSelector
+from database.services import VersionedLoader
+from .services import strip_location_name, get_cities_location, convert_bandwidth_list
+
+
+logger = logging.getLogger('asn.history')
+
+EDU_HISTORY_VERSION = 'as/cernet/history'
+
+
+class HistoryLedger:
+    """
+    the state /as/cernet/history replays vis_edu_as_history into, in the
+    order the rows are stored: the bandwidth total, the locations seen and
+    the routes, the bandwidth of every (location, asn, name) or abroad the
+    open (location, asn, name, bandwidth) lines, a removal closing an open
+    line of the same bandwidth
+    """
+
+    def __init__(self, abroad: int, bandwidth: float = 0, locations: list = None, routes: list = None):
+        self.abroad = abroad
+        self.bandwidth = bandwidth
+        self.locations = set(locations or [])
+        self.routes = {tuple(_k): _v for _k, _v in routes or []}  # in the order first opened
+
+    def add(self, cur: dict):
+        self.bandwidth += cur['bandwidth']
+        self.locations.add(cur['location'])
+
+        if self.abroad == 0:
+            _key = cur['location'], cur['asn'], strip_location_name(cur['name'])
+            self.routes[_key] = self.routes.get(_key, 0) + cur['bandwidth']
+            return
+
+        _key = cur['location'], cur['asn'], cur['name'], cur['bandwidth']
+        _rkey = cur['location'], cur['asn'], cur['name'], -cur['bandwidth']
+
+        if _key not in self.routes:
+            if _rkey in self.routes:
+                self.routes[_rkey] -= 1
+                if self.routes[_rkey] == 0:
+                    del self.routes[_rkey]
+                return
+
+            self.routes[_key] = 0
+
+        self.routes[_key] += 1
+
+    def to_doc(self, version: int, date: int) -> dict:
+        return {'version': version, 'abroad': self.abroad, 'date': date,
+                'bandwidth': self.bandwidth, 'locations': sorted(self.locations),
+                'routes': [[list(_k), _v] for _k, _v in self.routes.items()]}
+
+    @classmethod
+    def from_doc(cls, doc: dict):
+        return cls(doc['abroad'], doc['bandwidth'], doc['locations'], doc['routes'])
+
+    def to_data(self, location_map: dict) -> dict:
+        ases = set()
+        locations = set()
+        routes = []
+
+        for _key, _value in self.routes.items():
+            if self.abroad == 0:
+                (_location, _asn, _name), _bandwidth, _count = _key, _value, 1
+                if _bandwidth <= 0:
+                    continue
+            else:
+                (_location, _asn, _name, _bandwidth), _count = _key, _value
+                if _count < 1 or _bandwidth == 0:
+                    continue
+
+            ases.add(_asn)
+            locations.add(_location)
+
+            _lng, _lat = location_map.get(_location, (None, None))
+            for i in range(_count):
+                routes.append({
+                    'bandwidth': _bandwidth,
+                    'location': _location,
+                    'asn': f"AS{_asn}",
+                    'name': _name,
+                    'lng': _lng,
+                    'lat': _lat,
+                })
+
+        return {
+            'ases': len(ases),
+            'locations': len(locations),
+            'bandwidth': round(self.bandwidth, 3),
+            'routes': convert_bandwidth_list(routes)
+        }
+
+
+def _month_end(date: int) -> int:
+    # 20200315 -> 20200399, after every day of the month
+    return date // 100 * 100 + 99
+
+
+def store_history_checkpoints(version: int, abroad: int) -> int:
+    """
+    for the cli: the ledger at the end of every month with rows, stored for
+    the next version before it is bumped. a checkpoint holds the rows up to
+    its date only when the rows are stored in date order, otherwise none
+    are stored and every request replays from the first row
+    :return: checkpoints stored
+    """
+    _table = TableSelector.get_edu_as_history_table(name='default_sync')
+    _checkpoints = TableSelector.get_edu_as_history_checkpoint_table(name='default_sync')
+    _checkpoints.create_index([('version', 1), ('abroad', 1), ('date', -1)])
+    _checkpoints.delete_many({'version': version, 'abroad': abroad})
+
+    ledger = HistoryLedger(abroad)
+    ops = []
+    last = None
+
+    for cur in _table.find({'abroad': abroad}, {'_id': 0}):
+        if last is not None and cur['date'] < last:
+            logger.warning(f'rows of abroad={abroad} not in date order at date={cur["date"]}, '
+                           f'no checkpoints stored')
+            return 0
+
+        if last is not None and _month_end(cur['date']) != _month_end(last):
+            ops.append(InsertOne(ledger.to_doc(version, _month_end(last))))
+
+        ledger.add(cur)
+        last = cur['date']
+
+    if last is not None:
+        ops.append(InsertOne(ledger.to_doc(version, _month_end(last))))
+
+    for i in range(0, len(ops), 100):
+        _checkpoints.bulk_write(ops[i: i + 100], ordered=True)
+
+    logger.info(f'stored history checkpoints={len(ops)}, abroad={abroad}, version={version}')
+    return len(ops)
+
+
+def drop_history_checkpoints(version: int) -> int:
+    _checkpoints = TableSelector.get_edu_as_history_checkpoint_table(name='default_sync')
+    return _checkpoints.delete_many({'version': {'$lt': version}}).deleted_count
+
+
+class EduHistory:
+    """
+    /as/cernet/history of one version of vis_edu_as_history: the nearest
+    checkpoint at or before the date plus the rows after it, the result
+    memoized per (date, abroad) until the next import
+    """
+
+    def __init__(self, version: int):
+        self.version = version
+        self._data = OrderedDict()
+
+    async def _ledger(self, abroad: int, date: int) -> HistoryLedger:
+        _checkpoints = TableSelector.get_edu_as_history_checkpoint_table()
+        doc = await _checkpoints.find_one({'version': self.version, 'abroad': abroad, 'date': {'$lte': date}},
+                                          {'_id': 0}, sort=[('date', -1)])
+
+        q = {'abroad': abroad, 'date': {'$lte': date}}
+        if doc:
+            ledger = HistoryLedger.from_doc(doc)
+            q['date']['$gt'] = doc['date']
+        else:
+            ledger = HistoryLedger(abroad)
+
+        logger.debug(f'q={q}, checkpoint={doc["date"] if doc else None}')
+
+        _table = TableSelector.get_edu_as_history_table()
+        async for cur in _table.find(q):
+            ledger.add(cur)
+
+        return ledger
+
+    async def get(self, date: int, abroad: int) -> dict:
+        """
+        :param date: year, rows up to its end are replayed
+        """
+        _key = date, abroad
+        if _key in self._data:
+            self._data.move_to_end(_key)
+            return self._data[_key]
+
+        ledger = await self._ledger(abroad, date * 10000 + 9999)
+
+        location_map = {}
+        if ledger.locations:
+            location_map = await get_cities_location(ledger.locations)
+
+        data = ledger.to_data(location_map)
+        self._data[_key] = data
+        if len(self._data) > Config.EDU_HISTORY_MEMO:
+            self._data.popitem(last=False)
+
+        return data
+
+
+async def _load_edu_history(version):
+    return EduHistory(version)
+
+
+edu_histories = VersionedLoader(EDU_HISTORY_VERSION, _load_edu_history)
+
+
+async def get_edu_history() -> EduHistory:
+    return await edu_histories.get()
@@ -0,0 +1,305 @@
+import logging
+import numpy as np
+from ipaddress import IPv4Network
+from pymongo import InsertOne
+from config import Config
+from database.models import TableSelector, VisCache
+from database.services import VersionedLoader
+from ip.lpm import IntervalMatcher
+from .services import build_cernet_paths, cernet_paths
+
+
+logger = logging.getLogger('asn.index')
+
+CERNET_PATH_VERSION = 'as/cernet/path'
+CERNET_PATH_KEY = 'as/cernet/path'  # of the /as/cernet/path result in vis_as_cache
+
+
+class CernetPathIndex:
+    """
+    all prefixes of vis_edu_as_path in process, one level per prefix
+    length holding its sorted starts; a containing prefix is one probe per
+    level from the longest, contained ones the first start of every level
+    at or after the queried start
+    """
+
+    PROJECTION = {'_id': 0, 'prefix': 1, 'prefix_start': 1, 'prefix_end': 1, 'path': 1}
+
+    def __init__(self, version: int, rows: list):
+        self.version = version
+
+        rows = sorted(rows, key=lambda x: (x['prefix_start'], -x['prefix_end']))
+        self.prefixes = [r['prefix'] for r in rows]
+        self.paths = [[str(_p) for _p in r['path']] for r in rows]
+        self.starts = [r['prefix_start'] for r in rows]
+        self.ends = [r['prefix_end'] for r in rows]
+
+        cidrs = np.array([33 - (e - s + 1).bit_length() for s, e in zip(self.starts, self.ends)],
+                         dtype=np.int64)
+        starts = np.array(self.starts, dtype=np.int64)
+
+        # rows are ordered by start, a stable sort by cidr keeps every level ordered
+        order = np.argsort(cidrs, kind='stable')
+        bounds = np.r_[0, np.flatnonzero(np.diff(cidrs[order])) + 1, len(order)]
+
+        self.levels = {}  # {cidr: (starts, rows)}
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if lo < hi:
+                _rows = order[lo:hi]
+                self.levels[int(cidrs[_rows[0]])] = (starts[_rows], _rows)
+
+        self._matcher = None
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    @property
+    def matcher(self) -> IntervalMatcher:
+        # point lookups of ips, built on the first use
+        if self._matcher is None:
+            self._matcher = IntervalMatcher('4', self.starts, self.ends)
+        return self._matcher
+
+    def containing_many(self, lefts: np.ndarray, rights: np.ndarray) -> np.ndarray:
+        """
+        prefix_start <= left and prefix_end >= right, the most specific one
+        :return: rows, -1 when none
+        """
+        found = np.full(len(lefts), -1, dtype=np.int64)
+
+        for cidr in sorted(self.levels, reverse=True):
+            starts, rows = self.levels[cidr]
+            shift = 32 - cidr
+            keys = lefts >> shift << shift
+
+            i = np.searchsorted(starts, keys)
+            _i = np.minimum(i, len(starts) - 1)
+            hit = (found < 0) & (i < len(starts)) & (starts[_i] == keys) & \
+                  ((rights >> shift) == (lefts >> shift))
+            found[hit] = rows[_i[hit]]
+
+        return found
+
+    def contained_many(self, lefts: np.ndarray, rights: np.ndarray) -> np.ndarray:
+        """
+        prefix_start >= left and prefix_end <= right, the smallest start,
+        the shortest prefix of the same start
+        :return: rows, -1 when none
+        """
+        found = np.full(len(lefts), -1, dtype=np.int64)
+        first = np.full(len(lefts), 2 ** 33, dtype=np.int64)
+
+        for cidr in sorted(self.levels):
+            starts, rows = self.levels[cidr]
+
+            i = np.searchsorted(starts, lefts)
+            _i = np.minimum(i, len(starts) - 1)
+            hit = (i < len(starts)) & (starts[_i] + (2 ** (32 - cidr) - 1) <= rights) & \
+                  (starts[_i] < first)
+            found[hit] = rows[_i[hit]]
+            first[hit] = starts[_i[hit]]
+
+        return found
+
+    def search_many(self, prefixes: list) -> list:
+        """
+        same as the mongo queries /as/cernet/path/search used to make: the
+        most specific prefix containing the queried one, else the first
+        prefix inside it
+        :return: [{"prefix", "data", "matched", "message"}] in the order of prefixes
+        """
+        lefts, rights, valid = [], [], []
+        for prefix in prefixes:
+            try:
+                _net = IPv4Network(prefix)
+                lefts.append(int(_net.network_address))
+                rights.append(int(_net.broadcast_address))
+                valid.append(True)
+
+            except (TypeError, ValueError):
+                lefts.append(0)
+                rights.append(0)
+                valid.append(False)
+
+        lefts = np.array(lefts, dtype=np.int64)
+        rights = np.array(rights, dtype=np.int64)
+
+        found = self.containing_many(lefts, rights)
+        missed = found < 0
+        if missed.any():
+            found[missed] = self.contained_many(lefts[missed], rights[missed])
+
+        items = []
+        for prefix, _valid, row in zip(prefixes, valid, found.tolist()):
+            if not _valid:
+                items.append({'prefix': prefix, 'data': [], 'matched': None, 'message': 'invalid prefix'})
+            elif row < 0:
+                items.append({'prefix': prefix, 'data': [], 'matched': None, 'message': ''})
+            else:
+                items.append({'prefix': prefix, 'data': self.paths[row],
+                              'matched': self.prefixes[row], 'message': ''})
+
+        return items
+
+    def to_item(self, row: int) -> dict:
+        return {'prefix': self.prefixes[row], 'path': self.paths[row]}
+
+
+async def _load_cernet_path_index(version):
+    _table = TableSelector.get_edu_as_path_table()
+    rows = [cur async for cur in _table.find({}, CernetPathIndex.PROJECTION)]
+
+    logger.debug(f'loaded cernet path rows={len(rows)}, version={version}')
+    return CernetPathIndex(version, rows)
+
+
+cernet_path_index = VersionedLoader(CERNET_PATH_VERSION, _load_cernet_path_index)
+
+
+async def get_cernet_path_index() -> CernetPathIndex:
+    return await cernet_path_index.get()
+
+
+def store_cernet_paths(version: int, paths: list = None, point_map: dict = None) -> dict:
+    """
+    for the cli: the /as/cernet/path result of the next version is stored
+    before the version is bumped, computed from vis_edu_as_path unless given
+    """
+    if paths is None:
+        _table = TableSelector.get_edu_as_path_table(name='default_sync')
+        paths, point_map = build_cernet_paths(cur['path'] for cur in _table.find({}, {'path': 1}))
+
+    data = {'data': {'paths': paths, 'dependencies': point_map},
+            'status': 'ok', 'message': '', 'version': version}
+
+    _table = TableSelector.get_as_cache_table(name='default_sync')
+    _table.update_one({'key': CERNET_PATH_KEY}, {'$set': data}, upsert=True)
+
+    logger.info(f'stored cernet paths routes={len(paths)}, version={version}')
+    return data
+
+
+async def _load_cernet_path_result(version):
+    cached = await VisCache.get_cache(CERNET_PATH_KEY)
+    if cached and cached.get('version') == version:
+        cached.pop('version')
+        return cached
+
+    # imported before the result was stored with the version, computed once
+    logger.warning(f'no cernet paths stored for version={version}, computing them')
+    paths, point_map = await cernet_paths()
+
+    data = {'data': {'paths': paths, 'dependencies': point_map}, 'status': 'ok', 'message': ''}
+    await VisCache.add_cache(CERNET_PATH_KEY, dict(data, version=version))
+    return data
+
+
+cernet_path_results = VersionedLoader(CERNET_PATH_VERSION, _load_cernet_path_result)
+
+
+class CernetPathRollup:
+    """
+    per as of vis_edu_as_path, the routes carrying it at each of the first
+    Config.CERNET_PATH_DEPTH hops; kept in vis_edu_as_path_rollup by the
+    cernet-path importer, one row per as and version, /as/cernet/summary
+    and any top-n of dependencies are read from it in process
+    """
+
+    def __init__(self, version: int, rows: list = None, depth: int = None):
+        self.version = version
+        self.depth = depth or Config.CERNET_PATH_DEPTH
+        self.hops = {}  # {asn: [routes per hop]}, in the order first seen
+
+        for row in sorted(rows or [], key=lambda x: x['first']):
+            self.hops[row['asn']] = row['hops']
+
+        self._summary = None
+        self._dependencies = None
+
+    def __len__(self):
+        return len(self.hops)
+
+    def add(self, path):
+        for idx, v in enumerate(path[:self.depth]):
+            _hops = self.hops.get(v)
+            if _hops is None:
+                _hops = self.hops[v] = [0] * self.depth
+            _hops[idx] += 1
+
+    def as_summary(self) -> list:
+        # distinct ases at every hop
+        if self._summary is None:
+            self._summary = [sum(1 for _h in self.hops.values() if _h[idx]) for idx in range(self.depth)]
+        return self._summary
+
+    def top_dependencies(self, n: int) -> list:
+        # routes through an as at any of the hops, ties to the as seen first;
+        # sorted once, every n is a slice of it
+        if self._dependencies is None:
+            _deps = [{'as': str(v), 'dependency': sum(_h)} for v, _h in self.hops.items()]
+            self._dependencies = sorted(_deps, key=lambda x: x['dependency'], reverse=True)
+        return self._dependencies[:n]
+
+    def summary(self, n: int = 5) -> dict:
+        return {'data': {'top_dependencies': self.top_dependencies(n),
+                         'as_summary': self.as_summary()},
+                'status': 'ok', 'message': ''}
+
+    def to_ops(self) -> list:
+        return [InsertOne({'version': self.version, 'asn': v, 'first': i,
+                           'hops': _h, 'dependency': sum(_h)})
+                for i, (v, _h) in enumerate(self.hops.items())]
+
+
+def store_cernet_rollup(version: int, paths=None) -> CernetPathRollup:
+    """
+    for the cli: rows of the next version are written before the version is
+    bumped, the rows of older versions are dropped by drop_cernet_rollups
+    :param paths: as paths of vis_edu_as_path, read from it unless given
+    """
+    if paths is None:
+        _table = TableSelector.get_edu_as_path_table(name='default_sync')
+        paths = (cur['path'] for cur in _table.find({}, {'path': 1}))
+
+    rollup = CernetPathRollup(version)
+    for path in paths:
+        rollup.add(path)
+
+    _table = TableSelector.get_edu_as_path_rollup_table(name='default_sync')
+    _table.create_index([('version', 1), ('dependency', -1)])
+    _table.delete_many({'version': version})
+
+    ops = rollup.to_ops()
+    for i in range(0, len(ops), 10000):
+        _table.bulk_write(ops[i: i + 10000], ordered=False)
+
+    logger.info(f'stored cernet path rollup ases={len(rollup)}, version={version}')
+    return rollup
+
+
+def drop_cernet_rollups(version: int) -> int:
+    _table = TableSelector.get_edu_as_path_rollup_table(name='default_sync')
+    return _table.delete_many({'version': {'$lt': version}}).deleted_count
+
+
+async def _load_cernet_rollup(version):
+    _table = TableSelector.get_edu_as_path_rollup_table()
+    rows = [cur async for cur in _table.find({'version': version}, {'_id': 0, 'asn': 1, 'first': 1, 'hops': 1})]
+    if rows:
+        logger.debug(f'loaded cernet path rollup rows={len(rows)}, version={version}')
+        return CernetPathRollup(version, rows)
+
+    # imported before the importer kept the rollup, counted once in process
+    logger.warning(f'no cernet path rollup for version={version}, counting vis_edu_as_path')
+    rollup = CernetPathRollup(version)
+    async for cur in TableSelector.get_edu_as_path_table().find({}, {'path': 1}):
+        rollup.add(cur['path'])
+
+    return rollup
+
+
+cernet_rollups = VersionedLoader(CERNET_PATH_VERSION, _load_cernet_rollup)
+
+
+async def get_cernet_rollup() -> CernetPathRollup:
+    return await cernet_rollups.get()
@@ -8,7 +8,8 @@ from typing import Optional, Literal
 import json
 import re
 from extensions import mongo
-from utils.request import PageQuery, TimeRangeQuery
+from config import Config
+from utils.request import PageQuery, TimeRangeQuery, RefreshQuery
 from utils.misc import (
     subnet_range,
     str_to_int_v4,
@@ -369,6 +370,15 @@ class ASPathSearchQuery(BaseModel):
     prefix: str = Field(Query())
 
 
+class ASPathSearchBatchBody(BaseModel):
+    prefixes: list[str] = []
+
+
+class ASCernetSummaryQuery(RefreshQuery):
+    # refresh, top
+    top: int = Field(Query(default=5, ge=1, le=Config.CERNET_SUMMARY_TOP_MAX))
+
+
 class ASTrendsQuery(BaseModel):
     countries: Optional[str] = Field(Query(default=None))
 
@@ -1,9 +1,11 @@
 import logging
+import numpy as np
 from utils.misc import (
     to_list,
     to_str_list
 )
 from database.models import TableSelector
+from config import Config
 
 logger = logging.getLogger('asn.services')
 
@@ -86,155 +88,190 @@ def load_all_ases_country():
     return as_map
 
 
-def get_top_hops(idx, routes, need):
-
-    last_count = {}
-    last_route_map = {}
-    _routes = []
-    for route in routes:
-
-        if idx >= len(route):
-            _routes.append(route)
-            continue
-
-        if route[idx] not in last_count:
-            last_count[route[idx]] = 1
-            last_route_map[route[idx]] = [route]
-
-        else:
-            last_count[route[idx]] += 1
-            last_route_map[route[idx]].append(route)
-
-    filter_count = sorted(list(last_count.items()), key=lambda x: x[1], reverse=True)[:need]
-    filter_map = {k for k, _ in filter_count}
-
-    return {k: v for k, v in last_route_map.items() if k in filter_map}, _routes
-
-
-def get_need_count(route_map, top=10):
-    max_count = 0
-
-    for k, v in route_map.items():
-        if len(v) >= max_count:
-            max_count = len(v)
-
-    count_map = {}
-    depend_map = {}
-
-    for k, v in route_map.items():
-        n = int(top * len(v) / max_count)
-        if n < 1:
-            n = 1
-
-        count_map[k] = n
-        depend_map[k] = n * 1000
+class HopTrie:
+    """
+    distinct as paths cut to `depth` hops (None - not cut), a node per path
+    prefix kept as parallel lists of parent and hop with the edges in one
+    dict {"parent hop": node}, node 0 being the root; a path equal to or a
+    prefix of one already added is skipped. freeze() turns the lists into
+    numpy arrays with the route count, first route and children of every
+    node, the top-k selection and naming are read from them
+    """
 
-    return count_map, depend_map
+    def __init__(self, depth: int = None):
+        self.depth = depth
+        self.edges = {}
+        self.parents = [0]
+        self.hops = ['']
+        self.ends = []  # the node every route ends at, a route is read back from it
+
+    def __len__(self):
+        return len(self.ends)
+
+    def add(self, path) -> bool:
+        path = [str(_h) for _h in path[:self.depth]]
+        edges, parents = self.edges, self.parents
+
+        node, added = 0, False
+        for hop in path:
+            edge = f'{node} {hop}'
+            child = edges.get(edge)
+            if child is None:
+                child = edges[edge] = len(parents)
+                parents.append(node)
+                self.hops.append(hop)
+                added = True
+            node = child
+
+        if not added:
+            return False
+
+        self.ends.append(node)
+        return True
+
+    def freeze(self):
+        size = len(self.parents)
+        parents = np.array(self.parents, dtype=np.int64)
+
+        # a child is created after its parent, the levels settle in depth passes
+        levels = np.zeros(size, dtype=np.int64)
+        while True:
+            _levels = levels[parents] + 1
+            _levels[0] = 0
+            if np.array_equal(_levels, levels):
+                break
+            levels = _levels
+        self.level = levels - 1  # of the hop in the path, -1 for the root
+
+        # a route creates the nodes from the first hop not seen before to its
+        # end, so the ends grow with the routes and a node has one route at most
+        ends = np.array(self.ends, dtype=np.int64)
+        self.route = np.full(size, -1, dtype=np.int64)
+        self.route[ends] = np.arange(len(ends))
+        self.first = np.searchsorted(ends, np.arange(size))
+
+        count = np.zeros(size, dtype=np.int64)
+        count[ends] = 1
+        for level in range(int(levels.max()), 0, -1):
+            _nodes = np.flatnonzero(levels == level)
+            count += np.bincount(parents[_nodes], weights=count[_nodes], minlength=size).astype(np.int64)
+        self.count = count
+
+        # children in the order they were created
+        self.child_order = np.argsort(parents[1:], kind='stable') + 1
+        self.child_bounds = np.searchsorted(parents[self.child_order], np.arange(size + 1))
+
+        codes = {_h: i for i, _h in enumerate(set(self.hops))}
+        self.code = np.fromiter(map(codes.__getitem__, self.hops), dtype=np.int64, count=size)
+
+        # the levels every hop is seen at, for the names
+        self.seen = np.zeros((max(int(levels.max()), 1), len(codes)), dtype=bool)
+        self.seen[self.level[1:], self.code[1:]] = True
+        return self
+
+    def children(self, nodes) -> np.ndarray:
+        return np.concatenate([self.child_order[self.child_bounds[n]: self.child_bounds[n + 1]]
+                               for n in nodes] or [np.zeros(0, dtype=np.int64)])
+
+    def routes_ending(self, nodes) -> list:
+        _routes = self.route[nodes]
+        return np.sort(_routes[_routes >= 0]).tolist()
+
+    def name(self, node: int) -> str:
+        """
+        an as seen at several levels is named asn, asn-1, asn-2 ... from its
+        first level on, so every level of the graph has its own node
+        """
+        rank = int(self.seen[:self.level[node], self.code[node]].sum())
+        return f'{self.hops[node]}-{rank}' if rank else self.hops[node]
+
+    def named_route(self, i: int) -> list:
+        node, names = self.ends[i], []
+        while node:
+            names.append(self.name(node))
+            node = self.parents[node]
+        return names[::-1]
+
+
+def _top_children(trie: HopTrie, nodes, need: int) -> dict:
+    """
+    children of the nodes grouped by hop, the `need` hops with the most
+    routes, ties to the hop seen first
+    :return: {hop code: [node]} in the order of the first route
+    """
+    children = trie.children(nodes)
+    if not len(children):
+        return {}
 
+    codes, inverse = np.unique(trie.code[children], return_inverse=True)
+    counts = np.bincount(inverse, weights=trie.count[children])
+    firsts = np.full(len(codes), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(firsts, inverse, trie.first[children])
 
-def get_paths(routes):
+    top = np.lexsort((firsts, -counts))[:need]
+    top = top[np.argsort(firsts[top])]
+    return {int(codes[k]): children[inverse == k].tolist() for k in top}
 
-    _routes = routes
 
-    tops, _ = get_top_hops(0, routes, need=10)
-    _tops = {}
+def get_paths(trie: HopTrie, first_top: int = 10, top: int = 7) -> (list, dict):
+    """
+    the routes through the `first_top` busiest first hops, then at every
+    level the busiest children of each kept hop, `top` for the busiest
+    hop of the level and fewer for the others; routes ending early are
+    kept at the end
+    :param trie: frozen
+    :return: routes with hops named by level, {name: dependency}
+    """
+    tops = _top_children(trie, [0], first_top)
 
-    idx = 1
     short_routes = []
     depend_map = {}
 
-    while idx < 4:
-
-        count_map, _depend_map = get_need_count(tops, top=7)
-        depend_map.update(_depend_map)
-        for v, _routes in tops.items():
-            _t, _r = get_top_hops(idx, _routes, count_map[v])
-            short_routes += _r
-            _tops.update(_t)
+    for idx in range(1, trie.depth):
+        sizes = {h: int(trie.count[nodes].sum()) for h, nodes in tops.items()}
+        max_count = max(sizes.values(), default=0)
 
-        idx += 1
-        tops = _tops
         _tops = {}
+        for h, nodes in tops.items():
+            need = max(int(top * sizes[h] / max_count), 1)
+            depend_map[trie.name(nodes[0])] = need * 1000
 
-    for v, _routes in tops.items():
-        depend_map[v] = len(_routes) * 1000
+            short_routes += trie.routes_ending(nodes)
 
-    _filter_routes = []
-    for _routes in tops.values():
-        _filter_routes += _routes
+            # a hop kept under several parents keeps the routes of the last one
+            _tops.update(_top_children(trie, nodes, need))
 
-    return _filter_routes + short_routes, depend_map
-
-
-async def cernet_paths():
-    _table = TableSelector.get_edu_as_path_table()
-
-    length = 4
-    routes = []
-    records = set()
-    _path_map = {}
-
-    async for cur in _table.find({}, {'path': 1}):
-        _path = [str(_c) for _c in cur['path'][:length]]
-
-        _record = []
-
-        if _path_to_str(_path_map, _path) in records:
-            continue
-
-        for v in _path:
-            _record.append(v)
-            records.add(_path_to_str(_path_map, _record))
-
-        routes.append(_path)
-
-    idx = 0
-    level_map = {}  # {asn: {v: 0, {0: asn, 1: asn-1, 2: asn-2}}
-
-    while idx < length:
-        c_map = {}
-
-        for route in routes:
-            if len(route) < idx + 1:
-                continue
-
-            if route[idx] not in level_map:
-                level_map[route[idx]] = (idx, 0)
-
-            else:
-                _i, _c = level_map[route[idx]]
-
-                if _i == idx:
-                    if _c != 0:
-                        route[idx] = f'{route[idx]}-{_c}'  # f'{route[idx]}-{_c}'
-                else:
-                    level_map[route[idx]] = (idx, _c + 1)
-                    route[idx] = f'{route[idx]}-{_c+1}'  # f'{route[idx]}-{_c+1}'
+        tops = _tops
 
-            if route[idx] not in c_map:
-                c_map[route[idx]] = 1
-            else:
-                c_map[route[idx]] += 1
+    _routes = []
+    for h, nodes in tops.items():
+        depend_map[trie.name(nodes[0])] = int(trie.count[nodes].sum()) * 1000
+        _routes += trie.routes_ending(nodes)
 
-        top_c = sorted(list(c_map.items()), key=lambda x: x[1], reverse=True)[:1]
-        idx += 1
-        logger.debug(f'^^^^idx={idx}, a={top_c[0]}')
+    routes = [trie.named_route(i) for i in _routes + short_routes]
+    return routes, depend_map
 
-    top_routes, point_map = get_paths(routes)
-    return top_routes, point_map
 
+def build_cernet_paths(paths, depth: int = None, first_top: int = None, top: int = None) -> (list, dict):
+    """
+    :param paths: as paths of vis_edu_as_path in the order they are stored
+    :param depth: hops kept of every path, Config.CERNET_PATH_DEPTH
+    :param first_top: first hops kept, Config.CERNET_PATH_FIRST_TOP
+    :param top: children kept of the busiest hop of a level, Config.CERNET_PATH_TOP
+    """
+    trie = HopTrie(depth=depth or Config.CERNET_PATH_DEPTH)
+    for path in paths:
+        trie.add(path)
+    trie.freeze()
 
-def _path_to_str(_path_map, _rp):
-    if not _rp:
-        return ''
+    logger.debug(f'built hop trie with routes={len(trie)}, depth={trie.depth}')
+    return get_paths(trie, first_top or Config.CERNET_PATH_FIRST_TOP, top or Config.CERNET_PATH_TOP)
 
-    _rp = tuple(_rp)
-    if _path_map and _rp in _path_map:
-        return _path_map[_rp]
 
-    _path_s = ','.join([str(_r) for _r in _rp])
-    _path_map[_rp] = _path_s
-    return _path_s
+async def cernet_paths():
+    # only for the results of imports made before they were precomputed
+    _table = TableSelector.get_edu_as_path_table()
+    return build_cernet_paths([cur['path'] async for cur in _table.find({}, {'path': 1})])
 
 
 def convert_hijack_event(e):
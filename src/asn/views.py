@@ -10,23 +10,19 @@ from .models import (
     ASHijackQuery,
     ASHijackSummaryQuery,
     ASPathSearchQuery,
-    ASTrendsQuery
+    ASPathSearchBatchBody,
+    ASTrendsQuery,
+    ASCernetSummaryQuery
 )
 from .services import (
-    strip_location_name,
     str_to_ases,
     get_ases_country,
-    get_cities_location,
-    cernet_paths,
-    _path_to_str,
+    HopTrie,
     convert_hijack_event,
     convert_as_item,
     convert_bandwidth_list
 )
-from database.models import (
-    TableSelector,
-    VisCache
-)
+from database.models import TableSelector
 from utils.request import (
     TimeRangeQuery,
     DateQuery,
@@ -34,13 +30,19 @@ from utils.request import (
 )
 from utils.misc import (
     extract_limit_offset_from_args,
-    subnet_range,
     to_list,
     Regions,
-    to_int,
-    to_str_list
+    to_int
+)
+from ip.index import get_asn_trends
+from .index import (
+    cernet_path_index,
+    cernet_path_results,
+    get_cernet_path_index,
+    get_cernet_rollup
 )
-from decorators import time_cost
+from .history import get_edu_history
+from config import Config
 
 router = APIRouter(prefix='/as')
 logger = logging.getLogger('asn.views')
@@ -70,119 +72,9 @@ async def cernet_history(args: EduHistoryQuery = Depends()):
     }
     """
 
-    _edu_as_table = TableSelector.get_edu_as_history_table()
-    _edu_as_city_table = TableSelector.get_edu_as_city_table()
-
-    ases = set()
-    locations = set()
-    bandwidth = 0
-
-    q = {'abroad': 0 if args.abroad == 0 else 1, 'date': {'$lte': args.date * 10000 + 9999}}
-
-    logger.debug(f'q={q}')
-
-    route_map = {}  # {(location, asn, name): bandwidth}
-    location_map = {}  # {city: (lng, lat)}
-    abroad_route_map = {}  # {(location, asn, name, bandwidth): count}
-    searched_locations = set()
-
-    async for cur in _edu_as_table.find(q):
-        bandwidth += cur['bandwidth']
-        searched_locations.add(cur['location'])
-
-        if args.abroad == 0:
-            _name = strip_location_name(cur['name'])
-            _key = cur['location'], cur['asn'], _name
-
-            if _key not in route_map:
-                route_map[_key] = 0
-
-            route_map[_key] += cur['bandwidth']
-
-        else:
-            _name = cur['name']
-            _key = cur['location'], cur['asn'], _name, cur['bandwidth']
-            _rkey = cur['location'], cur['asn'], _name, -cur['bandwidth']
-
-            if _key not in abroad_route_map:
-
-                if _rkey in abroad_route_map:
-                    abroad_route_map[_rkey] -= 1
-                    # logger.debug(f'rkey={_rkey} dow, abroad_route_map={abroad_route_map}, len={len(abroad_route_map)}')
-
-                    if abroad_route_map[_rkey] == 0:
-                        del abroad_route_map[_rkey]
-                        # logger.debug(f'delete={_rkey}, abroad_route_map={abroad_route_map}, len={len(abroad_route_map)}')
-                    continue
-                else:
-                    abroad_route_map[_key] = 0
-
-            abroad_route_map[_key] += 1
-            # logger.debug(f'abroad_route_map={abroad_route_map}, len={len(abroad_route_map)}')
-
-    if searched_locations:
-        location_map = await get_cities_location(searched_locations)
-
-    routes = []
-
-    def _get_location(_loc):
-        if _loc not in location_map:
-            # logger.warning(f"location of {_loc} missing")
-            _long, _lati = None, None
-        else:
-            _long, _lati = location_map[_loc]
-
-        return _long, _lati
-
-    if args.abroad == 0:
-
-        for (_location, _asn, _name), _bandwidth in route_map.items():
-            if _bandwidth <= 0:
-                continue
-
-            ases.add(_asn)
-            locations.add(_location)
-
-            _lng, _lat = _get_location(_location)
-            item = {
-                'bandwidth': _bandwidth,
-                'location': _location,
-                'asn': f"AS{_asn}",
-                'name': _name,
-                'lng': _lng,
-                'lat': _lat,
-            }
-            routes.append(item)
-
-    else:
-
-        for (_location, _asn, _name, _bandwidth), _count in abroad_route_map.items():
-            if _count < 1 or _bandwidth == 0:
-                continue
-
-            ases.add(_asn)
-            locations.add(_location)
-
-            _lng, _lat = _get_location(_location)
-
-            for i in range(_count):
-                item = {
-                    'bandwidth': _bandwidth,
-                    'location': _location,
-                    'asn': f"AS{_asn}",
-                    'name': _name,
-                    'lng': _lng,
-                    'lat': _lat,
-                }
-
-                routes.append(item)
-
-    data = {
-        'ases': len(ases),
-        'locations': len(locations),
-        'bandwidth': round(bandwidth, 3),
-        'routes': convert_bandwidth_list(routes)
-    }
+    # the nearest checkpoint stored by `cli.py cernet-history import` plus the rows after it
+    _history = await get_edu_history()
+    data = await _history.get(args.date, 0 if args.abroad == 0 else 1)
 
     return {'data': data, 'status': 'ok', 'message': ''}
 
@@ -296,29 +188,15 @@ async def hijack_detail(args: ASHijackDetailQuery = Depends()):
         'hops': []
     }
 
-    _path_map = {}
-
     def _merge_paths(_rpaths):
         if len(_rpaths) < 2:
             return _rpaths
 
-        _spath_map = set()
+        # longest first, a path inside one already kept is dropped
+        _trie = HopTrie()
         _rpaths = sorted(_rpaths, key=lambda x: len(x), reverse=True)
 
-        _merged_paths = []
-        for _rpath in _rpaths:
-            _record = []
-
-            if _path_to_str(_path_map, _rpath) in _spath_map:
-                continue
-
-            for _v in _rpath:
-                _record += [_v]
-                _spath_map.add(_path_to_str(_path_map, _record))
-
-            _merged_paths.append(_rpath)
-
-        return _merged_paths
+        return [_rpath for _rpath in _rpaths if _trie.add(_rpath)]
 
     normal_paths = []
     abnormal_paths = []
@@ -577,113 +455,71 @@ async def hijack_countries(args: TimeRangeQuery = Depends()):
     return {'data': data, 'total': _total, 'status': 'ok', 'message': ''}
 
 
-@router.get('/cernet/path/search')
-async def path_search(args: ASPathSearchQuery = Depends()):
-    prefix_start, prefix_end = subnet_range(args.prefix)
-
-    _table = TableSelector.get_edu_as_path_table()
+async def _as_index_init():
+    logger.debug('init as index ...')
+    await cernet_path_index.get()
+    logger.debug('finished init as index ...')
 
-    if None in [prefix_start, prefix_end]:
-        return {'data': [], 'message': 'invalid prefix', 'status': 'ok'}
 
-    _large_q = {'prefix_start': {'$lte': prefix_start},
-                'prefix_end': {'$gte': prefix_end}}
-
-    _small_q = {'prefix_start': {'$gte': prefix_start},
-                'prefix_end': {'$lte': prefix_end}}
-
-    @time_cost()
-    async def _large_search():
-        _matched = None
-        _searched = []
-        logger.debug(f'large_q={_large_q}')
-
-        async for _cur in _table.find(_large_q).sort('prefix_start', -1).limit(1):
-            _searched = to_str_list(_cur['path'])
-            _matched = _cur['prefix']
-
-        return _searched, _matched
-
-    @time_cost()
-    async def _small_search():
-        _matched = None
-        _searched = []
-        logger.debug(f'small_q={_small_q}')
-
-        async for _cur in _table.find(_small_q).sort('prefix_start', 1).limit(1):
-            _searched = to_str_list(_cur['path'])
-            _matched = _cur['prefix']
+@router.get('/cernet/path/search')
+async def path_search(args: ASPathSearchQuery = Depends()):
+    # the most specific prefix containing args.prefix, else the first one inside it
+    _index = await get_cernet_path_index()
+    item = _index.search_many([args.prefix])[0]
 
-        return _searched, _matched
+    if item['message']:
+        return {'data': [], 'message': item['message'], 'status': 'ok'}
 
-    searched, matched = await _large_search()
+    return {'data': item['data'], 'status': 'ok', 'message': '', 'matched': item['matched']}
 
-    if searched:
-        return {'data': searched, 'status': 'ok', 'message': '', 'matched': matched}
 
-    searched, matched = await _small_search()
+@router.post('/cernet/path/search/batch')
+async def path_search_batch(body: ASPathSearchBatchBody):
+    """
+    :param body: {"prefixes": ["1.2.0.0/16", "1.2.3.4/32"]}
+    :return: in the order of prefixes
+    {
+    "data": [{
+        "prefix": "1.2.0.0/16",
+        "data": ["4538", "23911"],  # as /cernet/path/search
+        "matched": "1.2.0.0/15",
+        "message": ""  # or invalid prefix
+    }],
+    "status": "ok",
+    "message": ""
+    }
+    """
+    if len(body.prefixes) > Config.CERNET_PATH_BATCH_MAX:
+        return {'data': [], 'status': 'ok',
+                'message': f'too many prefixes, at most {Config.CERNET_PATH_BATCH_MAX}'}
 
-    return {'data': searched, 'status': 'ok', 'message': '', 'matched': matched}
+    _index = await get_cernet_path_index()
+    return {'data': _index.search_many(body.prefixes), 'status': 'ok', 'message': ''}
 
 
 @router.get('/cernet/path')
 async def path(args: RefreshQuery = Depends()):
-    _key = 'as/cernet/path'
-
-    if not args.refresh:
-        cached = await VisCache.get_cache(_key)
-        if cached:
-            return cached
-
-    paths, point_map = await cernet_paths()
-    data = {'data': {'paths': paths, 'dependencies': point_map}, 'status': 'ok', 'message': ''}
-
-    await VisCache.add_cache(_key, data)
-    return data
+    # stored by `cli.py cernet-path import`, the collection is not scanned here
+    return await cernet_path_results.get()
 
 
 @router.get('/cernet/summary')
-async def cernet_summary(args: RefreshQuery = Depends()):
-    _key = 'as/cernet/summary'
-    if not args.refresh:
-        cached = await VisCache.get_cache(_key)
-        if cached:
-            return cached
-
-    _table = TableSelector.get_edu_as_path_table()
-    _hops_count_map = [set(), set(), set(), set()]
-    _dependencies_map = {}
-
-    length = 4
-    async for cur in _table.find({}, {'path': 1}):
-
-        for idx, v in enumerate(cur['path'][:length]):
-            _hops_count_map[idx].add(v)
-
-            if v not in _dependencies_map:
-                _dependencies_map[v] = 0
-
-            _dependencies_map[v] += 1
-
-    as_summary = []
-    for _hops in _hops_count_map:
-        as_summary.append(len(_hops))
-
-    _tops = sorted(_dependencies_map.items(), key=lambda x: x[1], reverse=True)[:5]
-    top_dependencies = []
-    for v, count in _tops:
-        item = {
-            'as': str(v),
-            'dependency': count
-        }
-        top_dependencies.append(item)
-
-    data = {'data': {'top_dependencies': top_dependencies,
-                     'as_summary': as_summary},
-            'status': 'ok', 'message': ''}
-
-    await VisCache.add_cache(_key, data)
-    return data
+async def cernet_summary(args: ASCernetSummaryQuery = Depends()):
+    """
+    :param args: refresh (kept for old clients, the rollup is current), top
+    :return:
+    {
+    "data": {
+        "top_dependencies": [{"as": "4538", "dependency": 1000}],  # top of them
+        "as_summary": [1, 20, 300, 4000]  # distinct ases at every hop
+    },
+    "status": "ok",
+    "message": ""
+    }
+    """
+    # counted by `cli.py cernet-path import`, the collection is not scanned here
+    _rollup = await get_cernet_rollup()
+    return _rollup.summary(args.top)
 
 
 @router.get('/trends')
@@ -692,79 +528,11 @@ async def trends(args: ASTrendsQuery = Depends()):
     if not cc:
         return {'data': {}, 'message': '', 'status': 'ok'}
 
-    q = {'cc': {'$in': cc}}
-    logger.debug(f'q={q}')
-
-    _table = TableSelector.get_asn_alloc_table()
-    cc_map = {}
-
-    async for cur in _table.find(q, {'count': 1, 'cc': 1, 'date': 1}):
-        if cur['cc'] not in cc_map:
-            cc_map[cur['cc']] = []
-
-        item = {
-            'date': int(cur['date'] / 10000),
-            'count': cur['count'],
-        }
-
-        cc_map[cur['cc']].append(item)
-
-    trend_map = {}
-
-    for cc, trend in cc_map.items():
-        if not trend:
-            continue
-
-        _trend = []
-        trend = sorted(trend, key=lambda x: x['date'])
-        prev = None
-
-        addup = 0
-        for item in trend:
-            addup += item['count']
-
-            if item['date'] == 0:
-                #logger.warning(f"got zero date of cc, cur={item}")
-                continue
+    _trends = await get_asn_trends()
 
-            if item['date'] == prev and _trend:
-                _trend[-1]['count'] = addup
-
-            else:
-                _trend.append({'date': item['date'], 'count': addup})
-
-            prev = item['date']
-
-        logger.debug(f'first={trend[0]}, last={trend[-1]},'
-                     f'trend={len(trend)}, new-trend={len(_trend)}, '
-                     f'first-new-trend={_trend[0]}, last-new-trend={_trend[-1]}')
-
-        if _trend:
-            trend_map[cc] = _trend
-
-    pipe = [
-        {'$group': {'_id': {'$toInt': {'$divide': ['$date', 10000]}},
-                    'count': {'$sum': '$count'}}},
-        {'$sort': {'_id': 1}}
-    ]
-    _totals = []
-    logger.debug(f'pipe={pipe}')
-
-    y_addup = 0
-    async for cur in _table.aggregate(pipe):
-        y_addup += cur['count']
-
-        if cur['_id'] == 0:
-            logger.warning(f"got zero date cur={cur}")
-            continue
-
-        item = {
-            'date': cur['_id'],
-            'count': y_addup
-        }
-        _totals.append(item)
+    trend_map = _trends.get_many(cc, skip_zero=True)
+    trend_map['total'] = _trends.get(_trends.TOTAL, skip_zero=True)
 
-    trend_map['total'] = _totals
     return {'data': trend_map, 'status': 'ok', 'message': ''}
 
 
@@ -4,6 +4,7 @@ import logging
 import time
 import json
 import requests
+from pymongo.errors import BulkWriteError
 
 from database.services import _bulk_load
 from utils.misc import (
@@ -21,10 +22,35 @@ from ip.models import (
     VisASAlloc,
     VisIPNetflow,
     VisIPv4Picture,
-    VisIPv6Picture
+    VisIPv6Picture,
+    NETFLOW_BUCKETS
 )
+from ip.models import IPv4_RANGE, IPv6_RANGE
 from ip.services import _get_diff_date
-from database.models import TableSelector
+from ip.index import ALLOC_VERSION, load_alloc_dataset_sync
+from ip.space import IPv4Bitmap, IPv6Space
+from ip.snapshot import SpaceSnapshots
+from ip.netflow import NetflowRollup
+from asn.index import (
+    CERNET_PATH_VERSION,
+    store_cernet_paths,
+    store_cernet_rollup,
+    drop_cernet_rollups
+)
+from asn.bench import bench_cernet_paths
+from asn.history import (
+    EDU_HISTORY_VERSION,
+    store_history_checkpoints,
+    drop_history_checkpoints
+)
+from ip.picture import (
+    update_picture_bloom,
+    stale_picture_bloom,
+    rollup_ops,
+    rebuild_probe_rollup,
+    seed_probe_rollup
+)
+from database.models import TableSelector, VisVersion
 from asn.models import (
     VisEduASHistory,
     VisEduASCityLocation,
@@ -33,7 +59,7 @@ from asn.models import (
     VisEduASPath,
     VisASHijackSimpleEvent
 )
-from asn.services import load_all_ases_country
+from asn.services import load_all_ases_country, build_cernet_paths
 from config import Config
 
 
@@ -148,11 +174,77 @@ def load_ip_alloc(file_dir, worker):
 
             _load_alloc_file(_file_path)
 
+    version = VisVersion.bump_version(ALLOC_VERSION)
+    logger.info(f'bumped {ALLOC_VERSION} to version={version}')
+
+    # the servers map the bitmap of the new version instead of building it,
+    # they build it themselves when it is missing
+    try:
+        IPv4Bitmap.load_or_build(load_alloc_dataset_sync('4', version))
+    except Exception as e:
+        logger.error(f'failed to build {IPv4Bitmap.NAME} for version={version}, err={e}')
+
     elapsed = time.time() - tick
     print(f'finished loading with elapsed={elapsed}, check log file'
           f' {Config.LOG_PATH} for more information')
 
 
+@endpoint.group(name='space')
+def space():
+    pass
+
+
+def _iter_space_snapshots(version, countries, batch):
+    _v4 = load_alloc_dataset_sync('4', version)
+    _v6 = load_alloc_dataset_sync('6', version)
+
+    _bitmap = IPv4Bitmap.load_or_build(_v4)
+    _space = IPv6Space(_v6)
+
+    # the /16 counters of the bitmap grow with the countries, go by batch
+    _batches = [countries[i: i + batch] for i in range(0, len(countries), batch)]
+
+    for _date in IPv4_RANGE:
+        cc_map = {}
+        for _ccs in _batches:
+            cc_map.update(_bitmap.cc_map(_date, _ccs))
+
+        yield SpaceSnapshots.snapshot_key('4', _date), cc_map
+
+    for _tight in [0, 1]:
+        for _date in IPv6_RANGE:
+            yield SpaceSnapshots.snapshot_key('6', _date, _tight), \
+                _space.cc_map(_date, countries, _tight)
+
+
+@space.command('dump')
+@click.option('--countries', '-c', type=str, help='comma separated, all countries by default')
+@click.option('--output', '-o', type=click.Path(), help='defaults to INDEX_DIR/space-snapshots.bin')
+@click.option('--batch', '-b', type=int, default=32)
+def dump_space(countries, output, batch):
+    print('going to dump space snapshots ...')
+    tick = time.time()
+
+    version = VisVersion.get_version_sync(ALLOC_VERSION)
+
+    if countries:
+        countries = sorted(set(countries.upper().split(',')))
+    else:
+        _tables = [TableSelector.get_prefix_alloc_table(v, name='default_sync') for v in [4, 6]]
+        countries = sorted(cc for cc in set(_tables[0].distinct('cc')) |
+                           set(_tables[1].distinct('cc')) if cc)
+
+    output = output or os.path.join(Config.INDEX_DIR, SpaceSnapshots.NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    rows = SpaceSnapshots.write(output, {'4': version, '6': version}, countries,
+                                _iter_space_snapshots(version, countries, batch))
+
+    elapsed = time.time() - tick
+    logger.info(f'dumped space snapshots rows={rows}, version={version}, file={output}')
+    print(f'finished dumping {rows} rows to {output} with elapsed={elapsed}')
+
+
 def curl_file(url, save_dir):
     url = url.strip('\n')
     # s = 'curl %s --output %s/%s' % (url, save_dir, os.path.basename(url))
@@ -200,15 +292,14 @@ def edu():
 
 
 def _load_edu_history_file(_file):
-    # todo need remove all data when insert
     logger.info(f'loading {_file} ...')
     step = 50
-    _edu_table = TableSelector.get_edu_as_history_table()
-
-    logger.info('going to delete old data ...')
-    _edu_table.delete_many({})
+    _edu_table = TableSelector.get_edu_as_history_table(name='default_sync')
 
+    # a file replaces the rows of its kind, domestic or abroad
     abroad = 'abroad' in os.path.basename(_file)
+    logger.info(f'going to delete old data of abroad={int(abroad)} ...')
+    _edu_table.delete_many({'abroad': int(abroad)})
     ops = []
     idx = 0
 
@@ -280,6 +371,18 @@ def load_edu_history(file_dir):
 
         _load_edu_history_file(_file_path)
 
+    # month end checkpoints of the next version, the servers drop their
+    # memoized results once it is bumped
+    version = VisVersion.get_version_sync(EDU_HISTORY_VERSION) + 1
+    for abroad in (0, 1):
+        store_history_checkpoints(version, abroad)
+
+    bumped = VisVersion.bump_version(EDU_HISTORY_VERSION)
+    if bumped != version:
+        logger.warning(f'{EDU_HISTORY_VERSION} moved to={bumped} while storing={version}')
+    logger.info(f'bumped {EDU_HISTORY_VERSION} to version={bumped}')
+    drop_history_checkpoints(version)
+
     elapsed = time.time() - tick
     print(f'finished loading with elapsed={elapsed}, check log file'
           f' {Config.LOG_PATH} for more information')
@@ -316,7 +419,7 @@ def as_path():
 
 
 def _load_as_path_file(_file, clean_file=False):
-    _table = TableSelector.get_edu_as_path_table()
+    _table = TableSelector.get_edu_as_path_table(name='default_sync')
     _load_file_batch(_file, VisEduASPath.to_op, _table, clean_file=clean_file)
 
 
@@ -334,11 +437,41 @@ def load_as_path(path, worker):
     else:
         _load_as_path_file(path)
 
+    # /as/cernet/path and the rollup of /as/cernet/summary are computed from
+    # one read of the collection here, stored before the version is bumped,
+    # then the servers swap in the new results and search index
+    version = VisVersion.get_version_sync(CERNET_PATH_VERSION) + 1
+    _table = TableSelector.get_edu_as_path_table(name='default_sync')
+    paths = [cur['path'] for cur in _table.find({}, {'path': 1})]
+
+    store_cernet_paths(version, *build_cernet_paths(paths))
+    store_cernet_rollup(version, paths)
+
+    bumped = VisVersion.bump_version(CERNET_PATH_VERSION)
+    if bumped != version:
+        logger.warning(f'{CERNET_PATH_VERSION} moved to={bumped} while storing={version}')
+    logger.info(f'bumped {CERNET_PATH_VERSION} to version={bumped}')
+    drop_cernet_rollups(version)
+
     elapsed = time.time() - tick
     print(f'finished loading with elapsed={elapsed}, check log file'
           f' {Config.LOG_PATH} for more information')
 
 
+@as_path.command('bench')
+@click.option('--routes', '-n', type=int, default=1000000, help='synthetic as paths')
+@click.option('--depth', type=int, default=4)
+@click.option('--first-top', type=int, default=10)
+@click.option('--top', type=int, default=7)
+@click.option('--seed', type=int, default=1)
+@click.option('--no-legacy', is_flag=True, help='skip the implementation before the hop trie')
+def bench_as_path(routes, depth, first_top, top, seed, no_legacy):
+    # /as/cernet/path on synthetic routes, nothing is read from or written to mongo
+    result = bench_cernet_paths(routes, depth, first_top, top, seed, legacy=not no_legacy)
+    for k, v in result.items():
+        print(f'{k}: {v}')
+
+
 @endpoint.group(name='city-location')
 def city():
     pass
@@ -463,9 +596,12 @@ def load_cernet_path_result(path):
             print('no object found')
             return
 
-        _table = TableSelector.get_as_cache_table()
-        data = {'data': obj, 'status': 'ok', 'message': ''}
-        _table.update_one({'key': 'as/cernet/path'}, {'$set': data}, upsert=True)
+        # served as the result of the next version, as an import would
+        version = VisVersion.get_version_sync(CERNET_PATH_VERSION) + 1
+        store_cernet_paths(version, obj.get('paths', []), obj.get('dependencies', {}))
+        store_cernet_rollup(version)
+        VisVersion.bump_version(CERNET_PATH_VERSION)
+        drop_cernet_rollups(version)
 
 
 @endpoint.group(name='netflow')
@@ -475,9 +611,13 @@ def netflow():
 
 def _load_netflow_file(_files, _dir):
     logger.debug(f'going to load netflow files with num={len(_files)}, dir={_dir}, pid={os.getpid()}')
+    tick = time.time()
 
-    _table = TableSelector.get_ip_netflow_table()
+    _table = TableSelector.get_ip_netflow_table(name='default_sync')
+    _rollup_table = TableSelector.get_ip_netflow_rollup_table(name='default_sync')
+    rollup = NetflowRollup()
     ops = []
+    rows = 0
     step = 200
 
     for _file in _files:
@@ -485,34 +625,73 @@ def _load_netflow_file(_files, _dir):
             logger.debug(f'file is not csv, will not load, file={_file}')
             continue
 
-        idx = 0
-        _path = os.path.join(_dir, _file)
-
-        with open(_path) as fd:
-            items = []
-            for line in fd:
-                idx += 1
-                if idx < 2:
-                    continue
-
-                items.append(VisIPNetflow.to_item(line))
-
-            ops += VisIPNetflow.to_ops(_file[:-4], items)
+        # one file per ip, parsed and averaged per timestamp by numpy
+        objs = VisIPNetflow.read_csv(os.path.join(_dir, _file))
+        rollup.add(_file[:-4], objs)
+        ops += VisIPNetflow.objs_to_ops(_file[:-4], objs)
+        rows += len(objs)
 
         if len(ops) >= step:
             _bulk_load(_table, ops)
             ops = []
 
+        if len(rollup) >= Config.NETFLOW_ROLLUP_FLUSH:
+            rollup.flush(_rollup_table)
+
     if ops:
         _bulk_load(_table, ops)
 
-    logger.debug(f'finish loading netflow files with num={len(_files)}, dir={_dir}, pid={os.getpid()}')
+    rollup.flush(_rollup_table)
+
+    elapsed = time.time() - tick
+    logger.info(f'finish loading netflow files with num={len(_files)}, samples={rows}, '
+                f'rows/sec={rows / max(elapsed, 1e-6):.0f}, pid={os.getpid()}')
+    return rows
+
+
+def _load_netflow_bucket_file(_files, _dir, seconds):
+    logger.debug(f'going to load netflow buckets with num={len(_files)}, dir={_dir}, '
+                 f'seconds={seconds}, pid={os.getpid()}')
+    tick = time.time()
+
+    _table = TableSelector.get_ip_netflow_bucket_table(name='default_sync')
+    _rollup_table = TableSelector.get_ip_netflow_rollup_table(name='default_sync')
+    rollup = NetflowRollup()
+    rows = 0
+
+    for _file in _files:
+        if not _file.endswith('.csv'):
+            logger.debug(f'file is not csv, will not load, file={_file}')
+            continue
+
+        objs = VisIPNetflow.read_csv(os.path.join(_dir, _file))
+        rows += len(objs)
+
+        ip = _file[:-4]
+        existing = {_d['bucket']: _d for _d in _table.find({'ip': ip, 'seconds': seconds})}
+
+        _bulk_load(_table, VisIPNetflow.to_bucket_ops(ip, objs, seconds, existing))
+
+        rollup.add(ip, objs)
+        if len(rollup) >= Config.NETFLOW_ROLLUP_FLUSH:
+            rollup.flush(_rollup_table)
+
+    rollup.flush(_rollup_table)
+
+    elapsed = time.time() - tick
+    logger.info(f'finish loading netflow buckets with num={len(_files)}, samples={rows}, '
+                f'rows/sec={rows / max(elapsed, 1e-6):.0f}, pid={os.getpid()}')
+    return rows
 
 
 @netflow.command('import')
 @click.option('--file-dir', '-d', type=click.Path(exists=True))
 @click.option('--worker', '-w', type=int)
-def load_netflow_file(file_dir, worker):
+@click.option('--layout', type=click.Choice(['sample', 'bucket']),
+              help='defaults to NETFLOW_LAYOUT, /ip/netflow reads the same one')
+@click.option('--bucket', type=click.Choice(list(NETFLOW_BUCKETS)),
+              help='defaults to NETFLOW_BUCKET, /ip/netflow reads the same one')
+def load_netflow_file(file_dir, worker, layout, bucket):
     print(f"going to load netflow file from {file_dir}")
 
     _files = os.listdir(file_dir)
@@ -520,10 +699,33 @@ def load_netflow_file(file_dir, worker):
     if not _files:
         return
 
+    layout = layout or Config.NETFLOW_LAYOUT
+    bucket = bucket or Config.NETFLOW_BUCKET
+
+    # /ip/netflow/top and /ip/netflow/anomaly read one document per window
+    _rollup_table = TableSelector.get_ip_netflow_rollup_table(name='default_sync')
+    _rollup_table.create_index([('seconds', 1), ('window', 1)], unique=True)
+
+    if layout == 'bucket':
+        # range reads of /ip/netflow go by (ip, seconds, bucket), an ip may
+        # be stored in both hour and day buckets
+        _table = TableSelector.get_ip_netflow_bucket_table(name='default_sync')
+        _table.create_index([('ip', 1), ('seconds', 1), ('bucket', 1)])
+        _load_fn, _extra = _load_netflow_bucket_file, (NETFLOW_BUCKETS[bucket],)
+
+    else:
+        # range reads of /ip/netflow go by (ip, timestamp)
+        _table = TableSelector.get_ip_netflow_table(name='default_sync')
+        _table.create_index([('ip', 1), ('timestamp', 1)])
+        _load_fn, _extra = _load_netflow_file, ()
+
     n = len(_files)
 
+    tick = time.time()
+
     if worker <= 1:
-        _load_netflow_file(_files, file_dir)
+        rows = _load_fn(_files, file_dir, *_extra)
+        print(f'loaded {rows} samples, rows/sec={rows / max(time.time() - tick, 1e-6):.0f}')
 
     else:
         if n > worker:
@@ -533,9 +735,63 @@ def load_netflow_file(file_dir, worker):
 
         args = []
         for _fs in iter_slice(_files, step):
-            args.append((_fs, file_dir))
+            args.append((_fs, file_dir) + _extra)
+
+        multiprocess_fn(_load_fn, args)
+        print(f'loaded with elapsed={time.time() - tick}, rows/sec of every worker'
+              f' in {Config.LOG_PATH}')
+
+
+@netflow.command('rollup')
+@click.option('--layout', type=click.Choice(['sample', 'bucket']),
+              help='the layout to read the samples from, defaults to NETFLOW_LAYOUT')
+def rebuild_netflow_rollup(layout):
+    """
+    rebuild vis_ip_netflow_rollup from the stored samples, after a change
+    of NETFLOW_WINDOW/NETFLOW_TOP_KEEP or for samples imported before it
+    """
+    layout = layout or Config.NETFLOW_LAYOUT
+    tick = time.time()
+
+    _rollup_table = TableSelector.get_ip_netflow_rollup_table(name='default_sync')
+    _rollup_table.create_index([('seconds', 1), ('window', 1)], unique=True)
+    _rollup_table.delete_many({'seconds': Config.NETFLOW_WINDOW})
+
+    if layout == 'bucket':
+        _table = TableSelector.get_ip_netflow_bucket_table(name='default_sync')
+        _seconds = NETFLOW_BUCKETS[Config.NETFLOW_BUCKET]
+        _cursor = _table.find({'seconds': _seconds}, {'_id': 0}).sort([('ip', 1), ('bucket', 1)])
+        _samples = ((_cur['ip'], VisIPNetflow.unpack_bucket(_cur)) for _cur in _cursor)
+
+    else:
+        _table = TableSelector.get_ip_netflow_table(name='default_sync')
+        _cursor = _table.find({}, {'_id': 0, 'n': 0}).sort([('ip', 1), ('timestamp', 1)])
+        _samples = ((_cur.pop('ip'), [_cur]) for _cur in _cursor)
+
+    rollup = NetflowRollup()
+    ip, objs = None, []
+    ips = 0
 
-        multiprocess_fn(_load_netflow_file, args)
+    # both cursors are ordered by ip, the samples of an ip are added at once
+    for _ip, _objs in _samples:
+        if _ip != ip:
+            if objs:
+                rollup.add(ip, objs)
+                ips += 1
+            ip, objs = _ip, []
+
+            if len(rollup) >= Config.NETFLOW_ROLLUP_FLUSH:
+                rollup.flush(_rollup_table)
+
+        objs += _objs
+
+    if objs:
+        rollup.add(ip, objs)
+        ips += 1
+
+    rollup.flush(_rollup_table)
+    print(f'rolled up {ips} ips into windows of {Config.NETFLOW_WINDOW}s, '
+          f'elapsed={time.time() - tick:.3f}')
 
 
 @endpoint.group(name='ip-alloc-map')
@@ -588,29 +844,89 @@ def write_ipv4_space(host, port, protocol):
         requests.get(url)
 
 
+def _write_pictures(v, objs):
+    # new ips are counted into the rollup, re-imported ones already are
+    _cls = VisIPv4Picture if v == 4 else VisIPv6Picture
+    _table = TableSelector.get_ip_picture(v, name='default_sync')
+
+    try:
+        upserted = list(_table.bulk_write([_cls.to_mongo(dict(_o)) for _o in objs],
+                                          ordered=False).upserted_ids)
+
+    except BulkWriteError as e:
+        logger.error(f'failed to write pictures with len={len(objs)}, err: {e}')
+        upserted = [_u['index'] for _u in e.details.get('upserted', [])]
+
+    keys = [(objs[i]['cc'], objs[i].get('carrier')) for i in upserted]
+    if keys:
+        _rollup = TableSelector.get_probe_rollup_table(name='default_sync')
+        _rollup.bulk_write(rollup_ops(v, keys), ordered=False)
+
+
+def _load_picture_file(v, _file, clean_file=False, step=300):
+    logger.info(f'going to load {_file} ...')
+
+    _cls = VisIPv4Picture if v == 4 else VisIPv6Picture
+    objs = []
+
+    with open(_file, 'r') as fd:
+        for line in fd:
+            if not line.strip():
+                continue
+
+            objs.append(_cls.to_obj(_cls.to_item(line)))
+
+            if len(objs) >= step:
+                _write_pictures(v, objs)
+                objs = []
+
+    if objs:
+        _write_pictures(v, objs)
+
+    if clean_file:
+        cmd(['rm', '-rf', _file])
+
+    logger.info(f'finished loading {_file}')
+
+
 @endpoint.group(name='ipv4-picture')
 def ipv4_picture():
     pass
 
 
 def _load_ipv4_picture_file(_file, clean_file=False):
-    _table = TableSelector.get_ip_picture(4)
-    _load_file_batch(_file, VisIPv4Picture.to_op, _table, clean_file=clean_file)
+    _load_picture_file(4, _file, clean_file=clean_file)
 
 
 @ipv4_picture.command('import')
 @click.option('--path', '-p', type=click.Path(exists=True))
 @click.option('--worker', '-w', type=int)
-def load_ipv4_picture(path, worker):
+@click.option('--fp-rate', type=float, help='bloom filter false positive rate')
+def load_ipv4_picture(path, worker, fp_rate):
     print(f'going to load ipv4 picture file ...')
     tick = time.time()
 
-    if worker > 1:
-        _files = split_file(path, worker)
-        args = [(_a, True) for _a in _files]
-        multiprocess_fn(_load_ipv4_picture_file, args)
-    else:
-        _load_ipv4_picture_file(path)
+    # new ips are added to the rollup, the ones stored before it are counted first
+    seed_probe_rollup(4)
+
+    # the servers go to mongo until the filter of the new pictures is
+    # saved, also when the import fails halfway
+    _wait = stale_picture_bloom(4)
+    if _wait:
+        print(f'waiting {_wait}s for the servers to drop the ipv4 picture bloom ...')
+        time.sleep(_wait)
+
+    try:
+        if worker > 1:
+            _files = split_file(path, worker)
+            args = [(_a, True) for _a in _files]
+            multiprocess_fn(_load_ipv4_picture_file, args)
+        else:
+            _load_ipv4_picture_file(path)
+
+    finally:
+        version = update_picture_bloom(4, fp_rate)
+        logger.info(f'saved ipv4 picture bloom with version={version}')
 
     elapsed = time.time() - tick
     print(f'finished loading with elapsed={elapsed}, check log file'
@@ -623,28 +939,58 @@ def ipv6_picture():
 
 
 def _load_ipv6_picture_file(_file, clean_file=False):
-    _table = TableSelector.get_ip_picture(6)
-    _load_file_batch(_file, VisIPv6Picture.to_op, _table, clean_file=clean_file)
+    _load_picture_file(6, _file, clean_file=clean_file)
 
 
 @ipv6_picture.command('import')
 @click.option('--path', '-p', type=click.Path(exists=True))
 @click.option('--worker', '-w', type=int)
-def load_ipv6_picture(path, worker):
+@click.option('--fp-rate', type=float, help='bloom filter false positive rate')
+def load_ipv6_picture(path, worker, fp_rate):
     print(f'going to load ipv6 picture file ...')
     tick = time.time()
 
-    if worker > 1:
-        _files = split_file(path, worker)
-        args = [(_a, True) for _a in _files]
-        multiprocess_fn(_load_ipv6_picture_file, args)
-    else:
-        _load_ipv6_picture_file(path)
+    # new ips are added to the rollup, the ones stored before it are counted first
+    seed_probe_rollup(6)
+
+    # the servers go to mongo until the filter of the new pictures is
+    # saved, also when the import fails halfway
+    _wait = stale_picture_bloom(6)
+    if _wait:
+        print(f'waiting {_wait}s for the servers to drop the ipv6 picture bloom ...')
+        time.sleep(_wait)
+
+    try:
+        if worker > 1:
+            _files = split_file(path, worker)
+            args = [(_a, True) for _a in _files]
+            multiprocess_fn(_load_ipv6_picture_file, args)
+        else:
+            _load_ipv6_picture_file(path)
+
+    finally:
+        version = update_picture_bloom(6, fp_rate)
+        logger.info(f'saved ipv6 picture bloom with version={version}')
 
     elapsed = time.time() - tick
     print(f'finished loading with elapsed={elapsed}, check log file'
           f' {Config.LOG_PATH} for more information')
 
 
+@endpoint.group(name='probe-rollup')
+def probe_rollup():
+    pass
+
+
+@probe_rollup.command('rebuild')
+@click.option('--v', '-v', type=click.Choice(['4', '6']), multiple=True)
+def rebuild_rollup(v):
+    # recounts from the pictures, e.g. after ips changed country on re-import
+    for _v in v or ['4', '6']:
+        rows = rebuild_probe_rollup(_v)
+        update_picture_bloom(int(_v))
+        print(f'rebuilt ipv{_v} probe rollup with rows={rows}')
+
+
 if __name__ == '__main__':
     endpoint()
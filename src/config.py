@@ -40,6 +40,35 @@ class Settings(BaseSettings):
     IPv4_ALLOC_END: int = 20230710
     IPv6_ALLOC_END: int = 20230710
 
+    VERSION_CHECK_INTERVAL: int = 60  # seconds between dataset version checks
+    INDEX_DIR: str = '../data'  # index files shared by the workers
+
+    SPACE_RESPONSE_CACHE_BYTES: int = 256 * 1024 * 1024
+    SPACE_RESPONSE_GZIP: bool = True
+    SPACE_WARMUP_CONCURRENCY: int = 4
+    SPACE_WARMUP_COUNTRIES: str = 'US,CN,JP,DE,GB,KR,BR,FR,CA,IT'
+
+    IP_LOOKUP_BATCH_MAX: int = 100000  # ips per /ip/lookup/batch request
+    CERNET_PATH_BATCH_MAX: int = 10000  # prefixes per /as/cernet/path/search/batch request
+    CERNET_PATH_DEPTH: int = 4  # hops of every route of /as/cernet/path
+    CERNET_PATH_FIRST_TOP: int = 10  # first hops kept by /as/cernet/path
+    CERNET_PATH_TOP: int = 7  # children kept of the busiest hop of every level
+    CERNET_SUMMARY_TOP_MAX: int = 100  # largest top of /as/cernet/summary
+    EDU_HISTORY_MEMO: int = 256  # /as/cernet/history results kept per worker
+    PROBE_BATCH_MAX: int = 10000  # ips per /ip/probe/picture/batch request
+    PROBE_BATCH_CHUNK: int = 1000  # ips per $in query
+    PROBE_BLOOM_FP_RATE: float = 0.01  # of the never probed ips reaching mongo
+    ENRICH_DIR: str = '../data/enrich'  # uploads and results of /ip/enrich jobs
+    ENRICH_CHUNK: int = 50000  # ips per chunk of an enrich job
+    ENRICH_MAX_BYTES: int = 1024 * 1024 * 1024  # of an /ip/enrich upload
+    ENRICH_KEEP_SECONDS: int = 7 * 86400  # before a job and its files are dropped
+    NETFLOW_MAX_POINTS: int = 1000  # /ip/netflow samples before downsampling
+    NETFLOW_LAYOUT: str = 'sample'  # sample - a document per sample, bucket - per ip per hour/day
+    NETFLOW_BUCKET: str = 'day'  # hour or day, the buckets of the bucket layout /ip/netflow reads
+    NETFLOW_WINDOW: int = 3600  # seconds per window of /ip/netflow/top and /ip/netflow/anomaly
+    NETFLOW_TOP_KEEP: int = 100  # ips kept per window and metric, the largest n of /ip/netflow/top
+    NETFLOW_ROLLUP_FLUSH: int = 1000  # ips an import worker rolls up before writing
+
     LOG_LEVEL: int = logging.DEBUG
     LOG_STDOUT: bool = False
     LOG_SYSLOG_ENDPOINT: Optional[tuple[str, int, int]] = None  # ip, port, msg_size
@@ -109,6 +138,35 @@ class DevSettings(BaseSettings):
     IPv4_ALLOC_END: int = 20230710
     IPv6_ALLOC_END: int = 20230710
 
+    VERSION_CHECK_INTERVAL: int = 60  # seconds between dataset version checks
+    INDEX_DIR: str = '../data'  # index files shared by the workers
+
+    SPACE_RESPONSE_CACHE_BYTES: int = 256 * 1024 * 1024
+    SPACE_RESPONSE_GZIP: bool = True
+    SPACE_WARMUP_CONCURRENCY: int = 4
+    SPACE_WARMUP_COUNTRIES: str = 'US,CN,JP,DE,GB,KR,BR,FR,CA,IT'
+
+    IP_LOOKUP_BATCH_MAX: int = 100000  # ips per /ip/lookup/batch request
+    CERNET_PATH_BATCH_MAX: int = 10000  # prefixes per /as/cernet/path/search/batch request
+    CERNET_PATH_DEPTH: int = 4  # hops of every route of /as/cernet/path
+    CERNET_PATH_FIRST_TOP: int = 10  # first hops kept by /as/cernet/path
+    CERNET_PATH_TOP: int = 7  # children kept of the busiest hop of every level
+    CERNET_SUMMARY_TOP_MAX: int = 100  # largest top of /as/cernet/summary
+    EDU_HISTORY_MEMO: int = 256  # /as/cernet/history results kept per worker
+    PROBE_BATCH_MAX: int = 10000  # ips per /ip/probe/picture/batch request
+    PROBE_BATCH_CHUNK: int = 1000  # ips per $in query
+    PROBE_BLOOM_FP_RATE: float = 0.01  # of the never probed ips reaching mongo
+    ENRICH_DIR: str = '../data/enrich'  # uploads and results of /ip/enrich jobs
+    ENRICH_CHUNK: int = 50000  # ips per chunk of an enrich job
+    ENRICH_MAX_BYTES: int = 1024 * 1024 * 1024  # of an /ip/enrich upload
+    ENRICH_KEEP_SECONDS: int = 7 * 86400  # before a job and its files are dropped
+    NETFLOW_MAX_POINTS: int = 1000  # /ip/netflow samples before downsampling
+    NETFLOW_LAYOUT: str = 'sample'  # sample - a document per sample, bucket - per ip per hour/day
+    NETFLOW_BUCKET: str = 'day'  # hour or day, the buckets of the bucket layout /ip/netflow reads
+    NETFLOW_WINDOW: int = 3600  # seconds per window of /ip/netflow/top and /ip/netflow/anomaly
+    NETFLOW_TOP_KEEP: int = 100  # ips kept per window and metric, the largest n of /ip/netflow/top
+    NETFLOW_ROLLUP_FLUSH: int = 1000  # ips an import worker rolls up before writing
+
     LOG_LEVEL: int = logging.DEBUG
     LOG_STDOUT: bool = False
     LOG_SYSLOG_ENDPOINT: Optional[tuple[str, int, int]] = None  # ip, port, msg_size
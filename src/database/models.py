@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from typing import Any
+from pymongo import ReturnDocument
 from extensions import mongo, cache
 
 
@@ -39,6 +40,10 @@ class TableSelector:
         db = getattr(cls.Meta.db_driver, name)
         return db.vis.vis_edu_as_history
 
+    @classmethod
+    def get_edu_as_history_checkpoint_table(cls, name='default'):
+        return cls.get_conn(name).vis.vis_edu_as_history_checkpoint
+
     @classmethod
     def get_edu_as_city_table(cls, name='default'):
         db = getattr(cls.Meta.db_driver, name)
@@ -59,6 +64,10 @@ class TableSelector:
         db = getattr(cls.Meta.db_driver, name)
         return db.vis.vis_edu_as_path
 
+    @classmethod
+    def get_edu_as_path_rollup_table(cls, name='default'):
+        return cls.get_conn(name).vis.vis_edu_as_path_rollup
+
     @classmethod
     def get_as_simple_hijack_table(cls, name='default'):
         db = getattr(cls.Meta.db_driver, name)
@@ -74,6 +83,15 @@ class TableSelector:
         db = getattr(cls.Meta.db_driver, name)
         return db.vis.vis_ip_netflow
 
+    @classmethod
+    def get_ip_netflow_bucket_table(cls, name='default'):
+        db = getattr(cls.Meta.db_driver, name)
+        return db.vis.vis_ip_netflow_bucket
+
+    @classmethod
+    def get_ip_netflow_rollup_table(cls, name='default'):
+        return cls.get_conn(name).vis.vis_ip_netflow_rollup
+
     @classmethod
     def get_ip_map_table(cls, name='default'):
         return cls.get_conn(name).vis.vis_ip_map
@@ -97,6 +115,14 @@ class TableSelector:
         conn = cls.get_conn(name)
         return conn.vis.vis_ip_trend
 
+    @classmethod
+    def get_version_table(cls, name='default'):
+        return cls.get_conn(name).vis.vis_version
+
+    @classmethod
+    def get_probe_rollup_table(cls, name='default'):
+        return cls.get_conn(name).vis.vis_probe_rollup
+
 
 class CacheSelector:
     class Meta:
@@ -122,3 +148,33 @@ class VisCache(BaseModel):
     async def add_cache(cls, key: str, val: Any):
         _table = TableSelector.get_as_cache_table()
         await _table.update_one({'key': key}, {'$set': val}, upsert=True)
+
+
+class VisVersion(BaseModel):
+    """
+    version of an imported dataset, bumped by the cli after every import,
+    in-process indexes compare it to know when to rebuild
+    """
+    name: str
+    version: int
+
+    @classmethod
+    async def get_version(cls, name: str) -> int:
+        _table = TableSelector.get_version_table()
+        cur = await _table.find_one({'name': name}, {'_id': 0})
+        return cur['version'] if cur else 0
+
+    @classmethod
+    def get_version_sync(cls, name: str) -> int:
+        _table = TableSelector.get_version_table(name='default_sync')
+        cur = _table.find_one({'name': name}, {'_id': 0})
+        return cur['version'] if cur else 0
+
+    @classmethod
+    def bump_version(cls, name: str) -> int:
+        _table = TableSelector.get_version_table(name='default_sync')
+        cur = _table.find_one_and_update({'name': name},
+                                         {'$inc': {'version': 1}},
+                                         upsert=True,
+                                         return_document=ReturnDocument.AFTER)
+        return cur['version']
@@ -1,5 +1,9 @@
+import time
+import asyncio
 import traceback
 import logging
+from database.models import VisVersion
+from config import Config
 
 
 logger = logging.getLogger('database.services')
@@ -31,3 +35,52 @@ async def _async_bulk_load(_table, _ops):
     except Exception as e:
         logger.error(f"Failed to bulk write for {_table} with len={len(_ops)},"
                      f" err: {e}, stack: {traceback.format_exc()}")
+
+
+class VersionedLoader:
+    """
+    keep one object built from mongo in process and rebuild it once the
+    version of its dataset is bumped by the importer, the new object is
+    swapped in only after it is fully built
+    """
+
+    def __init__(self, name: str, build_fn):
+        self.name = name
+        self._build_fn = build_fn  # async fn(version) -> object
+        self._obj = None
+        self._version = None
+        self._checked = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def loaded(self) -> bool:
+        return self._obj is not None
+
+    def _is_fresh(self) -> bool:
+        return self._obj is not None and \
+            time.time() - self._checked < Config.VERSION_CHECK_INTERVAL
+
+    async def get(self):
+        if self._is_fresh():
+            return self._obj
+
+        async with self._lock:
+            if self._is_fresh():
+                return self._obj
+
+            version = await VisVersion.get_version(self.name)
+            self._checked = time.time()
+
+            if self._obj is None or version != self._version:
+                tick = time.time()
+                obj = await self._build_fn(version)
+                self._obj, self._version = obj, version
+
+                logger.info(f'built {self.name} with version={version}, '
+                            f'cost={time.time() - tick}')
+
+        return self._obj
@@ -1,4 +1,6 @@
 import time
+import inspect
+from functools import wraps
 
 
 def time_cost(threshold=None, logger=None):
@@ -6,15 +8,30 @@ def time_cost(threshold=None, logger=None):
         import logging
         logger = logging.getLogger('decorators')
 
+    def _log(fn, t0, t1):
+        if threshold is None or t1 - t0 > threshold:
+            logger.info('function %s cost %.6fs', fn.__name__, t1 - t0)
+
     def w(fn):
 
+        # a coroutine function is timed until it is awaited to the end,
+        # not only the creation of the coroutine
+        if inspect.iscoroutinefunction(fn):
+
+            @wraps(fn)
+            async def _aw(*args, **kwargs):
+                t0 = time.time()
+                ret = await fn(*args, **kwargs)
+                _log(fn, t0, time.time())
+                return ret
+
+            return _aw
+
+        @wraps(fn)
         def _w(*args, **kwargs):
             t0 = time.time()
             ret = fn(*args, **kwargs)
-            t1 = time.time()
-
-            if threshold is None or t1 - t0 > threshold:
-                logger.info('function %s cost %.6fs', fn.__name__, t1 - t0)
+            _log(fn, t0, time.time())
             return ret
 
         return _w
@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 import logging
 from database.models import CacheSelector
+from ip.warmup import space_warmer
 
 
 router = APIRouter(prefix='/health')
@@ -22,3 +23,12 @@ async def get_mem():
 
     return {'data': _data, 'size': _backend.size,
             'status': 'ok', 'message': ''}
+
+
+@router.get('/ready')
+def ready():
+    """
+    the server takes traffic at once, warm is the percentage of the
+    /ip/space keys warmed in the background
+    """
+    return {'data': space_warmer.status(), 'status': 'ok', 'message': ''}
@@ -0,0 +1,349 @@
+import os
+import re
+import csv
+import io
+import json
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import traceback
+import orjson
+import numpy as np
+from itertools import islice
+from config import Config
+from database.models import TableSelector
+from asn.index import get_cernet_path_index
+from .lpm import get_prefix_matcher
+from .picture import get_picture_filter
+from .services import to_picture_key, convert_picture
+from .index import ip_to_int
+
+
+logger = logging.getLogger('ip.enrich')
+
+ENRICH_FIELDS = ('delegation', 'path', 'picture')
+CSV_COLUMNS = ['ip', 'message', 'country', 'prefix', 'registry', 'status', 'date',
+               'path_prefix', 'path', 'picture']
+
+_JOB_ID = re.compile(r'[0-9a-f]{32}')
+_tasks = set()  # running jobs of this worker, referenced until they finish
+_LIVE = ('uploading', 'queued', 'running')  # statuses of a job its worker still owns
+
+
+class EnrichJob:
+    """
+    a bulk enrichment job under Config.ENRICH_DIR/<id>: the uploaded ips,
+    a state file rewritten after every chunk and the result as ndjson, so
+    any worker can report the progress and serve the result; the state
+    keeps the pid of the worker owning the job until it ends
+    """
+
+    INPUT = 'input.txt'
+    RESULT = 'result.ndjson'
+    STATE = 'state.json'
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.dir = os.path.join(Config.ENRICH_DIR, job_id)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    @classmethod
+    def create(cls, v: str, fields: list):
+        cls.clean()
+
+        job = cls(uuid.uuid4().hex)
+        os.makedirs(job.dir)
+        job.save_state(id=job.id, v=v, fields=fields, status='uploading',
+                       total=0, processed=0, created_at=int(time.time()),
+                       started_at=None, finished_at=None, error='', pid=os.getpid())
+        return job
+
+    @classmethod
+    def get(cls, job_id: str):
+        if not _JOB_ID.fullmatch(job_id or ''):
+            return None
+
+        job = cls(job_id)
+        if not os.path.exists(job.path(cls.STATE)):
+            return None
+
+        return job
+
+    @classmethod
+    def clean(cls):
+        # jobs older than Config.ENRICH_KEEP_SECONDS are dropped with their files
+        if not os.path.isdir(Config.ENRICH_DIR):
+            return
+
+        _deadline = time.time() - Config.ENRICH_KEEP_SECONDS
+        for _id in os.listdir(Config.ENRICH_DIR):
+            _dir = os.path.join(Config.ENRICH_DIR, _id)
+            if _JOB_ID.fullmatch(_id) and os.path.getmtime(_dir) < _deadline:
+                shutil.rmtree(_dir, ignore_errors=True)
+
+    @classmethod
+    def fail_orphans(cls) -> int:
+        """
+        at startup: jobs left uploading, queued or running by a worker that
+        is gone, or by an earlier process of this pid, are failed, nothing
+        would ever finish them
+        :return: jobs failed
+        """
+        if not os.path.isdir(Config.ENRICH_DIR):
+            return 0
+
+        failed = 0
+        for _id in os.listdir(Config.ENRICH_DIR):
+            job = cls.get(_id)
+            if job is None:
+                continue
+
+            try:
+                state = job.state()
+            except (OSError, ValueError):
+                continue
+
+            if state.get('status') not in _LIVE or _alive(state.get('pid')):
+                continue
+
+            job.save_state(status='failed', finished_at=int(time.time()),
+                           error='the worker running the job exited')
+            failed += 1
+
+        if failed:
+            logger.warning(f'failed orphaned enrich jobs={failed}')
+        return failed
+
+    def state(self) -> dict:
+        with open(self.path(self.STATE), 'r') as fd:
+            return json.load(fd)
+
+    def save_state(self, **kwargs) -> dict:
+        state = self.state() if os.path.exists(self.path(self.STATE)) else {}
+        state.update(kwargs)
+
+        tmp = f'{self.path(self.STATE)}.{os.getpid()}'
+        with open(tmp, 'w') as fd:
+            json.dump(state, fd)
+        os.replace(tmp, self.path(self.STATE))
+        return state
+
+    async def upload(self, stream) -> int:
+        """
+        :param stream: chunks of the request body, one ip per line, or a
+                       csv with the ip in the first column
+        :return: lines received
+        """
+        size = lines = 0
+        with open(self.path(self.INPUT), 'wb') as fd:
+            async for chunk in stream:
+                size += len(chunk)
+                if size > Config.ENRICH_MAX_BYTES:
+                    raise ValueError(f'file too large, at most {Config.ENRICH_MAX_BYTES} bytes')
+
+                lines += chunk.count(b'\n')
+                fd.write(chunk)
+
+            # a last line without a newline
+            if size and not chunk.endswith(b'\n'):
+                fd.write(b'\n')
+                lines += 1
+
+        self.save_state(total=lines, status='queued')
+        return lines
+
+    def start(self):
+        task = asyncio.create_task(self.run())
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        return task
+
+    def _iter_chunks(self, step: int):
+        with open(self.path(self.INPUT), 'r', errors='replace') as fd:
+            first = True
+            while True:
+                lines = list(islice(fd, step))
+                if not lines:
+                    return
+
+                ips = [_l.split(',', 1)[0].strip().strip('"') for _l in lines]
+                if first and ips and ips[0].lower() == 'ip':
+                    ips = ips[1:]
+                first = False
+
+                yield [_ip for _ip in ips if _ip]
+
+    async def run(self):
+        state = self.save_state(status='running', started_at=int(time.time()), pid=os.getpid())
+        v, fields = state['v'], state['fields']
+        tick = time.time()
+        processed = 0
+
+        try:
+            ctx = {'delegation': await get_prefix_matcher(v)}
+            if 'path' in fields and v == '4':
+                ctx['path'] = await get_cernet_path_index()
+            if 'picture' in fields:
+                ctx['picture'] = await get_picture_filter(v)
+
+            # reading, matching and writing a chunk run in a thread, only
+            # the picture reads stay on the event loop
+            chunks = self._iter_chunks(Config.ENRICH_CHUNK)
+            with open(self.path(f'{self.RESULT}.part'), 'wb') as fd:
+                while True:
+                    ips = await asyncio.to_thread(next, chunks, None)
+                    if ips is None:
+                        break
+
+                    await self._enrich_chunk(fd, v, fields, ips, ctx)
+
+                    processed += len(ips)
+                    await asyncio.to_thread(self.save_state, processed=processed)
+
+            os.replace(self.path(f'{self.RESULT}.part'), self.path(self.RESULT))
+
+            elapsed = time.time() - tick
+            self.save_state(status='done', total=processed, processed=processed,
+                            finished_at=int(time.time()),
+                            rows_per_sec=round(processed / max(elapsed, 1e-6)))
+            logger.info(f'finished enrich job={self.id}, ips={processed}, elapsed={elapsed:.3f}')
+
+        except Exception as e:
+            logger.error(f'failed enrich job={self.id}, err={e}, stack={traceback.format_exc()}')
+            self.save_state(status='failed', finished_at=int(time.time()), error=str(e))
+
+    async def _enrich_chunk(self, fd, v: str, fields: list, ips: list, ctx: dict):
+        """
+        the keys of a chunk are sorted once, then merged against the sorted
+        segments of the prefix tables by searchsorted; pictures are read by
+        sorted $in over what the bloom filter lets through
+        """
+        valid, rows = await asyncio.to_thread(self._match_chunk, fields, ips, ctx)
+
+        pictures = {}
+        if 'picture' in fields:
+            pictures = await self._read_pictures(v, [_ip for _ip, _ok in zip(ips, valid) if _ok],
+                                                 ctx['picture'])
+
+        items = await asyncio.to_thread(self._to_items, v, fields, ips, ctx, valid, rows, pictures)
+        await asyncio.to_thread(fd.write, b''.join(orjson.dumps(_i) + b'\n' for _i in items))
+
+    @staticmethod
+    def _match_chunk(fields: list, ips: list, ctx: dict) -> tuple:
+        """
+        :return: valid of every ip, {field: row of every ip, -1 unmatched}
+        """
+        _delegation = ctx['delegation']
+        keys, valid = _delegation.parse_keys(ips)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        rows = {}
+        for name in ('delegation', 'path'):
+            if name not in fields:
+                continue
+
+            _rows = np.full(len(ips), -1, dtype=np.int64)
+            if name in ctx:
+                _matcher = _delegation if name == 'delegation' else ctx['path'].matcher
+                _rows[order] = _matcher.match_keys(sorted_keys)
+            rows[name] = _rows.tolist()
+
+        return valid.tolist(), rows
+
+    @staticmethod
+    def _to_items(v: str, fields: list, ips: list, ctx: dict, valid: list, rows: dict, pictures: dict) -> list:
+        _delegation = ctx['delegation']
+
+        items = []
+        for i, (ip, _valid) in enumerate(zip(ips, valid)):
+            item = {'ip': ip, 'message': '' if _valid else 'invalid ip'}
+
+            if 'delegation' in rows:
+                _r = rows['delegation'][i]
+                item['delegation'] = _delegation.to_item(_r) if _valid and _r >= 0 else None
+
+            if 'path' in rows:
+                _r = rows['path'][i]
+                item['path'] = ctx['path'].to_item(_r) if _valid and _r >= 0 else None
+
+            if 'picture' in fields:
+                item['picture'] = pictures.get(to_picture_key(v, ip)) if _valid else None
+
+            items.append(item)
+
+        return items
+
+    @staticmethod
+    async def _read_pictures(v: str, ips: list, bloom) -> dict:
+        _table = TableSelector.get_ip_picture(v)
+        _keys = sorted({_k for _k in (to_picture_key(v, _ip) for _ip in ips) if _k is not None})
+
+        if _keys:
+            _maybe = bloom.contains_many([ip_to_int(_k, v) for _k in _keys])
+            _keys = [_k for _k, _m in zip(_keys, _maybe.tolist()) if _m]
+
+        found = {}
+        step = Config.PROBE_BATCH_CHUNK
+        for i in range(0, len(_keys), step):
+            async for _cur in _table.find({'ip': {'$in': _keys[i: i + step]}}, {'_id': 0}):
+                _key = _cur['ip']
+                found[_key] = convert_picture(v, _cur)
+
+        return found
+
+    def iter_result(self, fmt: str = 'ndjson', step: int = 2 ** 16):
+        if fmt == 'ndjson':
+            with open(self.path(self.RESULT), 'rb') as fd:
+                while True:
+                    chunk = fd.read(step)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        else:
+            yield from self._iter_csv(step)
+
+    def _iter_csv(self, step: int):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(CSV_COLUMNS)
+
+        with open(self.path(self.RESULT), 'r') as fd:
+            for line in fd:
+                item = json.loads(line)
+                _d = item.get('delegation') or {}
+                _p = item.get('path') or {}
+                _pic = item.get('picture')
+
+                writer.writerow([item['ip'], item['message'],
+                                 _d.get('country', ''), _d.get('prefix', ''),
+                                 _d.get('registry', ''), _d.get('status', ''), _d.get('date', ''),
+                                 _p.get('prefix', ''), ' '.join(_p.get('path', [])),
+                                 json.dumps(_pic) if _pic else ''])
+
+                if buf.tell() >= step:
+                    yield buf.getvalue().encode()
+                    buf.seek(0)
+                    buf.truncate()
+
+        yield buf.getvalue().encode()
+
+
+def _alive(pid) -> bool:
+    # a worker other than this one, still running
+    if not pid or pid == os.getpid():
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
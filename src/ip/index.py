@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import numpy as np
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import partial
+from itertools import accumulate
+from ipaddress import IPv6Address
+from database.models import TableSelector
+from database.services import VersionedLoader
+
+
+logger = logging.getLogger('ip.index')
+
+ALLOC_VERSION = 'ip/alloc'
+
+
+def ip_to_int(ip, v) -> int:
+    # ipv4 is stored as int, ipv6 as exploded string
+    if str(v) == '4':
+        return int(ip)
+    return int(IPv6Address(ip))
+
+
+class AllocDataset:
+    """
+    all delegation rows of vis_ipv4_alloc/vis_ipv6_alloc kept in process,
+    ordered by (prefix_start, -prefix_end), ipv6 addresses as 128-bit ints
+    """
+
+    PROJECTION = {'_id': 0, 'cc': 1, 'date': 1, 'count': 1, 'registry': 1, 'status': 1,
+                  'prefix': 1, 'prefix_start': 1, 'prefix_end': 1}
+
+    def __init__(self, v: str, version: int, rows: list):
+        self.v = str(v)
+        self.version = version
+
+        rows = sorted(rows, key=lambda x: (x['prefix_start'], -x['prefix_end']))
+
+        self.starts = [r['prefix_start'] for r in rows]
+        self.ends = [r['prefix_end'] for r in rows]
+        self.dates = [r['date'] for r in rows]
+        self.ccs = [r['cc'] for r in rows]
+        self.counts = [r['count'] for r in rows]
+        self.prefixes = [r['prefix'] for r in rows]
+        self.registries = [r.get('registry', '') for r in rows]
+        self.statuses = [r.get('status', '') for r in rows]
+
+        # max_ends[i] = max(ends[:i + 1]), stops the backward scan of containing()
+        self.max_ends = list(accumulate(self.ends, max))
+        self._derived = {}
+        self._building = {}  # {name: future} of derive_in_thread
+
+    def __len__(self):
+        return len(self.starts)
+
+    def derive(self, name: str, build_fn):
+        """
+        structures built from this dataset are kept with it, so they are
+        dropped together when a new version is loaded
+        """
+        if name not in self._derived:
+            self._derived[name] = build_fn(self)
+
+        return self._derived[name]
+
+    async def derive_in_thread(self, name: str, build_fn):
+        """
+        derive() for structures too slow to build on the event loop, the
+        build runs in a thread and concurrent callers wait for the same one
+        """
+        if name in self._derived:
+            return self._derived[name]
+
+        future = self._building.get(name)
+        if future is None:
+            future = self._building[name] = asyncio.ensure_future(asyncio.to_thread(build_fn, self))
+
+        try:
+            # a cancelled request does not cancel the build the others wait for
+            obj = await asyncio.shield(future)
+        finally:
+            if future.done() and self._building.get(name) is future:
+                self._building.pop(name)
+
+        return self._derived.setdefault(name, obj)
+
+    def contained(self, left: int, right: int, date: int) -> list:
+        # prefix_start >= left and prefix_end <= right and date <= date
+        lo = bisect_left(self.starts, left)
+        hi = bisect_right(self.starts, right)
+
+        return [i for i in range(lo, hi)
+                if self.ends[i] <= right and self.dates[i] <= date]
+
+    def containing(self, left: int, right: int, date: int):
+        # prefix_start <= left and prefix_end >= right and date <= date,
+        # the one with the largest prefix_start
+        i = bisect_right(self.starts, left) - 1
+
+        while i >= 0 and self.max_ends[i] >= right:
+            if self.ends[i] >= right and self.dates[i] <= date:
+                return i
+            i -= 1
+
+        return None
+
+
+class AllocCube:
+    """
+    cumulative ips and prefixes per (date, cc): row i holds the totals of all
+    delegations with date <= dates[i], so any date is one searchsorted away
+    """
+
+    HIDDEN_CC = {'HK', 'MO', 'TW', ''}
+
+    def __init__(self, dataset: AllocDataset):
+        self.dates, date_idx = np.unique(np.asarray(dataset.dates, dtype=np.int64),
+                                         return_inverse=True)
+        self.ccs, cc_idx = np.unique(np.asarray(dataset.ccs, dtype=str),
+                                     return_inverse=True)
+
+        shape = (len(self.dates), len(self.ccs))
+        self.ips = np.zeros(shape, dtype=np.int64)
+        self.prefixes = np.zeros(shape, dtype=np.int32)
+
+        np.add.at(self.ips, (date_idx, cc_idx), np.asarray(dataset.counts, dtype=np.int64))
+        np.add.at(self.prefixes, (date_idx, cc_idx), 1)
+
+        np.cumsum(self.ips, axis=0, out=self.ips)
+        np.cumsum(self.prefixes, axis=0, out=self.prefixes)
+
+    def get_map(self, date: int) -> list:
+        i = np.searchsorted(self.dates, date, side='right') - 1
+        if i < 0:
+            return []
+
+        ips, prefixes = self.ips[i], self.prefixes[i]
+        data = []
+
+        for j in np.flatnonzero(prefixes):
+            if self.ccs[j] in self.HIDDEN_CC:
+                continue
+
+            data.append({'country': str(self.ccs[j]),
+                         'ips': int(ips[j]),
+                         'prefixes': int(prefixes[j])})
+
+        return sorted(data, key=lambda x: x['ips'], reverse=True)
+
+
+class TrendStore:
+    """
+    cumulative count series per country and for all countries together,
+    each series is a pair of arrays (dates, running sum) holding one point
+    per date with allocations, by day or by year
+    """
+
+    TOTAL = 'total'
+
+    def __init__(self, ccs, dates, counts, yearly: bool = False):
+        ccs = np.asarray(ccs, dtype=str)
+        dates = np.asarray(dates, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+
+        if yearly:
+            dates = dates // 10000
+
+        self.yearly = yearly
+        self.series = {}
+
+        order = np.lexsort((dates, ccs))
+        ccs, dates, counts = ccs[order], dates[order], counts[order]
+
+        bounds = np.flatnonzero(ccs[1:] != ccs[:-1]) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(ccs)]):
+            if lo < hi:
+                self.series[str(ccs[lo])] = self._cumulate(dates[lo:hi], counts[lo:hi])
+
+        order = np.argsort(dates, kind='stable')
+        self.series[self.TOTAL] = self._cumulate(dates[order], counts[order])
+
+    @staticmethod
+    def _cumulate(dates, counts):
+        # dates are sorted, keep the running sum at the last row of each date
+        last = np.r_[dates[1:] != dates[:-1], True] if len(dates) else dates.astype(bool)
+        return dates[last], np.cumsum(counts)[last]
+
+    @classmethod
+    def from_dataset(cls, dataset: AllocDataset, yearly: bool = False):
+        return cls(dataset.ccs, dataset.dates, dataset.counts, yearly=yearly)
+
+    def get(self, cc: str, skip_zero: bool = False) -> list:
+        if cc not in self.series:
+            return []
+
+        dates, counts = self.series[cc]
+        if skip_zero:
+            keep = dates != 0
+            dates, counts = dates[keep], counts[keep]
+
+        return [{'date': int(_d), 'count': int(_c)}
+                for _d, _c in zip(dates.tolist(), counts.tolist())]
+
+    def get_many(self, ccs: list, skip_zero: bool = False) -> dict:
+        data = {}
+        for cc in ccs:
+            trend = self.get(cc, skip_zero=skip_zero)
+            if trend:
+                data[cc] = trend
+
+        return data
+
+
+class CountryPrefixes:
+    """
+    rows of every country ordered by (-count, prefix_start) for keyset
+    pagination, the rows visible at a date are cached per (cc, date) and
+    totals come from the sorted dates of the country
+    """
+
+    CACHE_SIZE = 128
+
+    def __init__(self, dataset: AllocDataset):
+        self.dataset = dataset
+        self.rows = {}  # {cc: [row]}
+        self.dates = {}  # {cc: sorted dates}
+
+        for i, cc in enumerate(dataset.ccs):
+            self.rows.setdefault(cc, []).append(i)
+
+        for cc, rows in self.rows.items():
+            rows.sort(key=lambda i: (-dataset.counts[i], dataset.starts[i]))
+            self.dates[cc] = sorted(dataset.dates[i] for i in rows)
+
+        self._visible = OrderedDict()  # {(cc, date): ([row], [(-count, start)])}
+
+    def total(self, cc: str, date: int) -> int:
+        return bisect_right(self.dates.get(cc, []), date)
+
+    def _get_visible(self, cc: str, date: int):
+        key = (cc, date)
+        if key in self._visible:
+            self._visible.move_to_end(key)
+            return self._visible[key]
+
+        _ds = self.dataset
+        rows = [i for i in self.rows.get(cc, []) if _ds.dates[i] <= date]
+        keys = [(-_ds.counts[i], _ds.starts[i]) for i in rows]
+
+        self._visible[key] = rows, keys
+        while len(self._visible) > self.CACHE_SIZE:
+            self._visible.popitem(last=False)
+
+        return rows, keys
+
+    def page(self, cc: str, date: int, limit: int,
+             offset: int = 0, after: tuple = None) -> (list, bool):
+        """
+        :param after: (count, prefix_start) of the last row of the previous
+                      page, offset is ignored when it is given
+        :return: rows of the page, whether there are more
+        """
+        rows, keys = self._get_visible(cc, date)
+
+        if after is not None:
+            offset = bisect_right(keys, (-after[0], after[1]))
+
+        return rows[offset: offset + limit], offset + limit < len(rows)
+
+
+def _to_alloc_row(cur: dict, v):
+    if cur.get('prefix_start') is None or cur.get('prefix_end') is None:
+        return None
+
+    cur['prefix_start'] = ip_to_int(cur['prefix_start'], v)
+    cur['prefix_end'] = ip_to_int(cur['prefix_end'], v)
+    return cur
+
+
+async def _load_alloc_dataset(v, version):
+    _table = TableSelector.get_prefix_alloc_table(v)
+    rows = []
+
+    async for cur in _table.find({}, AllocDataset.PROJECTION):
+        cur = _to_alloc_row(cur, v)
+        if cur is not None:
+            rows.append(cur)
+
+    logger.debug(f'loaded alloc rows={len(rows)}, v={v}, version={version}')
+    return AllocDataset(v, version, rows)
+
+
+def load_alloc_dataset_sync(v, version) -> AllocDataset:
+    # for the cli, which has no event loop
+    _table = TableSelector.get_prefix_alloc_table(v, name='default_sync')
+    rows = [_to_alloc_row(cur, v) for cur in _table.find({}, AllocDataset.PROJECTION)]
+
+    logger.debug(f'loaded alloc rows={len(rows)}, v={v}, version={version}')
+    return AllocDataset(v, version, [r for r in rows if r is not None])
+
+
+alloc_datasets = {
+    '4': VersionedLoader(ALLOC_VERSION, partial(_load_alloc_dataset, '4')),
+    '6': VersionedLoader(ALLOC_VERSION, partial(_load_alloc_dataset, '6')),
+}
+
+
+async def get_alloc_dataset(v) -> AllocDataset:
+    return await alloc_datasets[str(v)].get()
+
+
+async def _load_asn_trends(version):
+    _table = TableSelector.get_asn_alloc_table()
+    ccs, dates, counts = [], [], []
+
+    async for cur in _table.find({}, {'_id': 0, 'cc': 1, 'date': 1, 'count': 1}):
+        ccs.append(cur.get('cc') or '')
+        dates.append(cur['date'])
+        counts.append(cur['count'])
+
+    logger.debug(f'loaded asn alloc rows={len(ccs)}, version={version}')
+    return TrendStore(ccs, dates, counts, yearly=True)
+
+
+asn_trends = VersionedLoader(ALLOC_VERSION, _load_asn_trends)
+
+
+async def get_ip_trends(v, yearly: bool = False) -> TrendStore:
+    _dataset = await get_alloc_dataset(v)
+    return _dataset.derive('trend-year' if yearly else 'trend-day',
+                           partial(TrendStore.from_dataset, yearly=yearly))
+
+
+async def get_country_prefixes(v) -> CountryPrefixes:
+    _dataset = await get_alloc_dataset(v)
+    return _dataset.derive('country-prefixes', CountryPrefixes)
+
+
+async def get_asn_trends() -> TrendStore:
+    return await asn_trends.get()
@@ -0,0 +1,160 @@
+import time
+import socket
+import logging
+import numpy as np
+from .index import AllocDataset, get_alloc_dataset
+
+
+logger = logging.getLogger('ip.lpm')
+
+
+def flatten_intervals(starts: list, ends: list, shift: int = 0, bits: int = 32) -> (list, list):
+    """
+    nested intervals ordered by (start, -end) into disjoint segments, each
+    owned by the most specific interval covering it (-1 for a gap)
+
+    :param shift: bits dropped from both ends, keys are start >> shift
+    :param bits: of the keys, a segment starting at 2 ** bits is dropped
+    :return: segment starts, the interval row owning every segment
+    """
+    limit = 2 ** bits
+    ends = [e >> shift for e in ends]
+    seg_starts, seg_rows = [], []
+    stack = []
+
+    def _emit(pos, row):
+        if pos >= limit:
+            return
+        if seg_starts and seg_starts[-1] == pos:
+            seg_rows[-1] = row
+        else:
+            seg_starts.append(pos)
+            seg_rows.append(row)
+
+    def _close(upto):
+        while stack and ends[stack[-1]] < upto:
+            pos = ends[stack.pop()] + 1
+
+            # an interval overlapping past the end of the one below it
+            # leaves that one with nothing more to own
+            while stack and ends[stack[-1]] < pos:
+                stack.pop()
+
+            _emit(pos, stack[-1] if stack else -1)
+
+    for i, start in enumerate(starts):
+        start >>= shift
+        _close(start)
+        _emit(start, i)
+        stack.append(i)
+
+    _close(limit)
+    return seg_starts, seg_rows
+
+
+class IntervalMatcher:
+    """
+    longest prefix match over intervals ordered by (start, -end), one
+    searchsorted over the sorted segment starts per batch of keys; ipv6
+    intervals are /64 or shorter, segments are keyed by the high 64 bits
+    of the address
+    """
+
+    def __init__(self, v, starts: list, ends: list):
+        self.v = str(v)
+        self.shift = 0 if self.v == '4' else 64
+        self.family = socket.AF_INET if self.v == '4' else socket.AF_INET6
+
+        seg_starts, seg_rows = flatten_intervals(starts, ends, self.shift,
+                                                 32 if self.v == '4' else 64)
+        self.starts = np.asarray(seg_starts, dtype=np.uint64)
+        self.rows = np.asarray(seg_rows, dtype=np.int64)
+
+    def parse_keys(self, ips: list) -> (np.ndarray, np.ndarray):
+        """
+        :return: segment keys, whether the ip is valid
+        """
+        size = 4 if self.v == '4' else 16
+        empty = b'\0' * size
+        valid = np.ones(len(ips), dtype=bool)
+        packed = []
+
+        for i, ip in enumerate(ips):
+            try:
+                packed.append(socket.inet_pton(self.family, ip))
+            except (OSError, TypeError, ValueError):
+                packed.append(empty)
+                valid[i] = False
+
+        raw = b''.join(packed)
+        if self.v == '4':
+            keys = np.frombuffer(raw, dtype='>u4').astype(np.uint64)
+        else:
+            keys = np.frombuffer(raw, dtype='>u8')[::2].astype(np.uint64)
+
+        return keys, valid
+
+    def to_keys(self, ints) -> np.ndarray:
+        # ips as ints, ipv6 as 128-bit ints
+        if self.v == '4':
+            return np.asarray(ints, dtype=np.uint64)
+        return np.array([i >> 64 for i in ints], dtype=np.uint64)
+
+    def match_keys(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :return: the interval row of every key, -1 when not covered
+        """
+        if not len(self.starts):
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        i = np.searchsorted(self.starts, keys, side='right') - 1
+        return np.where(i >= 0, self.rows[np.maximum(i, 0)], -1)
+
+
+class PrefixMatcher(IntervalMatcher):
+    """
+    the most specific delegation of an alloc dataset covering an ip; the
+    matcher can be built in any process from load_alloc_dataset_sync for
+    batch jobs
+    """
+
+    def __init__(self, dataset: AllocDataset):
+        tick = time.time()
+        super().__init__(dataset.v, dataset.starts, dataset.ends)
+        self.dataset = dataset
+
+        logger.info(f'built prefix matcher v={self.v}, version={dataset.version}, '
+                    f'delegations={len(dataset)}, segments={len(self.starts)}, '
+                    f'elapsed={time.time() - tick:.3f}')
+
+    def to_item(self, row: int) -> dict:
+        _ds = self.dataset
+        return {'prefix': _ds.prefixes[row],
+                'country': _ds.ccs[row],
+                'registry': _ds.registries[row],
+                'status': _ds.statuses[row],
+                'date': _ds.dates[row]}
+
+    def match(self, ips: list) -> list:
+        """
+        :return: [{"ip", "data", "message"}] in the order of ips, as the
+                 other batch endpoints
+        """
+        keys, valid = self.parse_keys(ips)
+        rows = self.match_keys(keys).tolist()
+
+        items = []
+        for ip, _valid, row in zip(ips, valid.tolist(), rows):
+            if not _valid:
+                items.append({'ip': ip, 'data': {}, 'message': 'invalid ip'})
+            elif row < 0:
+                items.append({'ip': ip, 'data': {}, 'message': 'not matched'})
+            else:
+                items.append({'ip': ip, 'data': self.to_item(row), 'message': ''})
+
+        return items
+
+
+async def get_prefix_matcher(v) -> PrefixMatcher:
+    _dataset = await get_alloc_dataset(v)
+    return _dataset.derive('lpm', PrefixMatcher)
@@ -1,14 +1,18 @@
 import json
 import math
 import logging
+import warnings
 import traceback
+import numpy as np
 from statistics import mean
 from fastapi import Query
-from typing import Optional, Union
+from typing import Optional, Union, Literal, List
 from ipaddress import IPv6Address
 from pydantic import Field, BaseModel
 from pymongo import UpdateOne
+from bson import Binary
 from functools import partial
+from collections import OrderedDict
 from netaddr import (
     IPNetwork,
     cidr_merge
@@ -25,16 +29,15 @@ from utils.misc import (
     Regions,
     str_to_exploded_ipv6,
     get_b_subnets_v4,
-    get_b_subnet_v4,
-    get_b_subnet_v4_str,
-    ip_to_str
+    get_b_subnet_v4_str
 )
 from database.models import (
     TableSelector,
     CacheSelector
 )
-from database.services import _async_bulk_load, _bulk_load
-from .services import _add_to_cc_map, _add_to_prefix_map, _get_diff_date
+from database.services import _async_bulk_load
+from .services import _add_to_prefix_map, _get_diff_date
+from .space import SpaceMatrix
 from decorators import time_cost
 from config import Config
 
@@ -50,8 +53,9 @@ class IPPrefixInfoQuery(IPQueryWithTime):
 
 
 class IPTrendsQuery(IPBaseQuery):
-    # v, countries
+    # v, countries, granularity
     countries: Optional[str] = Field(Query(default=None))
+    granularity: Literal['day', 'year'] = Field(Query(default='day'))
 
 
 class IPSpaceQuery(IPQueryWithTime):
@@ -63,18 +67,61 @@ class IPSpaceQuery(IPQueryWithTime):
 
 
 class IPPrefixInfoCountryQuery(IPQueryWithTime, PageQuery):
-    # v, date, country
+    # v, date, country, cursor
     country: Optional[str] = Field(Query(default=None))
+    cursor: Optional[str] = Field(Query(default=None))
 
 
 class IPNetflowQuery(BaseModel):
+    # ip, start, end, max_points
     ip: str = Field(Query(default=''))
+    start: Optional[int] = Field(Query(default=None))
+    end: Optional[int] = Field(Query(default=None))
+    max_points: int = Field(Query(default=0, ge=0))
+
+
+class IPNetflowTopQuery(BaseModel):
+    # metric, n, start, end
+    metric: Literal['src_ip_bandwidth', 'src_ip_packet_rate',
+                    'dst_ip_bandwidth', 'dst_ip_packet_rate'] = Field(Query(default='src_ip_bandwidth'))
+    n: int = Field(Query(default=10, ge=1))
+    start: Optional[int] = Field(Query(default=None))
+    end: Optional[int] = Field(Query(default=None))
+
+
+class IPNetflowAnomalyQuery(BaseModel):
+    # start, end
+    start: Optional[int] = Field(Query(default=None))
+    end: Optional[int] = Field(Query(default=None))
+
+
+class IPLookupQuery(IPBaseQuery):
+    ip: str = Field(Query(default=''))
+
+
+class IPLookupBatchBody(BaseModel):
+    v: Literal['4', '6'] = '4'
+    ips: List[str] = []
+
+
+class IPEnrichQuery(IPBaseQuery):
+    # v, fields
+    fields: str = Field(Query(default='delegation,path,picture'))
+
+
+class IPEnrichResultQuery(BaseModel):
+    format: Literal['ndjson', 'csv'] = Field(Query(default='ndjson'))
 
 
 class ProbePictureQuery(IPBaseQuery):
     ip: str = Field(Query(default=''))
 
 
+class ProbePictureBatchBody(BaseModel):
+    v: Literal['4', '6'] = '4'
+    ips: List[str] = []
+
+
 class ProbeMapQuery(IPBaseQuery, RefreshQuery):
     country: str = Field(Query(default=''))
 
@@ -331,6 +378,9 @@ VIS_IP_NETFLOW_KEYS = ['timestamp',
                        'dst_ip_dst_port_bandwidth',
                        'status']
 
+# seconds of the bucket layout, one document per ip per bucket
+NETFLOW_BUCKETS = {'hour': 3600, 'day': 86400}
+
 
 class VisIPNetflow(BaseModel):
     timestamp: int
@@ -359,9 +409,9 @@ class VisIPNetflow(BaseModel):
         return dict(zip(VIS_IP_NETFLOW_KEYS, p))
 
     @classmethod
-    def to_ops(cls, ip, items):
+    def to_objs(cls, items) -> list:
+        # samples of the same timestamp are averaged into one
         t_map = {}
-        ops = []
 
         for item in items:
             t = item['timestamp']
@@ -388,71 +438,118 @@ class VisIPNetflow(BaseModel):
             obj['status'] = status
             objs.append(obj)
 
-        n = len(objs)
-        for obj in objs:
-            obj['n'] = n
-            ops.append(UpdateOne({'ip': ip, 'timestamp': obj.pop('timestamp')}, {'$set': obj}, upsert=True))
+        return objs
 
-        return ops
+    @classmethod
+    def read_csv(cls, path: str) -> list:
+        """
+        columnar version of to_item + to_objs: the csv is parsed into one
+        float array, samples are grouped by timestamp with reduceat
+        """
+        # a header-only file is an empty import, not worth the numpy warning
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            values = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2, dtype=np.float64,
+                                encoding='utf-8',
+                                usecols=range(len(VIS_IP_NETFLOW_KEYS)),
+                                converters={len(VIS_IP_NETFLOW_KEYS) - 1:
+                                            lambda x: float(x.strip() == 'Anomaly')})
+        if not len(values):
+            return []
 
+        ts = values[:, 0].astype(np.int64)
+        order = np.argsort(ts, kind='stable')
+        ts, values = ts[order], values[order]
 
-class VisIPMap(BaseModel):
-    date: int
-    v: str
-    data: list
+        bounds = np.r_[0, np.flatnonzero(ts[1:] != ts[:-1]) + 1]
+        sizes = np.diff(np.r_[bounds, len(ts)])[:, None]
 
-    @classmethod
-    async def get_latest_map(cls, v: str, date: int):
-        _q = {'v': v, 'date': {'$lte': date}}
-        _table = TableSelector.get_ip_map_table()
-        _cur = None
-        async for cur in _table.find(_q, {'_id': 0}).sort('date', -1).limit(1):
-            _cur = cur
+        means = np.add.reduceat(values[:, 1:-1], bounds, axis=0) / sizes
+        status = np.maximum.reduceat(values[:, -1], bounds).astype(np.int64)
+
+        keys = VIS_IP_NETFLOW_KEYS[1:-1]
+        objs = []
+        for t, _means, _status in zip(ts[bounds].tolist(), means.tolist(), status.tolist()):
+            obj = dict(zip(keys, _means))
+            obj['timestamp'] = t
+            obj['status'] = _status
+            objs.append(obj)
 
-        return _cur
+        return objs
 
     @classmethod
-    async def insert_map(cls, v: str, date: int, data: list):
-        _table = TableSelector.get_ip_map_table()
-        await _table.update_one({'v': v, 'date': date},
-                                {'$set': {'data': data}}, upsert=True)
+    def to_ops(cls, ip, items):
+        return cls.objs_to_ops(ip, cls.to_objs(items))
 
     @classmethod
-    async def addup_to_date(cls, v: str, start_date: int, end_date: int, data: list):
-        _table = TableSelector.get_prefix_alloc_table(v)
+    def objs_to_ops(cls, ip, objs):
+        ops = []
 
-        pipe = [
-            {'$match': {'date': {'$gt': start_date, '$lte': end_date}}},
-            {'$group': {'_id': '$cc',
-                        'ips': {'$sum': '$count'},
-                        'prefixes': {'$sum': 1}}}
-        ]
+        n = len(objs)
+        for obj in objs:
+            obj['n'] = n
+            ops.append(UpdateOne({'ip': ip, 'timestamp': obj.pop('timestamp')}, {'$set': obj}, upsert=True))
 
-        logger.debug(f"add_to_date pip={pipe}")
+        return ops
 
-        cc_map = {}
-        async for cur in _table.aggregate(pipe):
-            if cur['_id'] not in cc_map:
-                item = {
-                    'country': cur['_id'],
-                    'ips': cur['ips'],
-                    'prefixes': cur['prefixes']
-                }
-                cc_map[cur['_id']] = item
+    @classmethod
+    def pack_bucket(cls, ip: str, bucket: int, seconds: int, objs: list) -> dict:
+        """
+        one document per ip per bucket, the samples as packed columns:
+        timestamps int64, rates float64, status uint8, all little endian
+        """
+        objs = sorted(objs, key=lambda x: x['timestamp'])
+
+        return {
+            'ip': ip,
+            'bucket': bucket,
+            'seconds': seconds,
+            'n': len(objs),
+            'timestamp': Binary(np.array([o['timestamp'] for o in objs], dtype='<i8').tobytes()),
+            'status': Binary(np.array([o['status'] for o in objs], dtype='u1').tobytes()),
+            'columns': {key: Binary(np.array([o[key] for o in objs], dtype='<f8').tobytes())
+                        for key in VIS_IP_NETFLOW_KEYS[1:-1]}
+        }
 
-        for cur in data:
-            if cur['country'] not in cc_map:
-                cc_map[cur['country']] = cur
+    @classmethod
+    def unpack_bucket(cls, doc: dict) -> list:
+        ts = np.frombuffer(doc['timestamp'], dtype='<i8').tolist()
+        status = np.frombuffer(doc['status'], dtype='u1').tolist()
+        columns = {key: np.frombuffer(doc['columns'][key], dtype='<f8').tolist()
+                   for key in VIS_IP_NETFLOW_KEYS[1:-1]}
 
-            else:
-                cc_map[cur['country']]['ips'] += cur['ips']
-                cc_map[cur['country']]['prefixes'] += cur['prefixes']
+        objs = []
+        for i, t in enumerate(ts):
+            obj = {key: columns[key][i] for key in columns}
+            obj['timestamp'] = t
+            obj['status'] = status[i]
+            objs.append(obj)
 
-        cc = sorted(list(cc_map.values()), key=lambda x: x['ips'], reverse=True)
-        if cc:
-            await cls.insert_map(v, end_date, cc)
+        return objs
 
-        return cc
+    @classmethod
+    def to_bucket_ops(cls, ip, objs, seconds: int, existing: dict) -> list:
+        """
+        :param objs: samples as returned by to_objs/read_csv
+        :param existing: {bucket: doc} already stored for the ip, merged
+                         with the new samples, a new sample wins
+        """
+        buckets = {}
+        for obj in objs:
+            buckets.setdefault(obj['timestamp'] // seconds * seconds, {})[obj['timestamp']] = obj
+
+        ops = []
+        for bucket, objs in buckets.items():
+            if bucket in existing:
+                _merged = {o['timestamp']: o for o in cls.unpack_bucket(existing[bucket])}
+                _merged.update(objs)
+                objs = _merged
+
+            ops.append(UpdateOne({'ip': ip, 'seconds': seconds, 'bucket': bucket},
+                                 {'$set': cls.pack_bucket(ip, bucket, seconds, list(objs.values()))},
+                                 upsert=True))
+
+        return ops
 
 
 class VisIPv4Picture(BaseModel):
@@ -551,6 +648,9 @@ IPv6_RANGE = _get_diff_date(ipv6_time_range[0], ipv6_time_range[1]) + [Config.IP
 ORDERED_IPv4_RANGE = list(reversed(IPv4_RANGE))
 ORDERED_IPv6_RANGE = list(reversed(IPv6_RANGE))
 
+WINNERS_SIZE = 256
+_winners = OrderedDict()  # {(version, cache_key, ccs): [{prefix, country}]}
+
 
 class VisIPSpace(BaseModel):
     cc: str
@@ -577,233 +677,103 @@ class VisIPSpace(BaseModel):
         return f'{v}-{date}'
 
     @classmethod
-    async def get_space(cls, v: str, date: int, ccs: list, is_tight: int = 0) -> (dict, set):
-        if not ccs:
-            return {}, set()
-
-        _spaces = {}
-        ccs = set(ccs)
+    def country_cache_key(cls, v: str, date: int, cc: str, is_tight=0, version=0):
+        return f'{cls.cache_key(v, date, is_tight)}-{cc}-{version}'
 
-        cache = CacheSelector.get_cache()
+    @classmethod
+    async def get_country_spaces(cls, v: str, date: int, ccs: list,
+                                 is_tight: int = 0, version: int = 0) -> (dict, set):
         """
-        {
-            data: {
-                cn: {prefix: count},
-                us: {prefix: count}
-            }
-        }
+        snapshots are stored per country and alloc version, any subset of
+        countries is assembled from the memory cache first, then from mongo
+        :return: {cc: {prefix: count}}, countries without a snapshot
         """
-        _cache_key = cls.cache_key(v, date, is_tight)
-        found = await cache.get(_cache_key)
-
-        if found is not None:
-            logger.debug(f'got cache with key={_cache_key}')
-
-        else:
-            _q = {'date': date}
-
-            if v == '6':
-                _q['tight'] = is_tight
-
-            _table = TableSelector.get_ip_space(v)
-            logger.debug(f'get_space_q={_q}, v={v}')
-
-            one = await _table.find_one(_q)
-            if not one:
-                return {}, ccs
-
-            found = one
-
-        for k, v in found['data'].items():
-            if k not in ccs:
-                continue
-
-            _spaces[k] = v
-
-        _left_cc = ccs - set(_spaces.keys())
-        return _spaces, _left_cc
-
-    @classmethod
-    async def get_latest_space(cls, v: str, date: int, ccs: list):
-        if not ccs:
-            return {}
-
-        _q = {'date': {'$lte': date}}
-        _table = TableSelector.get_ip_space(v)
-        # {cc: {prefix: count}}
-
-        _spaces = {}
-        _date = 0
-        _left = {}
-
-        ccs = set(ccs)
-        logger.debug(f'get_latest_q={_q}')
-
-        async for cur in _table.find(_q, {'_id': 0}).sort('date', -1).limit(1):
-            # logger.debug(f'cur={cur}')
-            for cc, prefixes in cur['data'].items():
-
-                if cc not in ccs:
-                    _left[cc] = prefixes
-                    continue
-
-                _spaces[cc] = prefixes
-
-            _date = cur['date']
-
-        _left_cc = ccs - set(_spaces.keys())
-
-        return _spaces, _left, _date, _left_cc
-
-    @classmethod
-    async def get_latest_space2(cls, v: str, date: int,
-                                ccs: list, is_tight: int = 0) \
-            -> (bool, dict, int, set, set):
-
-        ccs = set(ccs)
-
-        _found = False
-        _found_date = 0
-        _found_cc = set()
+        ccs = sorted(set(ccs))
         _spaces = {}
 
         if not ccs:
-            return _found, _spaces, _found_date, ccs, _found_cc
+            return _spaces, set()
 
         cache = CacheSelector.get_cache()
-        """
-        {
-            data: {
-                cn: {prefix: count},
-                us: {prefix: count}
-            },
-            cc: [cn, us, de]
-        }
-        """
-        _latest_date = cls.get_latest_date(v, date)
-        _cache_key = cls.cache_key(v, _latest_date, is_tight)
-        found = await cache.get(_cache_key)
-
-        if found is not None:
-            logger.debug(f'got cache with key={_cache_key}')
-            _found = True
-            _found_date = _latest_date
+        _keys = [cls.country_cache_key(v, date, cc, is_tight, version) for cc in ccs]
 
-        else:
-            _q = {'date': {'$lte': _latest_date}}
-            if v == '6':
-                _q['tight'] = is_tight
+        for cc, found in zip(ccs, await cache.get_many(*_keys)):
+            if found is not None:
+                _spaces[cc] = found
 
-            _table = TableSelector.get_ip_space(v)
-            logger.debug(f'get_latest_space_q={_q}, v={v}')
+        _left_cc = [cc for cc in ccs if cc not in _spaces]
+        if not _left_cc:
+            logger.debug(f'got all spaces from cache, date={date}, cc={ccs}')
+            return _spaces, set()
 
-            async for cur in _table.find(_q, {'_id': 0}).sort('date', -1).limit(1):
-                found = cur
-
-            if not found:
-                return _found, _spaces, _found_date, ccs, _found_cc
+        _q = {'date': date, 'country': {'$in': _left_cc}, 'version': version}
+        if v == '6':
+            _q['tight'] = is_tight
 
-            _found = True
-            _found_date = found['date']
+        _table = TableSelector.get_ip_space(v)
+        logger.debug(f'get_country_spaces_q={_q}, v={v}')
 
-        for k, v in found['data'].items():
-            if k not in ccs:
-                continue
-            _spaces[k] = v
+        _found = {}
+        async for cur in _table.find(_q, {'_id': 0, 'country': 1, 'data': 1}):
+            _found[cur['country']] = cur['data']
 
-        _found_cc = found['cc']
-        _left_cc = ccs - set(_found_cc)
+        if _found:
+            await cache.set_many({cls.country_cache_key(v, date, cc, is_tight, version): data
+                                  for cc, data in _found.items()}, expire=None)
+            _spaces.update(_found)
 
-        return _found, _spaces, _found_date, _left_cc, _found_cc
+        return _spaces, set(_left_cc) - set(_found)
 
     @classmethod
-    async def insert_space(cls, v: str, date: int, cc_map: dict,
-                           left: dict, tight: int = 0, cc: list = None):
-        logger.debug(f'insert space date={date}, map={len(cc_map)}, '
-                     f'left={len(left)}, tight={tight}, v={v}')
+    async def insert_country_spaces(cls, v: str, date: int, cc_map: dict,
+                                    tight: int = 0, version: int = 0):
+        """
+        one document per (date, tight, country), so a later request for any
+        subset of these countries is answered without computing
+        """
+        logger.debug(f'insert country spaces date={date}, '
+                     f'cc={list(cc_map)}, tight={tight}, v={v}')
 
         if not cc_map:
             return
 
-        if left:
-            cc_map.update(left)
-
-        # set in db
-        _q = {'date': date}
-        if v == '6':
-            _q['tight'] = tight
-
-        _u = {'data': cc_map, 'cc': cc}
-
-        # set in mem
         cache = CacheSelector.get_cache()
-        _cache_key = cls.cache_key(v, date, tight)
+        ok = await cache.set_many({cls.country_cache_key(v, date, cc, tight, version): data
+                                   for cc, data in cc_map.items()}, expire=None)
+        if ok is False:
+            logger.warning(f'failed to set country spaces cache, date={date}, v={v}')
+
+        _ops = []
+        for cc, data in cc_map.items():
+            _q = {'date': date, 'country': cc}
+            if v == '6':
+                _q['tight'] = tight
 
-        logger.debug(f"set cache with key={_cache_key},"
-                     f" value={len(_u['data'])}")
-        # todo remove TTL
-        ok = await cache.set(key=_cache_key,
-                             value=_u,
-                             expire=None)
-        if not ok:
-            logger.warning(f'failed to set cache with key={_cache_key}')
+            _ops.append(UpdateOne(_q, {'$set': {'data': data, 'version': version}},
+                                  upsert=True))
 
         _table = TableSelector.get_ip_space(v)
-        await _table.update_one(_q,
-                                {'$set': _u},
-                                upsert=True)
+        await _table.bulk_write(_ops, ordered=False)
 
     @classmethod
-    async def addup_to_date(cls,
-                            v,
-                            start_date: int,
-                            end_date: int,
-                            data: dict,
-                            ccs: list,
-                            left: dict,
-                            cidr: int = 16):
-        if not data:
-            return {}
-
-        cc_map = {}  # {cc: {prefix: count}}
-        step = 2 ** cidr
-
-        ccs = set(ccs) - set(data.keys())
-
-        def _add_item(cur_):
-
-            if cur_['count'] <= step:
-                b_ = get_b_subnet_v4(cur_['prefix_start'])
-                _add_to_cc_map(cc_map, f'{ip_to_str(b_, v=v)}/{cidr}',
-                               cur_['cc'], cur_['count'])
-
-            else:
-                _add_to_cc_map(cc_map, cur_['prefix_start'], cur_['cc'], cur_['count'])
-
-        _table = TableSelector.get_prefix_alloc_table(v)
-
-        if start_date < end_date:
-
-            q = {'date': {'$gt': start_date, '$lte': end_date},
-                 'cc': {'$in': list(data.keys())}}
-
-            logger.debug(f'addup_to_date_q={q}')
-
-            async for cur in _table.find(q, {'_id': 0}):
-                _add_item(cur)
+    def get_winners(cls, cache_key: str, cc_map: dict, version: int) -> list:
+        """
+        winners of a cached snapshot are computed once per alloc version and
+        requested countries, a new version is never served older winners
+        """
+        key = (version, cache_key, tuple(sorted(cc_map)))
 
-        cc_q = {'cc': {'$in': list(ccs)}, 'date': {'$lte': end_date}}
-        logger.debug(f'cc_q={cc_q}')
+        if key in _winners:
+            _winners.move_to_end(key)
+            return _winners[key]
 
-        async for cur in _table.find(cc_q, {'_id': 0}):
-            _add_item(cur)
+        data = cls.convert_cc_map(cc_map)
+        _winners[key] = data
 
-        for cc, _prefixes in data.items():
-            for _prefix, _count in _prefixes.items():
-                _add_to_cc_map(cc_map, _prefix, cc, _count)
+        while len(_winners) > WINNERS_SIZE:
+            _winners.popitem(last=False)
 
-        await cls.insert_space(v, end_date, cc_map, left)
-        return cc_map
+        return data
 
     @classmethod
     @time_cost()
@@ -811,40 +781,7 @@ class VisIPSpace(BaseModel):
         if not cc_map:
             return []
 
-        prefix_map = {}
-
-        for cc, prefixes in cc_map.items():
-
-            for _prefix, _count in prefixes.items():
-                if _prefix not in prefix_map:
-                    prefix_map[_prefix] = {cc: _count}
-
-                else:
-                    if cc not in prefix_map[_prefix]:
-                        prefix_map[_prefix][cc] = _count
-
-                    else:
-                        prefix_map[_prefix][cc] += _count
-
-        if not prefix_map:
-            return []
-
-        data = []
-        for prefix, cc in prefix_map.items():
-
-            if not cc:
-                continue
-
-            c = sorted(list(cc.items()), key=lambda x: x[1], reverse=True)[0]
-            #logger.debug(f'prefix={prefix}, c={c}, '
-            #             f'from={sorted(list(cc.items()), key=lambda x: x[1], reverse=True)}')
-            item = {
-                'prefix': prefix,
-                'country': c[0]
-            }
-            data.append(item)
-
-        return data
+        return SpaceMatrix.from_cc_map(cc_map).winners()
 
     @classmethod
     @time_cost()
@@ -852,70 +789,7 @@ class VisIPSpace(BaseModel):
         if not prefix_map:
             return []
 
-        data = []
-        for prefix, cc in prefix_map.items():
-
-            if not cc:
-                continue
-
-            c = sorted(list(cc.items()), key=lambda x: x[1], reverse=True)[0]
-            # logger.debug(f'c={c[0]}, prefix={prefix}, from={sorted(list(cc.items()), key=lambda x: x[1], reverse=True)}')
-            item = {
-                'prefix': prefix,
-                'country': c[0]
-            }
-            data.append(item)
+        data = SpaceMatrix.from_prefix_map(prefix_map).winners()
 
         logger.debug(f'prefix={len(data)}')
         return data
-
-
-class VisIPTrend(BaseModel):
-    cc: str
-    data: list
-    v: str
-
-    @classmethod
-    async def get_trend(cls, v, cc: list):
-        if not cc:
-            return {}
-
-        _table = TableSelector.get_ip_trend()
-
-        cc_map = {}
-        async for cur in _table.find({'cc': {'$in': cc}, 'v': v}, {'_id': 0, 'v': 0}):
-            cc_map[cur['cc']] = cur['data']
-
-        _left = set(cc) - set(cc_map.keys())
-        return cc_map, _left
-
-    @classmethod
-    def insert_trend(cls, v, cc_map):
-        logger.debug(f'v={v}, cc_map={len(cc_map)}')
-
-        if not cc_map:
-            return
-
-        logger.debug(f'insert_trend len={len(cc_map)}')
-        _table = TableSelector.get_ip_trend(name='default_sync')
-        ops = []
-
-        for cc, trend in cc_map.items():
-            ops.append(UpdateOne({'cc': cc, 'v': v},
-                                 {'$set': {'data': trend}}, upsert=True))
-
-        _bulk_load(_table, ops)
-
-    @classmethod
-    def convert_trend(cls, v, cc_map):
-        if not cc_map:
-            return cc_map
-
-        _cc_map = {}
-        for cc, trend in cc_map.items():
-            for _t in trend:
-                if str(v) == '6':
-                    _t['count'] = _t['count'] * (2 ** 64)
-            _cc_map[cc] = trend
-
-        return _cc_map
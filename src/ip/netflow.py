@@ -0,0 +1,154 @@
+import heapq
+import logging
+from pymongo import UpdateOne
+from config import Config
+from database.models import TableSelector
+
+
+logger = logging.getLogger('ip.netflow')
+
+# rates ranked by /ip/netflow/top
+NETFLOW_TOP_METRICS = ('src_ip_bandwidth',
+                       'src_ip_packet_rate',
+                       'dst_ip_bandwidth',
+                       'dst_ip_packet_rate')
+
+
+class NetflowRollup:
+    """
+    per Config.NETFLOW_WINDOW window of vis_ip_netflow_rollup: the
+    Config.NETFLOW_TOP_KEEP ips with the highest mean of every top metric
+    (a min-heap per window and metric while importing) and the ips with an
+    anomalous sample; one document per window, merged into by the workers
+    with $push $sort/$slice and $addToSet
+    """
+
+    def __init__(self, seconds: int = None, keep: int = None):
+        self.seconds = seconds or Config.NETFLOW_WINDOW
+        self.keep = keep or Config.NETFLOW_TOP_KEEP
+
+        self.ips = set()
+        self.tops = {}  # {(window, metric): [(value, ip)]}
+        self.anomalies = {}  # {window: {ip}}
+
+    def __len__(self):
+        return len(self.ips)
+
+    def add(self, ip: str, objs: list):
+        """
+        :param objs: samples of one ip as returned by VisIPNetflow.read_csv
+        """
+        windows = {}
+        for obj in objs:
+            windows.setdefault(obj['timestamp'] // self.seconds * self.seconds, []).append(obj)
+
+        self.ips.add(ip)
+        for window, _objs in windows.items():
+            for metric in NETFLOW_TOP_METRICS:
+                value = sum(o[metric] for o in _objs) / len(_objs)
+                heap = self.tops.setdefault((window, metric), [])
+
+                if len(heap) < self.keep:
+                    heapq.heappush(heap, (value, ip))
+                elif value > heap[0][0]:
+                    heapq.heapreplace(heap, (value, ip))
+
+            if any(o['status'] for o in _objs):
+                self.anomalies.setdefault(window, set()).add(ip)
+
+    def windows(self) -> set:
+        return {w for w, _ in self.tops} | set(self.anomalies)
+
+    def to_ops(self) -> list:
+        """
+        ordered: the ips of this batch are pulled from every window they
+        may have been in before their new values are pushed, a re-import
+        replaces an ip instead of adding it twice
+        """
+        if not self.ips:
+            return []
+
+        ips = sorted(self.ips)
+        ops = []
+
+        for window in sorted(self.windows()):
+            q = {'seconds': self.seconds, 'window': window}
+
+            _pull = {f'top.{m}': {'ip': {'$in': ips}} for m in NETFLOW_TOP_METRICS}
+            _pull['anomaly'] = {'$in': ips}
+            ops.append(UpdateOne(q, {'$pull': _pull}))
+
+            _push = {}
+            for metric in NETFLOW_TOP_METRICS:
+                items = [{'ip': _ip, 'value': _v} for _v, _ip in self.tops.get((window, metric), [])]
+                if items:
+                    _push[f'top.{metric}'] = {'$each': items, '$sort': {'value': -1}, '$slice': self.keep}
+
+            update = {}
+            if _push:
+                update['$push'] = _push
+            if window in self.anomalies:
+                update['$addToSet'] = {'anomaly': {'$each': sorted(self.anomalies[window])}}
+
+            if update:
+                ops.append(UpdateOne(q, update, upsert=True))
+
+        return ops
+
+    def flush(self, table) -> int:
+        # table is a sync collection, the cli workers write with pymongo
+        ops = self.to_ops()
+        if ops:
+            table.bulk_write(ops, ordered=True)
+
+        n = len(self.ips)
+        self.ips, self.tops, self.anomalies = set(), {}, {}
+        return n
+
+
+def _window_query(start: int = None, end: int = None) -> dict:
+    q = {'seconds': Config.NETFLOW_WINDOW}
+
+    _range = {}
+    if start is not None:
+        _range['$gte'] = start // Config.NETFLOW_WINDOW * Config.NETFLOW_WINDOW
+    if end is not None:
+        _range['$lte'] = end
+    if _range:
+        q['window'] = _range
+
+    return q
+
+
+async def get_netflow_top(metric: str, n: int, start: int = None, end: int = None) -> list:
+    """
+    an ip of several windows is ranked by its highest window mean
+    """
+    _table = TableSelector.get_ip_netflow_rollup_table()
+    q = _window_query(start, end)
+    logger.debug(f'q={q}, metric={metric}')
+
+    best = {}  # {ip: (value, window)}
+    async for cur in _table.find(q, {'_id': 0, 'window': 1, f'top.{metric}': 1}):
+        for item in cur.get('top', {}).get(metric, []):
+            if item['ip'] not in best or item['value'] > best[item['ip']][0]:
+                best[item['ip']] = (item['value'], cur['window'])
+
+    top = heapq.nlargest(n, best.items(), key=lambda x: x[1][0])
+    return [{'ip': _ip, 'value': _v, 'window': _w} for _ip, (_v, _w) in top]
+
+
+async def get_netflow_anomalies(start: int = None, end: int = None) -> list:
+    _table = TableSelector.get_ip_netflow_rollup_table()
+    q = _window_query(start, end)
+    q['anomaly.0'] = {'$exists': True}
+    logger.debug(f'q={q}')
+
+    windows = {}  # {ip: [window]}
+    async for cur in _table.find(q, {'_id': 0, 'window': 1, 'anomaly': 1}).sort('window', 1):
+        for _ip in cur['anomaly']:
+            windows.setdefault(_ip, []).append(cur['window'])
+
+    data = [{'ip': _ip, 'count': len(_ws), 'first': _ws[0], 'last': _ws[-1]}
+            for _ip, _ws in windows.items()]
+    return sorted(data, key=lambda x: (-x['count'], x['ip']))
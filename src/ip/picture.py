@@ -0,0 +1,262 @@
+import os
+import random
+import logging
+import numpy as np
+from functools import partial
+from collections import Counter
+from pymongo import UpdateOne
+from config import Config
+from database.models import TableSelector, VisVersion
+from database.services import VersionedLoader
+from utils.bloom import BloomFilter
+from utils.misc import Regions
+from .index import ip_to_int
+
+
+logger = logging.getLogger('ip.picture')
+
+PICTURE_VERSION = 'ip/picture/{v}'
+BLOOM_NAME = 'probe-bloom'
+FP_SAMPLES = 100000
+
+
+def picture_version(v) -> str:
+    return PICTURE_VERSION.format(v=v)
+
+
+def bloom_path(v, version) -> str:
+    return os.path.join(Config.INDEX_DIR, f'{BLOOM_NAME}-{v}-{version}')
+
+
+def _measure_fp(bloom: BloomFilter, v, keys: list) -> float:
+    """
+    share of never probed ips the filter lets through: random ipv4, or
+    random hosts in the /64s of probed ipv6
+    """
+    if not keys:
+        return 0.0
+
+    members = set(keys)
+    if str(v) == '4':
+        samples = [random.getrandbits(32) for _ in range(FP_SAMPLES)]
+    else:
+        samples = [(random.choice(keys) >> 64 << 64) | random.getrandbits(64)
+                   for _ in range(FP_SAMPLES)]
+
+    samples = [_k for _k in samples if _k not in members]
+    if not samples:
+        return 0.0
+
+    return float(np.mean(bloom.contains_many(samples)))
+
+
+def build_picture_bloom(v, version, fp_rate: float = None) -> BloomFilter:
+    """
+    for the cli, every ip of vis_ipv4_picture/vis_ipv6_picture goes in
+    """
+    fp_rate = fp_rate or Config.PROBE_BLOOM_FP_RATE
+    _table = TableSelector.get_ip_picture(v, name='default_sync')
+
+    keys = [ip_to_int(_cur['ip'], v) for _cur in _table.find({}, {'_id': 0, 'ip': 1})]
+
+    bloom = BloomFilter.with_capacity(len(keys), fp_rate)
+    bloom.add_many(keys)
+
+    bloom.meta.update(version=version, v=str(v), measured_fp=_measure_fp(bloom, v, keys))
+    logger.info(f'built picture bloom v={v}, version={version}, {bloom.meta}')
+    return bloom
+
+
+def clean_picture_bloom(v, version):
+    keep = os.path.basename(bloom_path(v, version))
+    for _file in os.listdir(Config.INDEX_DIR):
+        if _file.startswith(f'{BLOOM_NAME}-{v}-') and _file.rsplit('.', 1)[0] != keep:
+            os.remove(os.path.join(Config.INDEX_DIR, _file))
+
+
+def stale_picture_bloom(v) -> int:
+    """
+    for the cli before an import writes: the version is bumped to one
+    without a filter file, lookups go to mongo until update_picture_bloom
+    saves the filter of the next one, a filter never misses a new ip
+    :return: seconds the servers may still use the filter they loaded
+    """
+    version = VisVersion.get_version_sync(picture_version(v))
+    loaded = os.path.exists(f'{bloom_path(v, version)}.json')
+
+    bumped = VisVersion.bump_version(picture_version(v))
+    if os.path.isdir(Config.INDEX_DIR):
+        clean_picture_bloom(v, bumped)
+
+    logger.info(f'picture bloom v={v} stale with version={bumped}')
+    return Config.VERSION_CHECK_INTERVAL if loaded else 0
+
+
+def update_picture_bloom(v, fp_rate: float = None) -> int:
+    """
+    for the cli after an import: the filter of the next version is saved
+    before the version is bumped, so the server never sees a version
+    without its file
+    """
+    version = VisVersion.get_version_sync(picture_version(v)) + 1
+
+    bloom = build_picture_bloom(v, version, fp_rate)
+    os.makedirs(Config.INDEX_DIR, exist_ok=True)
+    bloom.save(bloom_path(v, version))
+
+    bumped = VisVersion.bump_version(picture_version(v))
+    if bumped != version:
+        logger.warning(f'picture version moved to={bumped} while building={version}')
+
+    clean_picture_bloom(v, version)
+    return version
+
+
+async def _load_picture_bloom(v, version):
+    bloom = BloomFilter.load(bloom_path(v, version))
+    if bloom is None:
+        logger.warning(f'no picture bloom for v={v}, version={version}, lookups go to mongo')
+        return BloomFilter.passthrough()
+
+    return bloom
+
+
+picture_filters = {
+    '4': VersionedLoader(picture_version('4'), partial(_load_picture_bloom, '4')),
+    '6': VersionedLoader(picture_version('6'), partial(_load_picture_bloom, '6')),
+}
+
+
+async def get_picture_filter(v) -> BloomFilter:
+    return await picture_filters[str(v)].get()
+
+
+class ProbeRollup:
+    """
+    probed ips per (cc, carrier) kept by the importers in vis_probe_rollup,
+    countries, carriers and their counts are read from it in process
+    """
+
+    def __init__(self, v, rows: list):
+        self.v = str(v)
+        self.counts = Counter()  # {(cc, carrier): count}
+
+        for row in rows:
+            self.counts[(row['cc'], row.get('carrier'))] += row['count']
+
+        self.cc_counts = Counter()
+        self.carrier_counts = {}  # {cc: Counter}
+
+        for (cc, carrier), count in self.counts.items():
+            if count <= 0:
+                continue
+
+            self.cc_counts[cc] += count
+            if carrier is not None:
+                self.carrier_counts.setdefault(cc, Counter())[carrier] += count
+
+    def countries(self) -> list:
+        return list(self.cc_counts)
+
+    def carriers(self, cc: str) -> list:
+        return list(self.carrier_counts.get(cc, {}))
+
+    @staticmethod
+    def to_items(counts: Counter) -> list:
+        items = [{'name': _n, 'count': _c} for _n, _c in counts.items()
+                 if not Regions.is_unknown(_n)]
+        return sorted(items, key=lambda x: x['count'], reverse=True)
+
+    def country_map(self) -> list:
+        return self.to_items(self.cc_counts)
+
+    def carrier_map(self, cc: str) -> list:
+        return self.to_items(self.carrier_counts.get(cc, Counter()))
+
+
+def rollup_ops(v, keys: list) -> list:
+    """
+    :param keys: [(cc, carrier)] of newly inserted pictures
+    """
+    return [UpdateOne({'v': str(v), 'cc': cc, 'carrier': carrier},
+                      {'$inc': {'count': count}}, upsert=True)
+            for (cc, carrier), count in Counter(keys).items()]
+
+
+# probed ips per (cc, carrier) of a picture collection
+_ROLLUP_PIPE = [{'$group': {'_id': {'cc': '$cc', 'carrier': '$carrier'}, 'count': {'$sum': 1}}}]
+
+# one row per (v, cc, carrier), the importers and the servers seeding it
+# concurrently upsert the same rows
+_ROLLUP_INDEX = [('v', 1), ('cc', 1), ('carrier', 1)]
+
+
+def _seed_ops(v, rows, op: str = '$setOnInsert') -> list:
+    return [UpdateOne({'v': str(v), 'cc': cur['_id']['cc'], 'carrier': cur['_id'].get('carrier')},
+                      {op: {'count': cur['count']}}, upsert=True)
+            for cur in rows]
+
+
+def rebuild_probe_rollup(v) -> int:
+    # for the cli, recounts the whole picture collection
+    _table = TableSelector.get_ip_picture(v, name='default_sync')
+    _rollup = TableSelector.get_probe_rollup_table(name='default_sync')
+
+    ops = _seed_ops(v, _table.aggregate(_ROLLUP_PIPE), op='$set')
+
+    _rollup.delete_many({'v': str(v)})
+    _rollup.create_index(_ROLLUP_INDEX, unique=True)
+    if ops:
+        _rollup.bulk_write(ops, ordered=False)
+
+    return len(ops)
+
+
+def seed_probe_rollup(v) -> int:
+    """
+    for the cli, before an import adds its new ips: pictures stored before
+    the importers kept the rollup are counted once when there is none
+    """
+    _rollup = TableSelector.get_probe_rollup_table(name='default_sync')
+    _rollup.create_index(_ROLLUP_INDEX, unique=True)
+    if _rollup.find_one({'v': str(v)}) is not None:
+        return 0
+
+    _table = TableSelector.get_ip_picture(v, name='default_sync')
+    ops = _seed_ops(v, _table.aggregate(_ROLLUP_PIPE))
+    if ops:
+        _rollup.bulk_write(ops, ordered=False)
+
+    logger.info(f'seeded ipv{v} probe rollup with rows={len(ops)}')
+    return len(ops)
+
+
+async def _load_probe_rollup(v, version):
+    _table = TableSelector.get_probe_rollup_table()
+    rows = [cur async for cur in _table.find({'v': str(v)}, {'_id': 0})]
+
+    if not rows:
+        # deployed before the importers kept the rollup, counted once and
+        # stored, rows an importer or another worker seeded meanwhile are kept
+        logger.warning(f'no ipv{v} probe rollup, counting the pictures')
+        _pictures = TableSelector.get_ip_picture(v)
+        ops = _seed_ops(v, [cur async for cur in _pictures.aggregate(_ROLLUP_PIPE)])
+
+        if ops:
+            await _table.create_index(_ROLLUP_INDEX, unique=True)
+            await _table.bulk_write(ops, ordered=False)
+
+        rows = [cur async for cur in _table.find({'v': str(v)}, {'_id': 0})]
+
+    logger.debug(f'loaded probe rollup rows={len(rows)}, v={v}, version={version}')
+    return ProbeRollup(v, rows)
+
+
+probe_rollups = {
+    '4': VersionedLoader(picture_version('4'), partial(_load_probe_rollup, '4')),
+    '6': VersionedLoader(picture_version('6'), partial(_load_probe_rollup, '6')),
+}
+
+
+async def get_probe_rollup(v) -> ProbeRollup:
+    return await probe_rollups[str(v)].get()
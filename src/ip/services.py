@@ -1,6 +1,7 @@
+import numpy as np
 from datetime import datetime
 from dateutil.rrule import rrule, YEARLY
-from utils.misc import ip_to_str
+from utils.misc import ip_to_str, str_to_int_v4, str_to_exploded_ipv6
 
 
 def _get_diff_date(_start: int, _end: int):
@@ -37,6 +38,25 @@ def convert_map(v: str, items: list) -> list:
     return convert_v6_map(items)
 
 
+def convert_trend(v: str, cc_map: dict) -> dict:
+    if str(v) == '4':
+        return cc_map
+
+    for trend in cc_map.values():
+        for _t in trend:
+            _t['count'] = _t['count'] * (2 ** 64)
+
+    return cc_map
+
+
+def to_picture_key(v, ip: str):
+    # ip as stored in vis_ipv4_picture/vis_ipv6_picture, None if invalid
+    try:
+        return str_to_int_v4(ip) if str(v) == '4' else str_to_exploded_ipv6(ip)
+    except ValueError:
+        return None
+
+
 def convert_picture(v, item: dict) -> dict:
     for k in item:
         if item[k] == 'Unknown':
@@ -96,3 +116,43 @@ def convert_prefix(item: dict, v) -> dict:
         item['count'] = int(item['count'] * (2 ** 64))
 
     return item
+
+
+def downsample_netflow(rows: list, keys: list, max_points: int) -> list:
+    """
+    rows are sorted by timestamp, at most max_points equal-width time
+    buckets each give the mean of every key with its min and max, the
+    timestamp of the first sample, status 1 if any sample was anomalous
+    """
+    if len(rows) <= max_points:
+        return rows
+
+    ts = np.array([r['timestamp'] for r in rows], dtype=np.int64)
+    span = int(ts[-1] - ts[0]) + 1
+
+    buckets = (ts - ts[0]) * max_points // span
+    bounds = np.r_[0, np.flatnonzero(buckets[1:] != buckets[:-1]) + 1]
+    sizes = np.diff(np.r_[bounds, len(rows)])
+
+    columns = {}
+    for key in keys:
+        values = np.array([r.get(key, 0) for r in rows], dtype=np.float64)
+        columns[key] = (np.add.reduceat(values, bounds) / sizes,
+                        np.minimum.reduceat(values, bounds),
+                        np.maximum.reduceat(values, bounds))
+
+    status = np.maximum.reduceat(np.array([r.get('status', 0) for r in rows]), bounds)
+
+    data = []
+    for i, lo in enumerate(bounds.tolist()):
+        item = {'timestamp': int(ts[lo]), 'status': int(status[i]),
+                'samples': int(sizes[i]), 'min': {}, 'max': {}}
+
+        for key, (_mean, _min, _max) in columns.items():
+            item[key] = float(_mean[i])
+            item['min'][key] = float(_min[i])
+            item['max'][key] = float(_max[i])
+
+        data.append(item)
+
+    return data
@@ -0,0 +1,150 @@
+import os
+import json
+import struct
+import logging
+import numpy as np
+from config import Config
+
+
+logger = logging.getLogger('ip.snapshot')
+
+
+class SpaceSnapshots:
+    """
+    all /ip/space snapshots in one file written by `cli.py space dump`:
+
+        8 bytes magic | uint64 header size | header json | padding | arrays
+
+    the header holds the alloc versions, the interned countries and prefixes,
+    and the row range of every snapshot key; the arrays (cc id, prefix id,
+    count) are memory-mapped, rows of a key are ordered by cc id
+    """
+
+    MAGIC = b'CSSPACE1'
+    NAME = 'space-snapshots.bin'
+    COLUMNS = (('cc', '<u2'), ('prefix', '<u4'), ('count', '<i8'))
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(Config.INDEX_DIR, self.NAME)
+        self.loaded = False
+
+        self.versions = {}
+        self.ccs = []
+        self.cc_code = {}
+        self.prefixes = []
+        self.keys = {}
+        self.arrays = {}
+
+    @staticmethod
+    def snapshot_key(v: str, date: int, tight: int = 0) -> str:
+        # same as VisIPSpace.cache_key
+        if str(v) == '6':
+            return f'{v}-{date}-{tight}'
+        return f'{v}-{date}'
+
+    @classmethod
+    def write(cls, path: str, versions: dict, countries: list, snapshots):
+        """
+        :param snapshots: iterable of (key, {cc: {prefix: count}})
+        """
+        cc_id = {cc: i for i, cc in enumerate(sorted(countries))}
+        prefix_id = {}
+        keys = {}
+        columns = {c: [] for c, _ in cls.COLUMNS}
+
+        rows = 0
+        for key, cc_map in snapshots:
+            lo = rows
+            for cc in sorted(cc_map, key=cc_id.get):
+                for _prefix, _count in cc_map[cc].items():
+                    columns['cc'].append(cc_id[cc])
+                    columns['prefix'].append(prefix_id.setdefault(_prefix, len(prefix_id)))
+                    columns['count'].append(_count)
+                    rows += 1
+
+            keys[key] = [lo, rows]
+
+        arrays = {c: np.asarray(columns[c], dtype=dtype) for c, dtype in cls.COLUMNS}
+
+        header = {'versions': versions, 'ccs': sorted(countries),
+                  'prefixes': list(prefix_id), 'keys': keys, 'arrays': {}}
+
+        # offsets are relative to the end of the padded header
+        offset = 0
+        for c, dtype in cls.COLUMNS:
+            header['arrays'][c] = [dtype, offset, len(arrays[c])]
+            offset += arrays[c].nbytes
+            offset += -offset % 8
+
+        raw = json.dumps(header).encode()
+        raw += b' ' * (-(len(raw) + 16) % 8)
+
+        tmp = f'{path}.{os.getpid()}'
+        with open(tmp, 'wb') as fd:
+            fd.write(cls.MAGIC)
+            fd.write(struct.pack('<Q', len(raw)))
+            fd.write(raw)
+
+            for c, _ in cls.COLUMNS:
+                fd.write(arrays[c].tobytes())
+                fd.write(b'\0' * (-arrays[c].nbytes % 8))
+
+        os.replace(tmp, path)
+        return rows
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            logger.info(f'no space snapshots at {self.path}')
+            return False
+
+        with open(self.path, 'rb') as fd:
+            if fd.read(8) != self.MAGIC:
+                logger.warning(f'bad space snapshots file {self.path}')
+                return False
+
+            size, = struct.unpack('<Q', fd.read(8))
+            header = json.loads(fd.read(size))
+
+        base = 16 + size
+        self.arrays = {}
+        for c, (dtype, offset, n) in header['arrays'].items():
+            if n:
+                self.arrays[c] = np.memmap(self.path, dtype=dtype, mode='r',
+                                           offset=base + offset, shape=(n,))
+            else:
+                self.arrays[c] = np.zeros(0, dtype=dtype)
+
+        self.versions = header['versions']
+        self.ccs = header['ccs']
+        self.cc_code = {cc: i for i, cc in enumerate(self.ccs)}
+        self.prefixes = header['prefixes']
+        self.keys = header['keys']
+        self.loaded = True
+
+        logger.info(f'loaded space snapshots keys={len(self.keys)}, '
+                    f'prefixes={len(self.prefixes)}, versions={self.versions}')
+        return True
+
+    def get(self, v: str, date: int, ccs, tight: int = 0, version: int = 0) -> (dict, set):
+        """
+        :return: {cc: {prefix: count}}, countries not in the file
+        """
+        ccs = set(ccs)
+        key = self.snapshot_key(v, date, tight)
+
+        if not self.loaded or self.versions.get(str(v)) != version or key not in self.keys:
+            return {}, ccs
+
+        lo, hi = self.keys[key]
+        rows = self.arrays['cc'][lo:hi]
+        _spaces = {}
+
+        for cc in ccs & self.cc_code.keys():
+            code = self.cc_code[cc]
+            start, end = np.searchsorted(rows, [code, code + 1]) + lo
+
+            _spaces[cc] = {self.prefixes[p]: int(c) for p, c in
+                           zip(self.arrays['prefix'][start:end].tolist(),
+                               self.arrays['count'][start:end].tolist())}
+
+        return _spaces, ccs - self.cc_code.keys()
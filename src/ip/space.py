@@ -0,0 +1,333 @@
+import os
+import json
+import logging
+import numpy as np
+from ipaddress import IPv6Address
+from config import Config
+from .index import AllocDataset
+
+
+logger = logging.getLogger('ip.space')
+
+
+def _add_count(cc_map: dict, cc: str, prefix: str, count: int):
+    prefixes = cc_map.setdefault(cc, {})
+    prefixes[prefix] = prefixes.get(prefix, 0) + count
+
+
+class IPv4Bitmap:
+    """
+    owner of every ipv4 /24: a uint16 country code (0 - not allocated), the
+    uint32 allocation date and the uint8 cidr of the delegation, 2 ** 24
+    slots each; the arrays are saved under Config.INDEX_DIR per alloc
+    version and memory-mapped read-only so workers share the pages
+    """
+
+    SLOTS = 2 ** 24
+    CHUNK = 2 ** 20
+    B_CIDR = 16
+    NAME = 'ipv4-bitmap'
+    FORMAT = 2  # of the meta file, files of another format are rebuilt
+    COLUMNS = ('cc', 'date', 'cidr')
+
+    def __init__(self, meta: dict, arrays: dict):
+        self.version = meta['version']
+        self.cc_table = meta['cc_table']  # code - 1 -> cc
+        self.cc_code = {cc: i + 1 for i, cc in enumerate(self.cc_table)}
+
+        # delegations larger than a /16 are kept as their own prefix
+        self.large = meta['large']  # [[prefix, cc, date, count]]
+        self.small = meta['small']  # [[/16 bucket, cc, date, count]]
+
+        self.ccs = arrays['cc']
+        self.dates = arrays['date']
+        self.cidrs = arrays['cidr']
+
+    @classmethod
+    def _paths(cls, version):
+        base = os.path.join(Config.INDEX_DIR, f'{cls.NAME}-{version}')
+        return f'{base}.json', {c: f'{base}-{c}.npy' for c in cls.COLUMNS}
+
+    @classmethod
+    def build(cls, dataset: AllocDataset):
+        cc_table = sorted(set(dataset.ccs))
+        cc_code = {cc: i + 1 for i, cc in enumerate(cc_table)}
+
+        ccs = np.zeros(cls.SLOTS, dtype=np.uint16)
+        dates = np.zeros(cls.SLOTS, dtype=np.uint32)
+        cidrs = np.zeros(cls.SLOTS, dtype=np.uint8)
+        large, small = [], []
+
+        # rows are ordered by (prefix_start, -prefix_end),
+        # so a nested delegation overwrites the one containing it
+        for i in range(len(dataset)):
+            count = dataset.counts[i]
+            cidr = 32 - int(count).bit_length() + 1
+
+            # a delegation smaller than /24 is counted into its /16 as it is
+            if count < 256:
+                small.append([dataset.starts[i] >> 16, dataset.ccs[i], dataset.dates[i], count])
+                continue
+
+            lo, hi = dataset.starts[i] >> 8, (dataset.ends[i] >> 8) + 1
+            ccs[lo:hi] = cc_code[dataset.ccs[i]]
+            dates[lo:hi] = dataset.dates[i]
+            cidrs[lo:hi] = cidr
+
+            if cidr < cls.B_CIDR:
+                large.append([dataset.prefixes[i], dataset.ccs[i], dataset.dates[i], count])
+
+        meta = {'format': cls.FORMAT, 'version': dataset.version, 'cc_table': cc_table,
+                'large': large, 'small': small}
+        return meta, {'cc': ccs, 'date': dates, 'cidr': cidrs}
+
+    @classmethod
+    def save(cls, meta: dict, arrays: dict):
+        os.makedirs(Config.INDEX_DIR, exist_ok=True)
+        meta_path, paths = cls._paths(meta['version'])
+
+        for column, path in paths.items():
+            with open(f'{path}.{os.getpid()}', 'wb') as fd:
+                np.save(fd, arrays[column])
+            os.replace(f'{path}.{os.getpid()}', path)
+
+        # meta is written last, a complete meta file means complete arrays
+        with open(f'{meta_path}.{os.getpid()}', 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(f'{meta_path}.{os.getpid()}', meta_path)
+
+    @classmethod
+    def clean(cls, version):
+        # drop files of older versions, workers still mapping them keep their pages
+        keep = f'{cls.NAME}-{version}'
+        for _file in os.listdir(Config.INDEX_DIR):
+            if not _file.startswith(f'{cls.NAME}-'):
+                continue
+
+            if _file != f'{keep}.json' and not _file.startswith(f'{keep}-'):
+                os.remove(os.path.join(Config.INDEX_DIR, _file))
+
+    @classmethod
+    def load(cls, version):
+        meta_path, paths = cls._paths(version)
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, 'r') as fd:
+            meta = json.load(fd)
+
+        if meta.get('format') != cls.FORMAT:
+            logger.info(f'{cls.NAME} with version={version} is of format={meta.get("format")}, rebuilding')
+            return None
+
+        arrays = {c: np.load(p, mmap_mode='r') for c, p in paths.items()}
+        return cls(meta, arrays)
+
+    @classmethod
+    def load_or_build(cls, dataset: AllocDataset):
+        bitmap = cls.load(dataset.version)
+        if bitmap is not None:
+            logger.debug(f'loaded {cls.NAME} with version={dataset.version}')
+            return bitmap
+
+        meta, arrays = cls.build(dataset)
+
+        try:
+            cls.save(meta, arrays)
+            cls.clean(dataset.version)
+            logger.info(f'saved {cls.NAME} with version={dataset.version}')
+
+        except OSError as e:
+            logger.warning(f'failed to save {cls.NAME} to {Config.INDEX_DIR}, err={e}')
+            return cls(meta, arrays)
+
+        return cls.load(dataset.version)
+
+    def cc_map(self, date: int, ccs) -> dict:
+        """
+        :return: {cc: {prefix: count}}, /16 buckets or the prefix itself when
+                 the delegation is larger than a /16
+        """
+        cc_map = {}
+        codes = [self.cc_code[cc] for cc in ccs if cc in self.cc_code]
+        if not codes:
+            return cc_map
+
+        n = len(codes)
+        selected = np.zeros(len(self.cc_table) + 1, dtype=bool)
+        selected[codes] = True
+        row = np.zeros(len(self.cc_table) + 1, dtype=np.int64)
+        row[codes] = np.arange(n)
+
+        # the arrays are scanned in chunks to keep the temporaries small
+        counts = np.zeros(n * 2 ** 16, dtype=np.int64)
+        for lo in range(0, self.SLOTS, self.CHUNK):
+            hi = lo + self.CHUNK
+            ccs_ = self.ccs[lo:hi]
+            slots = np.flatnonzero(selected[ccs_] &
+                                   (self.dates[lo:hi] <= date) &
+                                   (self.cidrs[lo:hi] >= self.B_CIDR))
+
+            keys = row[ccs_[slots]] * 2 ** 16 + ((slots + lo) >> 8)
+            counts += np.bincount(keys, minlength=n * 2 ** 16)
+
+        counts = counts.reshape(n, 2 ** 16) * 256
+
+        for code, _counts in zip(codes, counts):
+            cc = self.cc_table[code - 1]
+            for b in np.flatnonzero(_counts).tolist():
+                _add_count(cc_map, cc, f'{b >> 8}.{b & 255}.0.0/16', int(_counts[b]))
+
+        ccs = set(ccs)
+        for b, cc, _date, count in self.small:
+            if cc in ccs and _date <= date:
+                _add_count(cc_map, cc, f'{b >> 8}.{b & 255}.0.0/16', count)
+
+        for prefix, cc, _date, count in self.large:
+            if cc in ccs and _date <= date:
+                _add_count(cc_map, cc, prefix, count)
+
+        return cc_map
+
+
+class IPv6Space:
+    """
+    ipv6 delegations as sorted columns: the 128-bit start split into hi/lo
+    uint64, the count of /64s, the date and the country code, grouped into
+    /20 (straight) or /24 (tight) buckets per country for any date
+    """
+
+    NAME = 'ipv6-space'
+    TIGHT_CIDR = 24
+    STRAIGHT_CIDR = 20
+
+    def __init__(self, dataset: AllocDataset):
+        self.version = dataset.version
+        self.cc_table = sorted(set(dataset.ccs))
+        self.cc_code = {cc: i for i, cc in enumerate(self.cc_table)}
+
+        starts = dataset.starts
+        self.hi = np.array([s >> 64 for s in starts], dtype=np.uint64)
+        self.lo = np.array([s & 0xFFFFFFFFFFFFFFFF for s in starts], dtype=np.uint64)
+        self.counts = np.asarray(dataset.counts, dtype=np.int64)
+        self.dates = np.asarray(dataset.dates, dtype=np.int64)
+        self.ccs = np.array([self.cc_code[cc] for cc in dataset.ccs], dtype=np.int64)
+
+        # counts are in /64s, a /64 or longer delegation counts 1
+        self.cidrs = 64 - (np.array([int(c).bit_length() for c in dataset.counts],
+                                    dtype=np.int64) - 1)
+        self.prefixes = dataset.prefixes
+
+    @staticmethod
+    def bucket_prefix(bucket: int, cidr: int) -> str:
+        return f'{IPv6Address(bucket << (128 - cidr))}/{cidr}'
+
+    def cc_map(self, date: int, ccs, tight: int = 0) -> dict:
+        """
+        :return: {cc: {prefix: count}}, same keys as prefix_tight/prefix_straight
+        """
+        cc_map = {}
+        codes = [self.cc_code[cc] for cc in ccs if cc in self.cc_code]
+        if not codes:
+            return cc_map
+
+        cidr = self.TIGHT_CIDR if tight else self.STRAIGHT_CIDR
+
+        selected = np.zeros(len(self.cc_table), dtype=bool)
+        selected[codes] = True
+        rows = np.flatnonzero(selected[self.ccs] & (self.dates <= date))
+
+        # delegations larger than the bucket are kept as their own prefix
+        large = rows[self.cidrs[rows] < cidr]
+        for i in large.tolist():
+            _add_count(cc_map, self.cc_table[self.ccs[i]], self.prefixes[i], int(self.counts[i]))
+
+        rows = rows[self.cidrs[rows] >= cidr]
+        if not len(rows):
+            return cc_map
+
+        keys = self.ccs[rows] * 2 ** cidr + (self.hi[rows] >> np.uint64(64 - cidr)).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+
+        bounds = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1]
+        sums = np.add.reduceat(self.counts[rows][order], bounds)
+
+        for key, count in zip(keys[bounds].tolist(), sums.tolist()):
+            code, bucket = divmod(key, 2 ** cidr)
+            _add_count(cc_map, self.cc_table[code], self.bucket_prefix(bucket, cidr), count)
+
+        return cc_map
+
+
+class SpaceMatrix:
+    """
+    country x prefix count matrix with interned prefix ids, the country
+    owning a prefix is the argmax of its column, ties go to the country
+    seen first, or of the lowest rank when ranks are given
+    """
+
+    def __init__(self, ccs: list, prefixes: list, rows: list, cols: list, counts: list,
+                 ranks: list = None):
+        self.ccs = ccs
+        self.prefixes = prefixes
+
+        _index = (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))
+        self.matrix = np.zeros((len(ccs), len(prefixes)), dtype=np.int64)
+        np.add.at(self.matrix, _index, np.asarray(counts, dtype=np.int64))
+
+        self.ranks = None
+        if ranks is not None:
+            self.ranks = np.full(self.matrix.shape, np.iinfo(np.int64).max, dtype=np.int64)
+            self.ranks[_index] = np.asarray(ranks, dtype=np.int64)
+
+    @classmethod
+    def from_cc_map(cls, cc_map: dict):
+        # {cc: {prefix: count}}
+        prefix_id = {}
+        rows, cols, counts = [], [], []
+
+        for row, prefixes in enumerate(cc_map.values()):
+            for _prefix, _count in prefixes.items():
+                rows.append(row)
+                cols.append(prefix_id.setdefault(_prefix, len(prefix_id)))
+                counts.append(_count)
+
+        return cls(list(cc_map), list(prefix_id), rows, cols, counts)
+
+    @classmethod
+    def from_prefix_map(cls, prefix_map: dict):
+        # {prefix: {cc: count}}, a prefix without countries is left out and
+        # ties go to the country first in the prefix's own dict
+        cc_id = {}
+        prefixes = []
+        rows, cols, counts, ranks = [], [], [], []
+
+        for _prefix, ccs in prefix_map.items():
+            if not ccs:
+                continue
+
+            for rank, (_cc, _count) in enumerate(ccs.items()):
+                rows.append(cc_id.setdefault(_cc, len(cc_id)))
+                cols.append(len(prefixes))
+                counts.append(_count)
+                ranks.append(rank)
+            prefixes.append(_prefix)
+
+        return cls(list(cc_id), prefixes, rows, cols, counts, ranks)
+
+    def winners(self) -> list:
+        if not self.prefixes:
+            return []
+
+        if self.ranks is None:
+            owners = self.matrix.argmax(axis=0).tolist()
+        else:
+            # only the countries of a prefix compete for it
+            _last = np.iinfo(np.int64).max
+            _counts = np.where(self.ranks < _last, self.matrix, np.iinfo(np.int64).min)
+            _best = _counts == _counts.max(axis=0)
+            owners = np.where(_best, self.ranks, _last).argmin(axis=0).tolist()
+
+        return [{'prefix': _prefix, 'country': self.ccs[_owner]}
+                for _prefix, _owner in zip(self.prefixes, owners)]
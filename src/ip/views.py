@@ -1,5 +1,9 @@
-from fastapi import APIRouter, Depends, Response
+import asyncio
+from fastapi import APIRouter, Depends, Response, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional
 import orjson
+import gzip
 import time
 import math
 import logging
@@ -17,17 +21,24 @@ from .models import (
     IPSpaceQuery,
     IPPrefixInfoCountryQuery,
     IPNetflowQuery,
-    VisIPMap,
+    IPNetflowTopQuery,
+    IPNetflowAnomalyQuery,
+    IPLookupQuery,
+    IPLookupBatchBody,
+    IPEnrichQuery,
+    IPEnrichResultQuery,
     ProbePictureQuery,
+    ProbePictureBatchBody,
     VisIPSpace,
-    VisIPTrend,
     ProbeMapQuery,
     IPv4_RANGE,
-    IPv6_RANGE
+    IPv6_RANGE,
+    VIS_IP_NETFLOW_KEYS,
+    NETFLOW_BUCKETS,
+    VisIPNetflow
 )
 from database.models import (
-    TableSelector,
-    VisCache
+    TableSelector
 )
 from utils.misc import (
     to_list,
@@ -36,6 +47,8 @@ from utils.misc import (
     get_b_subnets_v4,
     ip_to_str,
     extract_limit_offset_from_args,
+    encode_cursor,
+    decode_cursor,
     str_to_int_v4,
     str_to_exploded_ipv6,
     Regions,
@@ -44,18 +57,41 @@ from .services import (
     _get_diff_date,
     convert_map,
     convert_picture,
-    _add_to_cc_map,
+    to_picture_key,
+    downsample_netflow,
+    convert_trend,
     _add_to_prefix_map,
     convert_prefix
 )
+from .index import (
+    get_alloc_dataset,
+    alloc_datasets,
+    ip_to_int,
+    AllocCube,
+    get_ip_trends,
+    get_country_prefixes
+)
+from .space import IPv4Bitmap, IPv6Space
+from .snapshot import SpaceSnapshots
+from .warmup import space_warmer
+from .picture import get_picture_filter, get_probe_rollup
+from .netflow import get_netflow_top, get_netflow_anomalies
+from .lpm import get_prefix_matcher
+from .enrich import EnrichJob, ENRICH_FIELDS
 from utils.request import IPBaseQuery
-from decorators import time_cost
+from utils.lru import BytesLRUCache
 from config import Config
 
 
 router = APIRouter(prefix='/ip')
 logger = logging.getLogger('ip.views')
 
+# serialized /ip/space responses of the current alloc version
+space_responses = BytesLRUCache(Config.SPACE_RESPONSE_CACHE_BYTES)
+
+# precomputed snapshots written by `cli.py space dump`
+space_snapshots = SpaceSnapshots()
+
 # TODO:
 # HK, MO, TW -> CN
 
@@ -76,16 +112,13 @@ async def prefix_info(args: IPPrefixInfoQuery = Depends()):
     }
     """
 
-    _table = TableSelector.get_prefix_alloc_table(args.v)
-
     cc_map = {}  # {cc: {count: 0, subnets: []}
     _left, _right = subnet_range(args.prefix, args.v)
 
-    q = {'prefix_start': {'$gte': _left},
-         'prefix_end': {'$lte': _right},
-         'date': {'$lte': args.date}}
+    if None in [_left, _right]:
+        return {'data': [], 'status': 'ok', 'message': 'invalid prefix'}
 
-    logger.debug(f'q={q}')
+    _left, _right = ip_to_int(_left, args.v), ip_to_int(_right, args.v)
     _cidr = int(args.prefix.split('/')[-1])
 
     if args.v == '4':
@@ -94,33 +127,27 @@ async def prefix_info(args: IPPrefixInfoQuery = Depends()):
     else:
         _count = 2 ** (64 - _cidr)
 
-    async for cur in _table.find(q):
-        if cur['cc'] not in cc_map:
-            cc_map[cur['cc']] = {'count': cur['count'],
-                                 'prefixes': [cur['prefix']],
-                                 'country': cur['cc']}
-
-        else:
-            cc_map[cur['cc']]['count'] += cur['count']
-            cc_map[cur['cc']]['prefixes'].append(cur['prefix'])
+    _dataset = await get_alloc_dataset(args.v)
 
-    if not cc_map:
+    for i in _dataset.contained(_left, _right, args.date):
+        _cc = _dataset.ccs[i]
 
-        q = {'prefix_start': {'$lte': _left},
-             'prefix_end': {'$gte': _right},
-             'date': {'$lte': args.date}}
+        if _cc not in cc_map:
+            cc_map[_cc] = {'count': _dataset.counts[i],
+                           'prefixes': [_dataset.prefixes[i]],
+                           'country': _cc}
 
-        logger.debug(f'contain_q={q}')
+        else:
+            cc_map[_cc]['count'] += _dataset.counts[i]
+            cc_map[_cc]['prefixes'].append(_dataset.prefixes[i])
 
-        async for cur in _table.find(q).sort('prefix_start', -1).limit(1):
-            if cur['cc'] not in cc_map:
-                cc_map[cur['cc']] = {'count': _count,
-                                     'prefixes': [args.prefix],
-                                     'country': cur['cc']}
+    if not cc_map:
+        i = _dataset.containing(_left, _right, args.date)
 
-            else:
-                cc_map[cur['cc']]['count'] += cur['count']
-                cc_map[cur['cc']]['prefixes'].append(cur['prefix'])
+        if i is not None:
+            cc_map[_dataset.ccs[i]] = {'count': _count,
+                                       'prefixes': [args.prefix],
+                                       'country': _dataset.ccs[i]}
 
     cc_list = sorted(list(cc_map.items()), key=lambda x: x[1]['count'], reverse=True)
 
@@ -135,7 +162,8 @@ async def prefix_info(args: IPPrefixInfoQuery = Depends()):
 @router.get('/prefix/country')
 async def prefix_info_country(args: IPPrefixInfoCountryQuery = Depends()):
     """
-    :param args: v, date, country, page_size, page
+    :param args: v, date, country, page_size, page, cursor(next_cursor of
+                 the previous page, page is ignored when it is given)
     :return:
     {
     "data": [{
@@ -143,31 +171,40 @@ async def prefix_info_country(args: IPPrefixInfoCountryQuery = Depends()):
         "count": 89
     }],
     "status": "",
-    "message": ""
+    "message": "",
+    "total": 1,
+    "next_cursor": "WyI4OSIsICIxMDAiXQ=="
     }
     """
 
-    _table = TableSelector.get_prefix_alloc_table(args.v)
-
-    q = {'cc': args.country, 'date': {'$lte': args.date}}
     _limit, _offset = extract_limit_offset_from_args(args)
 
-    logger.debug(f'q={q}, limit={_limit}, offset={_offset}')
+    _after = None
+    if args.cursor:
+        _after = decode_cursor(args.cursor)
 
-    data = []
-    async for cur in _table.find(q).sort('count', -1).\
-            skip(_offset).limit(_limit):
+        try:
+            _after = int(_after[0]), int(_after[1])
+        except (TypeError, ValueError, IndexError):
+            return {'data': [], 'status': 'ok', 'message': 'invalid cursor'}
 
-        item = {
-            'prefix': cur['prefix'],
-            'count': cur['count']
-        }
-        data.append(item)
+    logger.debug(f'cc={args.country}, date={args.date}, limit={_limit}, '
+                 f'offset={_offset}, after={_after}')
+
+    _prefixes = await get_country_prefixes(args.v)
+    _dataset = _prefixes.dataset
+
+    rows, more = _prefixes.page(args.country, args.date, _limit, _offset, _after)
 
-    _total = await _table.count_documents(q)
+    data = [{'prefix': _dataset.prefixes[i], 'count': _dataset.counts[i]} for i in rows]
 
-    data = sorted(data, key=lambda x: x['count'], reverse=True)
-    return {'data': data, 'status': 'ok', 'message': '', 'total': _total}
+    _next = None
+    if rows and more:
+        _next = encode_cursor([_dataset.counts[rows[-1]], _dataset.starts[rows[-1]]])
+
+    return {'data': data, 'status': 'ok', 'message': '',
+            'total': _prefixes.total(args.country, args.date),
+            'next_cursor': _next}
 
 
 @router.get('/trends')
@@ -175,7 +212,7 @@ async def ip_trends(args: IPTrendsQuery = Depends()):
     """
     todo: only have cn as parameter, cannot have its son as parameter
     todo: think about aggregations of data
-    :param args: v, countries
+    :param args: v, countries, granularity(day|year)
     :return:
     {
     "data": {
@@ -193,61 +230,19 @@ async def ip_trends(args: IPTrendsQuery = Depends()):
     }
     """
 
-    _table = TableSelector.get_prefix_alloc_table(args.v)
-
     cc = to_list(args.countries, raise_error=False, fn=str.upper)
     if not args.countries or not cc:
         return {'data': {}, 'status': 'ok', 'message': 'no countries provided'}
 
-    _cached, _left = await VisIPTrend.get_trend(args.v, cc)
-    logger.debug(f'cached={len(_cached)}, left={len(_left)}')
-
-    if _cached and not _left:
-        return {'data': VisIPTrend.convert_trend(args.v, _cached),
-                'status': 'ok', 'message': ''}
-
-    q = {'cc': {'$in': list(_left)}}
-    cc_map = {}
-
-    async for cur in _table.find(q):
-
-        if cur['cc'] not in cc_map:
-            cc_map[cur['cc']] = []
+    _yearly = args.granularity == 'year'
+    _trends = await get_ip_trends(args.v, yearly=_yearly)
 
-        cc_map[cur['cc']].append(dict(date=cur['date'], count=cur['count']))
-
-    cc_hills = {}
-    logger.debug(f'got cc_map={len(cc_map)}')
-
-    for cc, tlist in cc_map.items():
-        ordered = sorted(tlist, key=lambda x: x['date'], reverse=False)
-
-        hills = []
-        addup = 0
-        last_ts = None
-
-        for t in ordered:
-            addup += t['count']
-
-            if last_ts == t['date']:
-                hills[-1]['count'] = addup
-            else:
-                hills.append({'date': t['date'], 'count': addup})
-
-            last_ts = t['date']
-
-        cc_hills[cc] = hills
-
-    VisIPTrend.insert_trend(args.v, cc_hills)
-    _cached.update(cc_hills)
-
-    return {'data': VisIPTrend.convert_trend(args.v, _cached),
+    return {'data': convert_trend(args.v, _trends.get_many(cc, skip_zero=_yearly)),
             'status': 'ok', 'message': ''}
 
 
 @router.get('/map')
 async def ip_map(args: IPQueryWithTime = Depends()):
-    # todo can use trend table
     """
     :param args:  v, date
     :return:
@@ -261,76 +256,66 @@ async def ip_map(args: IPQueryWithTime = Depends()):
         "message": ""
     }
     """
-    _map = await VisIPMap.get_latest_map(args.v, args.date)
-    if _map:
+    _cube = (await get_alloc_dataset(args.v)).derive('cube', AllocCube)
+    data = convert_map(args.v, _cube.get_map(args.date))
 
-        if _map['v'] == args.v and _map['date'] == args.date:
-            return {'data': convert_map(args.v, _map['data']),
-                    'status': 'ok', 'message': ''}
+    return {'data': data, 'message': '', 'status': 'ok'}
 
-        else:
-            _addup_map = await VisIPMap.addup_to_date(args.v, _map['date'], args.date, _map['data'])
-            return {'data': convert_map(args.v, _addup_map),
-                    'status': 'ok', 'message': ''}
 
-    _table = TableSelector.get_prefix_alloc_table(args.v)
+SpaceArgs = namedtuple('SpaceArgs',
+                       ['v', 'date', 'countries',
+                        'refresh', 'tight', 'force_cache'])
 
-    _q = {}
-    pipe = [
-        {'$match': {'date': {'$lte': args.date}}},
-        {'$group': {'_id': '$cc',
-                    'ips': {'$sum': '$count'},
-                    'prefixes': {'$sum': 1}}},
-        {'$sort': {'ips': -1}}
-    ]
 
-    data = []
-    logger.debug(f'pipe={pipe}')
+async def _ip_index_init():
+    logger.debug('init ip index ...')
 
-    async for cur in _table.aggregate(pipe):
-        if cur['_id'] in {'HK', 'MO', 'TW', ''}:
-            logger.debug(f"got watched region={cur}")
-            continue
+    for _loader in alloc_datasets.values():
+        await _loader.get()
 
-        item = dict(
-            country=cur['_id'],
-            ips=cur['ips'],
-            prefixes=cur['prefixes']
-        )
+    await (await get_alloc_dataset('4')).derive_in_thread(IPv4Bitmap.NAME, IPv4Bitmap.load_or_build)
+    await (await get_alloc_dataset('6')).derive_in_thread(IPv6Space.NAME, IPv6Space)
 
-        data.append(item)
+    logger.debug('finished init ip index ...')
 
-    data = sorted(data, key=lambda x: x['ips'], reverse=True)
-    await VisIPMap.insert_map(args.v, args.date, data)
 
-    data = convert_map(args.v, data)
-    return {'data': data, 'message': '', 'status': 'ok'}
+def _ip_enrich_init():
+    # no task of this worker runs the jobs left by the one before it
+    EnrichJob.fail_orphans()
 
 
-SpaceArgs = namedtuple('SpaceArgs',
-                       ['v', 'date', 'countries',
-                        'refresh', 'tight', 'force_cache'])
+def _ip_snapshot_init():
+    # mapping the file is cheap, missing keys are computed on request
+    if not space_snapshots.load():
+        logger.warning('no space snapshots, /ip/space is computed on request')
+
+
+async def _warm_space(v: str, date: int, tight: int = 0):
+    args = SpaceArgs(v=v, date=date, countries=Config.SPACE_WARMUP_COUNTRIES,
+                     refresh=0, tight=tight, force_cache=0)
+    await _ip_space(args)
 
 
-@time_cost()
-async def _ip_space_init(cache_reuse=1):
+def _ip_space_warmup():
+    # runs in the background, cold keys are still computed on request
+    keys = [('4', _date, 0) for _date in IPv4_RANGE]
+    keys += [('6', _date, _tight) for _tight in [0, 1] for _date in IPv6_RANGE]
 
-    countries = 'US,CN,JP,DE,GB,KR,BR,FR,CA,IT'
-    logger.debug('init ip space ...')
+    logger.debug(f'start warming ip space, keys={len(keys)}')
+    return space_warmer.start(keys, _warm_space)
 
-    for _date in IPv4_RANGE:
-        args = SpaceArgs(v='4', date=_date, countries=countries,
-                         refresh=1, tight=0, force_cache=cache_reuse)
-        await _ip_space(args)
 
-    for _tight in [0, 1]:
-        for _date in IPv6_RANGE:
+async def _space_cc_map(v: str, date: int, ccs, tight: int = 0) -> dict:
+    _dataset = await get_alloc_dataset(v)
 
-            args = SpaceArgs(v='6', date=_date, countries=countries,
-                             refresh=1, tight=_tight, force_cache=cache_reuse)
-            await _ip_space(args)
+    # built by `cli.py alloc import`, loaded or built in a thread otherwise;
+    # the scans run in a thread too, requests are served while warming
+    if v == '4':
+        _bitmap = await _dataset.derive_in_thread(IPv4Bitmap.NAME, IPv4Bitmap.load_or_build)
+        return await asyncio.to_thread(_bitmap.cc_map, date, ccs)
 
-    logger.debug('finished init ...')
+    _space = await _dataset.derive_in_thread(IPv6Space.NAME, IPv6Space)
+    return await asyncio.to_thread(_space.cc_map, date, ccs, tight)
 
 
 async def _ip_space(args):
@@ -361,133 +346,309 @@ async def _ip_space(args):
     if not cc:
         return {'data': [], 'status': 'ok', 'message': ''}
 
-    _cached = {}  # {cc: {prefix: count}}}
-    _found = False
-    _found_date = 0
-    _found_cc = set()
-    _left_cc = set()
+    _cached = {}  # {cc: {prefix: count}}
+    _compute_cc = set(cc)
+    _version = (await get_alloc_dataset(args.v)).version
 
+    if not args.refresh or args.force_cache:
+        _cached, _compute_cc = space_snapshots.get(args.v, args.date, cc,
+                                                   args.tight, _version)
+        if _compute_cc:
+            _found, _compute_cc = await VisIPSpace.get_country_spaces(
+                args.v, args.date, _compute_cc, args.tight, _version)
+            _cached.update(_found)
+
+        logger.debug(f'got one={len(_cached)}, left={_compute_cc}, '
+                     f'date={args.date}, v={args.v}')
+
+        if not args.refresh and not _compute_cc:
+            _cache_key = VisIPSpace.cache_key(args.v, args.date, args.tight)
+            return {'data': VisIPSpace.get_winners(_cache_key, _cached, _version),
+                    'status': 'ok', 'message': '',
+                    'found_date': args.date}
+
+    # only the countries without a snapshot are computed, in one pass
+    _computed = {}
+    if _compute_cc:
+        tick = time.time()
+        _computed = await _space_cc_map(args.v, args.date, _compute_cc, args.tight)
+        logger.debug(f'cost={time.time() - tick}, cc={_compute_cc}')
+
+        # a country without any allocation is stored empty, not computed again
+        for _cc in _compute_cc:
+            _computed.setdefault(_cc, {})
+
+        _cached.update(_computed)
+
+    # arbitrary dates are not stored, only the snapshot dates or a refresh
     _latest_date = VisIPSpace.get_latest_date(args.v, args.date)
+    if _computed and (args.refresh or _latest_date == args.date):
+        await VisIPSpace.insert_country_spaces(args.v, args.date, _computed,
+                                               tight=args.tight, version=_version)
 
-    if not args.refresh or args.force_cache:
+    return {'data': await asyncio.to_thread(VisIPSpace.convert_cc_map, _cached),
+            'status': 'ok', 'message': ''}
 
-        _found, _cached, _found_date, _left_cc, _found_cc = await VisIPSpace.get_latest_space2(
-            args.v, args.date, cc, args.tight)
 
-        logger.debug(f'got one={len(_cached)}, left={_left_cc}, '
-                     f'found_date={_found_date}, date={args.date}, '
-                     f'found_cc={_found_cc}, v={args.v}')
+def _space_response_key(args) -> tuple:
+    # (v, resolved date, sorted countries, tight)
+    _end = Config.IPv4_ALLOC_END if args.v == '4' else Config.IPv6_ALLOC_END
+    cc = sorted(set(to_list(args.countries, fn=str.upper, raise_error=False)))
+    return args.v, min(args.date, _end), tuple(cc), args.tight if args.v == '6' else 0
 
-        if not args.refresh and _found and _found_date == args.date and not _left_cc:
-            return {'data': VisIPSpace.convert_cc_map(_cached),
-                    'status': 'ok', 'message': '',
-                    'found_date': _found_date}
 
-    if args.v == '4':
-        _q_prefix = '$prefix_b'
+def _encode_space_response(data: dict) -> tuple:
+    # (json, gzipped json or None), run in a thread for the tens of thousands of prefixes
+    raw = orjson.dumps(data)
+    gz = gzip.compress(raw, compresslevel=6) if Config.SPACE_RESPONSE_GZIP else None
+    return raw, gz
 
-    else:
-        if args.tight:
-            _q_prefix = '$prefix_tight'
-        else:
-            _q_prefix = '$prefix_straight'
 
-    if not _found:
-        _q_cc = cc
+def _space_response(raw: bytes, gz: Optional[bytes], request: Request) -> Response:
+    if gz is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        return Response(gz, media_type='application/json',
+                        headers={'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
 
-    else:
-        if _left_cc:
-            _q_cc = _left_cc
-        else:
-            _q_cc = set()
+    return Response(raw, media_type='application/json')
+
+
+@router.get("/space")
+async def ip_space(request: Request, args: IPSpaceQuery = Depends()):
+    """
+    :param args: v, date, countries，tight(1 - tight - /24; 0 - not tight - /20),
+                 refresh, force_cache
+    :return:
+    {
+    "data": [{
+        "country": "CN",
+        "prefix": "1.1.0.0/16"
+    }],
+    "status": "ok",
+    "message": ""
+    }
+    """
+    _key = _space_response_key(args)
+    space_warmer.hit((_key[0], _key[1], _key[3]))
+    _version = (await get_alloc_dataset(args.v)).version
 
-    _addup_cc = set()
-    if _found and _found_date < args.date:
-        _addup_cc = _found_cc
+    if not args.refresh:
+        _cached = space_responses.get(_key, _version)
+        if _cached is not None:
+            return _space_response(*_cached, request)
 
-    _table = TableSelector.get_prefix_alloc_table(args.v)
+    data = await _ip_space(args)
 
-    if _q_cc:
-        pipe = [
-            {'$match': {'cc': {'$in': list(_q_cc)},
-                        'date': {'$lte': args.date}}},
-            {'$group': {'_id': {'cc': '$cc', 'prefix': _q_prefix},
-                        'count': {'$sum': '$count'}}}
-        ]
+    raw, gz = await asyncio.to_thread(_encode_space_response, data)
+    space_responses.set(_key, _version, (raw, gz))
 
-        logger.debug(f'q={pipe}')
+    return _space_response(raw, gz, request)
 
-        tick = time.time()
-        idx = 0
 
-        async for cur in _table.aggregate(pipe):
-            idx += 1
-            _add_to_cc_map(_cached, cur['_id']['prefix'], cur['_id']['cc'], cur['count'])
+async def _read_netflow_samples(ip: str, start: int = None, end: int = None) -> list:
+    _table = TableSelector.get_ip_netflow_table()
+    q = {'ip': ip}
 
-        logger.debug(f'cost={time.time() - tick}, rows = {idx}')
+    _range = {}
+    if start is not None:
+        _range['$gte'] = start
+    if end is not None:
+        _range['$lte'] = end
+    if _range:
+        q['timestamp'] = _range
 
-    if _addup_cc:
-        addup_pipe = [
-            {'$match': {'cc': {'$in': list(_addup_cc)},
-                        'date': {'$lte': args.date,
-                                 '$gt': _found_date}}},
-            {'$group': {'_id': {'cc': '$cc', 'prefix': _q_prefix},
-                        'count': {'$sum': '$count'}}}
-        ]
-        logger.debug(f'addup_pipe={addup_pipe}')
+    logger.debug(f'q={q}')
 
-        tick = time.time()
-        addup_idx = 0
+    # served in order by the (ip, timestamp) index
+    return [cur async for cur in _table.find(q, {'_id': 0, 'n': 0, 'ip': 0}).sort('timestamp', 1)]
 
-        async for cur in _table.aggregate(addup_pipe):
-            addup_idx += 1
-            _add_to_cc_map(_cached, cur['_id']['prefix'], cur['_id']['cc'], cur['count'])
 
-        logger.debug(f'cost={time.time() - tick}, addup_row = {addup_idx}')
+async def _read_netflow_buckets(ip: str, start: int = None, end: int = None) -> list:
+    _table = TableSelector.get_ip_netflow_bucket_table()
+    _seconds = NETFLOW_BUCKETS[Config.NETFLOW_BUCKET]
+    q = {'ip': ip, 'seconds': _seconds}
 
-    if args.refresh:
-        await VisIPSpace.insert_space(args.v, args.date, _cached,
-                                      left={}, tight=args.tight, cc=cc)
+    # a bucket starting before start may still hold samples of the range
+    _range = {}
+    if start is not None:
+        _range['$gt'] = start - _seconds
+    if end is not None:
+        _range['$lte'] = end
+    if _range:
+        q['bucket'] = _range
 
-    return {'data': VisIPSpace.convert_cc_map(_cached),
-            'status': 'ok', 'message': ''}
+    logger.debug(f'q={q}')
 
+    data = []
+    async for cur in _table.find(q, {'_id': 0}).sort('bucket', 1):
+        data += VisIPNetflow.unpack_bucket(cur)
 
-@router.get("/space")
-async def ip_space(args: IPSpaceQuery = Depends()):
+    return [_d for _d in data
+            if (start is None or _d['timestamp'] >= start) and
+            (end is None or _d['timestamp'] <= end)]
+
+
+@router.get('/lookup')
+async def ip_lookup(args: IPLookupQuery = Depends()):
     """
-    :param args: v, date, countries，tight(1 - tight - /24; 0 - not tight - /20),
-                 refresh, force_cache
-    :return:
+    :param args: v, ip
+    :return: the most specific delegation covering the ip
+    {
+    "data": {
+        "prefix": "1.0.0.0/24",
+        "country": "AU",
+        "registry": "apnic",
+        "status": "assigned",
+        "date": 20110811
+    },
+    "status": "ok",
+    "message": ""  # or not matched, invalid ip
+    }
+    """
+    _matcher = await get_prefix_matcher(args.v)
+    item = _matcher.match([args.ip])[0]
+    return {'data': item['data'], 'status': 'ok', 'message': item['message']}
+
+
+@router.post('/lookup/batch')
+async def ip_lookup_batch(body: IPLookupBatchBody):
+    """
+    :param body: {"v": "4", "ips": ["1.1.1.1", "1.1.1.2"]}
+    :return: in the order of ips
     {
     "data": [{
-        "country": "CN",
-        "prefix": "1.1.0.0/16"
+        "ip": "1.1.1.1",
+        "data": {...},  # as /lookup
+        "message": ""  # or not matched, invalid ip
     }],
     "status": "ok",
     "message": ""
     }
     """
-    data = await _ip_space(args)
-    #return data
-    return Response(orjson.dumps(data), media_type='application/json')
+    if len(body.ips) > Config.IP_LOOKUP_BATCH_MAX:
+        return {'data': [], 'status': 'ok',
+                'message': f'too many ips, at most {Config.IP_LOOKUP_BATCH_MAX}'}
+
+    logger.debug(f'batch lookup ips={len(body.ips)}, v={body.v}')
+    _matcher = await get_prefix_matcher(body.v)
+    return {'data': _matcher.match(body.ips), 'status': 'ok', 'message': ''}
+
+
+@router.post('/enrich')
+async def ip_enrich(request: Request, args: IPEnrichQuery = Depends()):
+    """
+    :param request: the body is the file itself, one ip per line or a csv
+                    with the ip in the first column
+    :param args: v, fields (of delegation, path, picture)
+    :return: the job, enriched in chunks in the background
+    {
+    "data": {"id": "...", "status": "running", "total": 1000000, "processed": 0, ...},
+    "status": "ok",
+    "message": ""
+    }
+    """
+    fields = [_f for _f in to_list(args.fields, raise_error=False, fn=str.strip) if _f]
+    if not fields or set(fields) - set(ENRICH_FIELDS):
+        return {'data': {}, 'status': 'ok', 'message': f'fields should be of {",".join(ENRICH_FIELDS)}'}
+
+    job = EnrichJob.create(args.v, fields)
+
+    try:
+        await job.upload(request.stream())
+
+    except ValueError as e:
+        state = job.save_state(status='failed', error=str(e))
+        return {'data': state, 'status': 'ok', 'message': str(e)}
+
+    job.start()
+    return {'data': job.state(), 'status': 'ok', 'message': ''}
+
+
+@router.get('/enrich/{job_id}')
+async def ip_enrich_state(job_id: str):
+    # the progress of a job, from any worker
+    job = EnrichJob.get(job_id)
+    if job is None:
+        return {'data': {}, 'status': 'ok', 'message': 'job not found'}
+
+    return {'data': job.state(), 'status': 'ok', 'message': ''}
+
+
+@router.get('/enrich/{job_id}/result')
+async def ip_enrich_result(job_id: str, args: IPEnrichResultQuery = Depends()):
+    """
+    :param args: format, ndjson - a line per ip as
+                 {"ip", "message", "delegation", "path", "picture"},
+                 csv - the same flattened, the picture as json
+    """
+    job = EnrichJob.get(job_id)
+    if job is None:
+        return {'data': {}, 'status': 'ok', 'message': 'job not found'}
+
+    state = job.state()
+    if state['status'] != 'done':
+        return {'data': state, 'status': 'ok', 'message': 'job is not done'}
+
+    media_type = 'application/x-ndjson' if args.format == 'ndjson' else 'text/csv'
+    headers = {'Content-Disposition': f'attachment; filename="{job_id}.{args.format}"'}
+    return StreamingResponse(job.iter_result(args.format), media_type=media_type, headers=headers)
 
 
 @router.get('/netflow')
 async def ip_netflow(args: IPNetflowQuery = Depends()):
+    """
+    :param args: ip, start, end (timestamps, inclusive), max_points (at
+                 most Config.NETFLOW_MAX_POINTS, samples are downsampled
+                 into time buckets beyond it)
+    """
     if not args.ip:
         return {'data': {}, 'status': 'ok', 'message': ''}
 
-    _table = TableSelector.get_ip_netflow_table()
-    data = []
+    _max = min(args.max_points or Config.NETFLOW_MAX_POINTS, Config.NETFLOW_MAX_POINTS)
 
-    q = {'ip': args.ip}
-    logger.debug(f'q={q}')
+    if Config.NETFLOW_LAYOUT == 'bucket':
+        data = await _read_netflow_buckets(args.ip, args.start, args.end)
+
+    else:
+        data = await _read_netflow_samples(args.ip, args.start, args.end)
+
+    _total = len(data)
+    data = downsample_netflow(data, VIS_IP_NETFLOW_KEYS[1:-1], _max)
+
+    return {'data': data, 'status': 'ok', 'message': '',
+            'total': _total, 'downsampled': len(data) < _total}
 
-    async for cur in _table.find(q, {'_id': 0, 'n': 0, 'ip': 0}):
-        data.append(cur)
 
-    data = sorted(data, key=lambda x: x['timestamp'])
+@router.get('/netflow/top')
+async def ip_netflow_top(args: IPNetflowTopQuery = Depends()):
+    """
+    :param args: metric, n (at most Config.NETFLOW_TOP_KEEP), start, end
+    :return: the n ips with the highest mean of metric in a window of
+             Config.NETFLOW_WINDOW seconds between start and end, read
+             from the rollup kept by `cli.py netflow import`
+    {
+    "data": [{"ip": "1.2.3.4", "value": 123.4, "window": 1690000000}],
+    "status": "ok",
+    "message": ""
+    }
+    """
+    _n = min(args.n, Config.NETFLOW_TOP_KEEP)
+    data = await get_netflow_top(args.metric, _n, args.start, args.end)
+    return {'data': data, 'status': 'ok', 'message': ''}
+
+
+@router.get('/netflow/anomaly')
+async def ip_netflow_anomaly(args: IPNetflowAnomalyQuery = Depends()):
+    """
+    :param args: start, end
+    :return: ips with an anomalous sample between start and end, count is
+             the number of anomalous windows, first and last their starts
+    {
+    "data": [{"ip": "1.2.3.4", "count": 3, "first": 1690000000, "last": 1690007200}],
+    "status": "ok",
+    "message": ""
+    }
+    """
+    data = await get_netflow_anomalies(args.start, args.end)
     return {'data': data, 'status': 'ok', 'message': ''}
 
 
@@ -501,6 +662,11 @@ async def probe_picture(args: ProbePictureQuery = Depends()):
 
     q = {'ip': str_to_int_v4(args.ip) if args.v == '4' else str_to_exploded_ipv6(args.ip)}
 
+    # a definite miss of the bloom filter never reaches mongo
+    _bloom = await get_picture_filter(args.v)
+    if ip_to_int(q['ip'], args.v) not in _bloom:
+        return {'data': {}, 'status': 'ok', 'message': 'not matched'}
+
     logger.debug(f'q={q}')
 
     _cur = await _table.find_one(q, {'_id': 0})
@@ -510,18 +676,79 @@ async def probe_picture(args: ProbePictureQuery = Depends()):
     return {'data': convert_picture(args.v, _cur), 'status': 'ok', 'message': ''}
 
 
+async def _iter_pictures(v: str, ips: list):
+    _table = TableSelector.get_ip_picture(v)
+    _bloom = await get_picture_filter(v)
+    step = Config.PROBE_BATCH_CHUNK
+
+    yield b'{"data":['
+
+    for i in range(0, len(ips), step):
+        _ips = ips[i: i + step]
+        _keys = [to_picture_key(v, _ip) for _ip in _ips]
+
+        # one $in query per chunk for what the bloom filter lets through,
+        # duplicates are queried once
+        _keys_in = list({_k for _k in _keys if _k is not None})
+        if _keys_in:
+            _maybe = _bloom.contains_many([ip_to_int(_k, v) for _k in _keys_in])
+            _keys_in = [_k for _k, _m in zip(_keys_in, _maybe.tolist()) if _m]
+
+        found = {}
+        if _keys_in:
+            async for _cur in _table.find({'ip': {'$in': _keys_in}}, {'_id': 0}):
+                found[_cur['ip']] = _cur
+
+        items = []
+        for _ip, _key in zip(_ips, _keys):
+            if _key is None:
+                items.append({'ip': _ip, 'data': {}, 'message': 'invalid ip'})
+            elif _key not in found:
+                items.append({'ip': _ip, 'data': {}, 'message': 'not matched'})
+            else:
+                items.append({'ip': _ip, 'data': convert_picture(v, dict(found[_key])),
+                              'message': ''})
+
+        _raw = b','.join(orjson.dumps(_item) for _item in items)
+        yield _raw if i == 0 else b',' + _raw
+
+    yield b'],"status":"ok","message":""}'
+
+
+@router.post('/probe/picture/batch')
+async def probe_picture_batch(body: ProbePictureBatchBody):
+    """
+    :param body: {"v": "4", "ips": ["1.1.1.1", "1.1.1.2"]}
+    :return: streamed in the order of ips
+    {
+    "data": [{
+        "ip": "1.1.1.1",
+        "data": {...},  # as /probe/picture
+        "message": ""  # or not matched, invalid ip
+    }],
+    "status": "ok",
+    "message": ""
+    }
+    """
+    if len(body.ips) > Config.PROBE_BATCH_MAX:
+        return {'data': [], 'status': 'ok',
+                'message': f'too many ips, at most {Config.PROBE_BATCH_MAX}'}
+
+    logger.debug(f'batch picture ips={len(body.ips)}, v={body.v}')
+    return StreamingResponse(_iter_pictures(body.v, body.ips), media_type='application/json')
+
+
 @router.get('/probe/countries')
 async def probe_countries(args: IPBaseQuery = Depends()):
-    _table = TableSelector.get_ip_picture(args.v)
+    # from the rollup the importers keep, not distinct over the pictures
+    _rollup = await get_probe_rollup(args.v)
 
-    cc = await _table.distinct('cc')
-    carriers = await _table.distinct('carrier', {'cc': Regions.CN})
-    carriers = list(set(carriers) - {Regions.UNKNOWN})
+    carriers = list(set(_rollup.carriers(Regions.CN)) - {Regions.UNKNOWN})
 
     data = []
     _me = {}
 
-    for _c in cc:
+    for _c in _rollup.countries():
         if Regions.is_unknown(_c):
             continue
 
@@ -543,44 +770,18 @@ async def probe_countries(args: IPBaseQuery = Depends()):
 
 @router.get('/probe/map')
 async def probe_map(args: ProbeMapQuery = Depends()):
+    """
+    :param args: v, country, refresh (kept for compatibility, the rollup
+                 always reflects the last import)
+    """
+    _rollup = await get_probe_rollup(args.v)
 
     if not args.country:
-        pipe = [
-            {'$group': {'_id': '$cc', 'count': {'$sum': 1}}}
-        ]
+        items = _rollup.country_map()
         _type = 'country'
-        _key = 'ip/probe/map'
 
     else:
-        pipe = [
-            {'$match': {'cc': args.country.upper()}},
-            {'$group': {'_id': '$carrier', 'count': {'$sum': 1}}}
-        ]
+        items = _rollup.carrier_map(args.country.upper())
         _type = 'carrier'
-        _key = f'ip/probe/map/{args.country.upper()}'
-
-    if args.refresh == 0:
-        _cached = await VisCache.get_cache(_key)
-
-        if _cached:
-            return _cached
-
-    _table = TableSelector.get_ip_picture(args.v)
-    logger.debug(f'probe_map_pipe={pipe}')
-
-    items = []
-    async for cur in _table.aggregate(pipe):
-        if Regions.is_unknown(cur['_id']):
-            continue
-
-        item = {
-            'name': cur['_id'],
-            'count': cur['count']
-        }
-        items.append(item)
-
-    items = sorted(items, key=lambda x: x['count'], reverse=True)
-    data = {'data': items, 'status': 'ok', 'message': '', 'type': _type}
 
-    await VisCache.add_cache(_key, data)
-    return data
+    return {'data': items, 'status': 'ok', 'message': '', 'type': _type}
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import logging
+from collections import Counter
+from config import Config
+
+
+logger = logging.getLogger('ip.warmup')
+
+
+class SpaceWarmer:
+    """
+    warms /ip/space snapshot keys (v, date, tight) in a background task,
+    at most Config.SPACE_WARMUP_CONCURRENCY at a time; the latest date of
+    every (v, tight) goes first, then the most requested, then the newest
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.hits = Counter()  # {(v, date, tight): requests}
+
+        self.done = 0
+        self.failed = 0
+        self.running = 0
+        self.started_at = None
+        self.finished_at = None
+
+        self._pending = set()
+        self._latest = set()
+        self._task = None
+
+    @property
+    def total(self) -> int:
+        return len(self.keys)
+
+    @property
+    def percent(self) -> float:
+        if not self.keys:
+            return 100.0
+        # failed keys are cold, they are not counted as warmed
+        return round(self.done * 100 / len(self.keys), 2)
+
+    def hit(self, key: tuple):
+        # only keys still to warm are reordered, any other date a client
+        # asks for is not kept
+        if key in self._pending:
+            self.hits[key] += 1
+
+    def status(self) -> dict:
+        _end = self.finished_at or time.time()
+        return {'warm': self.percent,
+                'total': self.total,
+                'done': self.done,
+                'failed': self.failed,
+                'running': self.running,
+                'pending': len(self._pending),
+                'elapsed': round(_end - self.started_at, 3) if self.started_at else 0}
+
+    def _next_key(self) -> tuple:
+        # hits are read at every pick, requests reorder what is left
+        _key = max(self._pending, key=lambda k: (k in self._latest, self.hits[k], k[1]))
+        self._pending.remove(_key)
+        self.hits.pop(_key, None)
+        return _key
+
+    async def _warm(self, warm_fn, key: tuple, semaphore: asyncio.Semaphore):
+        self.running += 1
+        try:
+            await warm_fn(*key)
+            self.done += 1
+
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f'failed to warm key={key}, err={e}')
+
+        finally:
+            self.running -= 1
+            semaphore.release()
+
+    async def _run(self, warm_fn):
+        semaphore = asyncio.Semaphore(max(Config.SPACE_WARMUP_CONCURRENCY, 1))
+        tasks = []
+
+        while self._pending:
+            await semaphore.acquire()
+            _key = self._next_key()
+            tasks.append(asyncio.create_task(self._warm(warm_fn, _key, semaphore)))
+
+        await asyncio.gather(*tasks)
+
+        self.finished_at = time.time()
+        logger.info(f'finished warmup {self.status()}')
+
+    def start(self, keys: list, warm_fn):
+        """
+        :param keys: [(v, date, tight)]
+        :param warm_fn: async fn(v, date, tight)
+        """
+        self.keys = list(keys)
+        self._pending = set(self.keys)
+
+        _latest = {}
+        for v, date, tight in self.keys:
+            _latest[(v, tight)] = max(date, _latest.get((v, tight), 0))
+        self._latest = {(v, date, tight) for (v, tight), date in _latest.items()}
+
+        self.done = self.failed = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+        self._task = asyncio.create_task(self._run(warm_fn))
+        return self._task
+
+
+space_warmer = SpaceWarmer()
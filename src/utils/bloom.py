@@ -0,0 +1,103 @@
+import os
+import json
+import math
+import logging
+import numpy as np
+
+
+logger = logging.getLogger('utils.bloom')
+
+_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_M2 = np.uint64(0x94D049BB133111EB)
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(x):
+    # splitmix64 finalizer, on uint64 arrays, overflow wraps
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * _M1
+        x = (x ^ (x >> np.uint64(27))) * _M2
+        return x ^ (x >> np.uint64(31))
+
+
+def split_keys(keys) -> (np.ndarray, np.ndarray):
+    # int keys up to 128 bits -> (hi, lo) uint64 arrays
+    hi = np.array([k >> 64 for k in keys], dtype=np.uint64)
+    lo = np.array([k & 0xFFFFFFFFFFFFFFFF for k in keys], dtype=np.uint64)
+    return hi, lo
+
+
+class BloomFilter:
+    """
+    bit array with k positions per key from double hashing (h1 + i * h2),
+    keys are ints of up to 128 bits; a filter with no bits lets every key
+    through, so a missing file never hides a match
+    """
+
+    def __init__(self, m: int, k: int, bits: np.ndarray = None, meta: dict = None):
+        self.m = m
+        self.k = k
+        self.bits = bits if bits is not None else np.zeros((m + 7) // 8, dtype=np.uint8)
+        self.meta = meta or {}
+
+    @classmethod
+    def with_capacity(cls, n: int, fp_rate: float):
+        n = max(n, 1)
+        m = max(int(-n * math.log(fp_rate) / math.log(2) ** 2), 8)
+        k = max(round(m / n * math.log(2)), 1)
+        return cls(m, k, meta={'n': n, 'fp_rate': fp_rate})
+
+    @classmethod
+    def passthrough(cls):
+        return cls(0, 0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.m > 0
+
+    def _positions(self, hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+        with np.errstate(over='ignore'):
+            h1 = _mix(lo ^ _mix(hi + _GOLDEN))
+            h2 = _mix(h1 ^ _GOLDEN) | np.uint64(1)
+
+            i = np.arange(self.k, dtype=np.uint64)[:, None]
+            return ((h1 + i * h2) % np.uint64(self.m)).astype(np.int64)
+
+    def add_many(self, keys, chunk: int = 2 ** 20):
+        # k positions per key, chunked to keep the temporaries small
+        for i in range(0, len(keys), chunk):
+            pos = self._positions(*split_keys(keys[i: i + chunk])).ravel()
+            np.bitwise_or.at(self.bits, pos >> 3, (1 << (pos & 7)).astype(np.uint8))
+
+    def contains_many(self, keys) -> np.ndarray:
+        if not self.enabled:
+            return np.ones(len(keys), dtype=bool)
+
+        pos = self._positions(*split_keys(keys))
+        return ((self.bits[pos >> 3] >> (pos & 7)) & 1).astype(bool).all(axis=0)
+
+    def __contains__(self, key: int) -> bool:
+        return bool(self.contains_many([key])[0])
+
+    def save(self, path: str):
+        # bits first, a complete meta file means complete bits
+        meta = dict(self.meta, m=self.m, k=self.k)
+
+        with open(f'{path}.npy.{os.getpid()}', 'wb') as fd:
+            np.save(fd, self.bits)
+        os.replace(f'{path}.npy.{os.getpid()}', f'{path}.npy')
+
+        with open(f'{path}.json.{os.getpid()}', 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(f'{path}.json.{os.getpid()}', f'{path}.json')
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(f'{path}.json'):
+            return None
+
+        with open(f'{path}.json', 'r') as fd:
+            meta = json.load(fd)
+
+        bits = np.load(f'{path}.npy', mmap_mode='r')
+        return cls(meta['m'], meta['k'], bits=bits, meta=meta)
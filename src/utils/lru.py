@@ -0,0 +1,61 @@
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger('utils.lru')
+
+
+class BytesLRUCache:
+    """
+    serialized responses bounded by their total size in bytes, the least
+    recently used are evicted first and everything is dropped once the
+    version of the dataset they were built from changes
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()  # {key: (bytes, ...)}
+
+    def __len__(self):
+        return len(self._store)
+
+    def clear(self, version=None):
+        self._store.clear()
+        self.size = 0
+        self.version = version
+
+    def get(self, key, version):
+        if version != self.version:
+            logger.debug(f'version changed from={self.version} to={version}, clear cache')
+            self.clear(version)
+
+        value = self._store.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._store.move_to_end(key)
+        return value
+
+    def set(self, key, version, value: tuple):
+        if version != self.version:
+            self.clear(version)
+
+        size = sum(len(_v) for _v in value if _v)
+        if size > self.max_bytes:
+            return
+
+        if key in self._store:
+            self.size -= sum(len(_v) for _v in self._store.pop(key) if _v)
+
+        self._store[key] = value
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, _value = self._store.popitem(last=False)
+            self.size -= sum(len(_v) for _v in _value if _v)
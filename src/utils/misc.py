@@ -1,11 +1,14 @@
 import os
+import json
 import time
+import base64
 import logging
 import subprocess
 import multiprocessing
 import traceback
 from ipaddress import IPv4Network, IPv6Network, IPv4Address, IPv6Address, ip_address
 from datetime import datetime
+from typing import Optional
 
 
 logger = logging.getLogger('utils.misc')
@@ -191,6 +194,19 @@ def str_to_exploded_ipv6(s):
     return ip_address(s).exploded
 
 
+def encode_cursor(values: list) -> str:
+    # opaque page token, big ints (ipv6) are kept as strings
+    raw = json.dumps([str(_v) if isinstance(_v, int) else _v for _v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(token: str) -> Optional[list]:
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        return None
+
+
 def extract_limit_offset_from_args(args):
     _limit = args.page_size if args.page_size > 0 else 30
     _offset = (args.page - 1) * _limit if args.page > 0 else 0